@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from datetime import datetime
+from pyrogram import enums, raw, types
+from pyrogram.file_id import FileId, FileType, FileUniqueId, FileUniqueType
+from bot.utils.uploader import UploadEngine
+
+LOGGER = logging.getLogger(__name__)
+
+BOT_USER_ID = 777000
+
+
+class FakeClient:
+    """In-process stand-in for pyrogram.Client.
+
+    Handlers registered with `on_message`/`on_callback_query` are dispatched with real pyrogram
+    filters and real `types.Message` objects bound to this client, so the bot code runs unchanged.
+    Every outgoing call is recorded instead of being sent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.me = types.User(id=BOT_USER_ID, is_bot=True, first_name="bench", username="benchbot")
+        self.handlers = []  # (kind, filters, callback), in registration order
+        self.messages = {}  # (chat_id, message_id) -> Message
+        self.media_files = {}  # media_id -> path of the file behind a fake file_id
+        self.message_ids = itertools.count(1)
+        self.media_ids = itertools.count(1)
+        self.videos = {}  # chat_id -> videos sent to it
+        self.video_events = {}  # chat_id -> asyncio.Event set on each video
+        self.calls = {}  # method name -> count
+
+    # Handler registration and dispatch
+
+    def on_message(self, filters=None, group=0):
+        def decorator(func):
+            self.handlers.append(('message', filters, func))
+            return func
+        return decorator
+
+    def on_callback_query(self, filters=None, group=0):
+        def decorator(func):
+            self.handlers.append(('callback_query', filters, func))
+            return func
+        return decorator
+
+    async def _dispatch(self, kind, update):
+        # Like pyrogram, only the first matching handler of the group runs
+        for handler_kind, flt, func in self.handlers:
+            if handler_kind == kind and (flt is None or await flt(self, update)):
+                await func(self, update)
+                return True
+        return False
+
+    async def feed_message(self, message):
+        return await self._dispatch('message', message)
+
+    async def feed_callback(self, callback_query):
+        return await self._dispatch('callback_query', callback_query)
+
+    # Building incoming updates
+
+    def user(self, user_id):
+        return types.User(id=user_id, is_bot=False, first_name=f"user{user_id}", client=self)
+
+    def chat(self, chat_id):
+        return types.Chat(id=chat_id, type=enums.ChatType.PRIVATE, client=self)
+
+    def _store(self, chat_id, **kwargs):
+        message = types.Message(
+            id=next(self.message_ids), chat=self.chat(chat_id), date=datetime.now(), client=self, **kwargs
+        )
+        self.messages[(chat_id, message.id)] = message
+        return message
+
+    def incoming_text(self, user_id, text, reply_to_message=None):
+        return self._store(
+            user_id, from_user=self.user(user_id), text=text, reply_to_message=reply_to_message,
+            reply_to_message_id=reply_to_message.id if reply_to_message else None
+        )
+
+    def incoming_video(self, user_id, path, width=1280, height=720, duration=0):
+        """A video message from the user whose file_id resolves to `path`."""
+        media_id = next(self.media_ids)
+        self.media_files[media_id] = path
+        video = types.Video(
+            client=self,
+            file_id=FileId(
+                file_type=FileType.VIDEO, dc_id=2, media_id=media_id, access_hash=0, file_reference=b""
+            ).encode(),
+            file_unique_id=FileUniqueId(file_unique_type=FileUniqueType.DOCUMENT, media_id=media_id).encode(),
+            width=width,
+            height=height,
+            duration=duration,
+            file_name=os.path.basename(path),
+            mime_type="video/mp4",
+            file_size=os.path.getsize(path),
+        )
+        return self._store(user_id, from_user=self.user(user_id), video=video)
+
+    def callback(self, user_id, message, data):
+        return types.CallbackQuery(
+            id=str(next(self.message_ids)), from_user=self.user(user_id), chat_instance="bench",
+            message=message, data=data, client=self
+        )
+
+    # Client API used by the bot
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def start(self):
+        self._count('start')
+
+    async def stop(self):
+        self._count('stop')
+
+    def rnd_id(self):
+        return int.from_bytes(os.urandom(8), "big", signed=True)
+
+    async def resolve_peer(self, chat_id):
+        return raw.types.InputPeerUser(user_id=chat_id, access_hash=0)
+
+    async def send_message(self, chat_id, text, reply_markup=None, reply_to_message_id=None, **kwargs):
+        self._count('send_message')
+        return self._store(chat_id, from_user=self.me, text=text, reply_markup=reply_markup)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None, **kwargs):
+        self._count('edit_message_text')
+        message = self.messages.get((chat_id, message_id))
+        if message is not None:
+            message.text = text
+            message.reply_markup = reply_markup
+        return message
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        self._count('delete_messages')
+        ids = message_ids if isinstance(message_ids, (list, tuple)) else [message_ids]
+        for message_id in ids:
+            self.messages.pop((chat_id, message_id), None)
+        return len(ids)
+
+    async def get_messages(self, chat_id, message_ids=None, **kwargs):
+        self._count('get_messages')
+        message = self.messages.get((chat_id, message_ids))
+        return message or types.Message(id=message_ids, empty=True)
+
+    async def answer_callback_query(self, *args, **kwargs):
+        self._count('answer_callback_query')
+        return True
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids, **kwargs):
+        self._count('forward_messages')
+        source = self.messages[(from_chat_id, message_ids)]
+        return self._store(chat_id, from_user=self.me, video=source.video)
+
+    async def send_video(self, chat_id, video, caption="", duration=0, width=0, height=0, **kwargs):
+        """Record a video; `video` is a local path (after a fake upload) or a file_id being re-sent."""
+        self._count('send_video')
+        if isinstance(video, str) and os.path.isfile(video):
+            media_id = next(self.media_ids)
+            self.media_files[media_id] = video
+            file_id = FileId(
+                file_type=FileType.VIDEO, dc_id=2, media_id=media_id, access_hash=0, file_reference=b""
+            ).encode()
+            file_unique_id = FileUniqueId(file_unique_type=FileUniqueType.DOCUMENT, media_id=media_id).encode()
+            file_size = os.path.getsize(video)
+        else:
+            file_id, file_unique_id, file_size = video, f"resent{next(self.media_ids)}", None
+        media = types.Video(
+            client=self, file_id=file_id, file_unique_id=file_unique_id, width=width, height=height,
+            duration=duration, file_size=file_size
+        )
+        message = self._store(chat_id, from_user=self.me, video=media, caption=caption)
+        self.videos.setdefault(chat_id, []).append(message)
+        self.video_event(chat_id).set()
+        return message
+
+    async def send_cached_media(self, chat_id, file_id, caption="", **kwargs):
+        self._count('send_cached_media')
+        return await self.send_video(chat_id, file_id, caption=caption)
+
+    def video_event(self, chat_id):
+        return self.video_events.setdefault(chat_id, asyncio.Event())
+
+    async def stream_media(self, message, limit=0, offset=0):
+        path = self._path_of(message)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, 1024 * 1024)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def download_media(self, message, file_name=None, progress=None, progress_args=(), **kwargs):
+        self._count('download_media')
+        await asyncio.to_thread(_copy, self._path_of(message), file_name)
+        return file_name
+
+    def _path_of(self, message):
+        media = message.video or message.document
+        return self.media_files[FileId.decode(media.file_id).media_id]
+
+
+def _copy(source, target):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        while True:
+            chunk = src.read(1024 * 1024)
+            if not chunk:
+                return
+            dst.write(chunk)
+
+
+class FakeSession:
+    """Media session that serves GetFile and accepts uploaded parts with a simulated link.
+
+    Each request costs one round trip plus its size over the per-connection bandwidth,
+    which is what makes parallel transfers pay off against Telegram.
+    """
+
+    def __init__(self, client, rtt, bandwidth):
+        self.client = client
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.lock = asyncio.Lock()  # One request on the wire at a time per connection
+
+    async def _transfer(self, size):
+        async with self.lock:
+            await asyncio.sleep(self.rtt + size / self.bandwidth)
+        self.requests += 1
+
+    async def invoke(self, query, **kwargs):
+        if isinstance(query, raw.functions.upload.GetFile):
+            path = self.client.media_files[query.location.id]
+            with open(path, 'rb') as f:
+                f.seek(query.offset)
+                data = f.read(query.limit)
+            await self._transfer(len(data))
+            return raw.types.upload.File(type=raw.types.storage.FileMp4(), mtime=int(time.time()), bytes=data)
+        if isinstance(query, (raw.functions.upload.SaveFilePart, raw.functions.upload.SaveBigFilePart)):
+            await self._transfer(len(query.bytes))
+            return True
+        raise NotImplementedError(f"FakeSession does not handle {type(query).__name__}")
+
+
+class FakeSessionPool:
+    """SessionPool replacement handing out FakeSessions."""
+
+    def __init__(self, client, rtt=0.05, bandwidth=5 * 1024 * 1024):
+        self.client = client
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.pools = {}
+        self.counter = itertools.count()
+
+    async def sessions(self, dc_id=None, count=1):
+        pool = self.pools.setdefault(dc_id or 2, [])
+        while len(pool) < count:
+            pool.append(FakeSession(self.client, self.rtt, self.bandwidth))
+        return pool[:count] if count else list(pool)
+
+    async def session(self, dc_id=None, count=1):
+        pool = await self.sessions(dc_id, count)
+        return pool[next(self.counter) % len(pool)]
+
+    def size(self):
+        return {dc_id: len(pool) for dc_id, pool in self.pools.items()}
+
+    async def close(self):
+        self.pools.clear()
+
+
+class BenchUploadEngine(UploadEngine):
+    """Runs the real parallel part upload against fake sessions, then records the video."""
+
+    async def send_video(self, chat_id, path, caption="", duration=0, width=0, height=0, thumb=None,
+                         reply_to_message_id=None, progress=None, progress_args=()):
+        await self.upload(path, progress, progress_args)
+        return await self.client.send_video(
+            chat_id, path, caption=caption, duration=duration, width=width, height=height
+        )
@@ -0,0 +1,115 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+LOGGER = logging.getLogger(__name__)
+
+
+def find_ffmpeg():
+    """Path of an ffmpeg binary: the bot's `vegapunk`, a system ffmpeg or the imageio-ffmpeg wheel."""
+    for name in ("vegapunk", "ffmpeg"):
+        path = shutil.which(name)
+        if path:
+            return path
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        raise RuntimeError("No ffmpeg found; install ffmpeg or the imageio-ffmpeg package")
+
+
+def generate_videos(directory, count, duration, size="1280x720", rate=30):
+    """Render `count` synthetic test videos (moving pattern plus a tone) and return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    ffmpeg = find_ffmpeg()
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"sample{index}_{size}_{duration}s.mp4")
+        if not os.path.exists(path):
+            subprocess.run([
+                ffmpeg, "-v", "error", "-y",
+                "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}",
+                "-f", "lavfi", "-i", f"sine=frequency={220 * (index + 1)}",
+                "-t", str(duration),
+                "-c:v", "libx264", "-preset", "veryfast", "-g", str(rate * 2),
+                "-c:a", "aac", "-movflags", "+faststart",
+                path
+            ], check=True)
+        paths.append(path)
+    LOGGER.info(f"Generated {count} sample videos in {directory}")
+    return paths
+
+
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler that honours single `Range: bytes=` requests, as yt-dlp resumes with them."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            pass  # yt-dlp closes connections early once it has what it needs
+
+    def send_head(self):
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start >= size:
+            self.send_error(416, "Requested range not satisfiable")
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        self.range_remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "range_remaining", None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+
+class MediaServer:
+    """Serves a directory over HTTP on 127.0.0.1 from a background thread."""
+
+    def __init__(self, directory, port=0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), partial(_RangeRequestHandler, directory=directory))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, path):
+        return f"{self.base_url}/{os.path.basename(path)}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,276 @@
+"""Offline end-to-end benchmark of the /yl and /add pipelines.
+
+Runs the real Bot handlers against an in-process fake Telegram client and a local HTTP server
+serving ffmpeg-generated videos, then writes latency, throughput, memory and disk figures as JSON:
+
+    python -m bench.run --yl 4 --add 4 --duration 20 --output bench-results.json
+
+Config values can be overridden for a run with --set NAME=VALUE (e.g. --set JOB_ENCODE_SLOTS=2).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOGGER = logging.getLogger("bench")
+
+DEFAULT_FFMPEG_CODE = "-c:v libx264 -preset ultrafast -crf 30 -c:a copy"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--yl", type=int, default=4, help="concurrent /yl flows")
+    parser.add_argument("--add", type=int, default=4, help="concurrent /add flows")
+    parser.add_argument("--videos", type=int, default=0, help="distinct sample videos (default: one per flow)")
+    parser.add_argument("--duration", type=int, default=10, help="sample video length in seconds")
+    parser.add_argument("--size", default="1280x720", help="sample video resolution")
+    parser.add_argument("--ffmpeg-code", default=DEFAULT_FFMPEG_CODE, help="code set with /set for every user")
+    parser.add_argument("--rtt-ms", type=float, default=50, help="simulated Telegram round trip per request")
+    parser.add_argument("--connection-mbps", type=float, default=40, help="simulated bandwidth per connection")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="config override")
+    parser.add_argument("--workdir", help="working directory (default: a temporary one)")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before unfinished flows count as failed")
+    parser.add_argument("--output", default="bench-results.json", help="where to write the JSON results")
+    return parser.parse_args(argv)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * fraction
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def tree_size(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Sampler:
+    """Tracks peak RSS of the bot process and peak disk usage of the downloads directory."""
+
+    def __init__(self, downloads_dir, interval=0.25):
+        self.downloads_dir = downloads_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+
+    async def run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, current_rss())
+            self.peak_disk = max(self.peak_disk, await asyncio.to_thread(tree_size, self.downloads_dir))
+            await asyncio.sleep(self.interval)
+
+
+class Harness:
+    def __init__(self, args, bot, fake, urls, videos):
+        self.args = args
+        self.bot = bot
+        self.fake = fake
+        self.urls = urls
+        self.videos = videos
+
+    async def prepare_user(self, user_id):
+        await self.bot.db.add_authorized_user(user_id)
+        await self.fake.feed_message(self.fake.incoming_text(user_id, f"/set {self.args.ffmpeg_code}"))
+
+    async def wait_for_video(self, user_id):
+        """Wait until the user got a video, or until their jobs ended without one."""
+        while not self.fake.videos.get(user_id):
+            if not self.bot.scheduler.user_jobs(user_id):
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def youtube_flow(self, user_id, url):
+        started = time.monotonic()
+        await self.fake.feed_message(self.fake.incoming_text(user_id, f"/yl {url}"))
+        menu = next(
+            (m for (chat_id, _), m in reversed(list(self.fake.messages.items()))
+             if chat_id == user_id and m.reply_markup is not None),
+            None
+        )
+        if menu is None:
+            return self._result("yl", user_id, started, False, "no format menu")
+        buttons = [button for row in menu.reply_markup.inline_keyboard for button in row]
+        if not buttons:
+            return self._result("yl", user_id, started, False, "empty format menu")
+        await self.fake.feed_callback(self.fake.callback(user_id, menu, buttons[-1].callback_data))
+        return self._result("yl", user_id, started, await self.wait_for_video(user_id))
+
+    async def add_flow(self, user_id, path):
+        video_message = self.fake.incoming_video(user_id, path, duration=self.args.duration)
+        started = time.monotonic()
+        await self.fake.feed_message(self.fake.incoming_text(user_id, "/add", reply_to_message=video_message))
+        return self._result("add", user_id, started, await self.wait_for_video(user_id))
+
+    def _result(self, kind, user_id, started, ok, error=None):
+        last_status = next(
+            (m.text for (chat_id, _), m in reversed(list(self.fake.messages.items()))
+             if chat_id == user_id and m.text and m.from_user and m.from_user.id == self.fake.me.id),
+            None
+        )
+        return {
+            "kind": kind,
+            "user_id": user_id,
+            "ok": ok,
+            "latency": time.monotonic() - started,
+            "error": None if ok else (error or last_status),
+        }
+
+    async def run(self):
+        flows = []
+        user_id = 1000
+        for index in range(self.args.yl):
+            user_id += 1
+            await self.prepare_user(user_id)
+            flows.append(self.youtube_flow(user_id, self.urls[index % len(self.urls)]))
+        for index in range(self.args.add):
+            user_id += 1
+            await self.prepare_user(user_id)
+            flows.append(self.add_flow(user_id, self.videos[index % len(self.videos)]))
+        return await asyncio.wait_for(asyncio.gather(*flows), self.args.timeout)
+
+
+def summarize(kind, results, wall, input_bytes):
+    latencies = [r["latency"] for r in results if r["ok"]]
+    return {
+        "flows": len(results),
+        "succeeded": len(latencies),
+        "failed": len(results) - len(latencies),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_mean": statistics.mean(latencies) if latencies else None,
+        "jobs_per_minute": len(latencies) / wall * 60 if wall else None,
+        "input_mb_per_second": input_bytes / 1024 / 1024 / wall if wall else None,
+    }
+
+
+async def bench(args):
+    from bench.fake_telegram import FakeClient, FakeSessionPool, BenchUploadEngine
+    from bench.media_server import MediaServer, generate_videos, find_ffmpeg
+    import bot.client
+    from bot.utils.downloader import engine
+    from bot.utils.metrics import encode_metrics
+    from bot.utils.status import status_editor
+    from config import DOWNLOADS_DIR, PARALLEL_UPLOAD_CONNECTIONS
+
+    # The bot invokes ffmpeg as `vegapunk`
+    shim_dir = os.path.abspath("bin")
+    os.makedirs(shim_dir, exist_ok=True)
+    for name in ("vegapunk", "ffmpeg"):
+        shim = os.path.join(shim_dir, name)
+        if not os.path.exists(shim):
+            os.symlink(find_ffmpeg(), shim)
+    os.environ["PATH"] = shim_dir + os.pathsep + os.environ.get("PATH", "")
+
+    count = args.videos or max(args.yl, args.add, 1)
+    videos = await asyncio.to_thread(generate_videos, os.path.abspath("media"), count, args.duration, args.size)
+    server = MediaServer(os.path.abspath("media")).start()
+    urls = [server.url(path) for path in videos]
+
+    bot.client.Client = FakeClient
+    instance = bot.client.Bot()
+    fake = instance.app
+    instance.sessions = FakeSessionPool(fake, args.rtt_ms / 1000, args.connection_mbps * 1024 * 1024 / 8)
+    instance.uploader = BenchUploadEngine(fake, instance.sessions, PARALLEL_UPLOAD_CONNECTIONS)
+    await instance.db.initialize()
+    bot_task = asyncio.create_task(instance.run())
+    await asyncio.sleep(0.5)
+
+    sampler = Sampler(DOWNLOADS_DIR)
+    sampler_task = asyncio.create_task(sampler.run())
+    started = time.monotonic()
+    try:
+        results = await Harness(args, instance, fake, urls, videos).run()
+    finally:
+        wall = time.monotonic() - started
+        # Jobs still release their reservations after the video arrives; let them finish before closing the DB
+        pending = list(instance.scheduler.tasks.values())
+        if pending:
+            await asyncio.wait(pending, timeout=30)
+        sampler_task.cancel()
+        bot_task.cancel()
+        await asyncio.gather(sampler_task, bot_task, return_exceptions=True)
+        engine.shutdown()
+        server.stop()
+
+    sizes = {path: os.path.getsize(path) for path in videos}
+    yl_bytes = sum(sizes[videos[i % len(videos)]] for i in range(args.yl))
+    add_bytes = sum(sizes[videos[i % len(videos)]] for i in range(args.add))
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "workdir")},
+        "wall_seconds": wall,
+        "all": summarize("all", results, wall, yl_bytes + add_bytes),
+        "yl": summarize("yl", [r for r in results if r["kind"] == "yl"], wall, yl_bytes),
+        "add": summarize("add", [r for r in results if r["kind"] == "add"], wall, add_bytes),
+        "peak_rss_mb": sampler.peak_rss / 1024 / 1024,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "peak_disk_mb": sampler.peak_disk / 1024 / 1024,
+        "leftover_disk_mb": tree_size(DOWNLOADS_DIR) / 1024 / 1024,
+        "status_edits": status_editor.stats(),
+        "uploads": instance.uploader.stats(),
+        "encodes": encode_metrics.summary(),
+        "telegram_calls": fake.calls,
+        "flows": results,
+    }
+    await instance.db.close()
+    return report
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    output = os.path.abspath(args.output)
+    for override in args.set:
+        name, _, value = override.partition("=")
+        os.environ[name] = value
+    # config.py resolves the database and downloads directory against the working directory
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    report = asyncio.run(bench(args))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    for kind in ("yl", "add", "all"):
+        s = report[kind]
+        if s["flows"]:
+            print(
+                f"{kind:>3}: {s['succeeded']}/{s['flows']} ok, p50 {s['latency_p50'] or 0:.1f}s, "
+                f"p95 {s['latency_p95'] or 0:.1f}s, {s['jobs_per_minute'] or 0:.1f} jobs/min"
+            )
+    print(f"peak RSS {report['peak_rss_mb']:.0f} MB, peak disk {report['peak_disk_mb']:.0f} MB -> {output}")
+
+
+if __name__ == "__main__":
+    main()
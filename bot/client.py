@@ -1,33 +1,104 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, CallbackQuery
+from pyrogram.errors import RPCError
 import os
 import asyncio
+import json
 import re
+import time
 from .database.db_manager import Database
-from .utils.downloader import get_video_formats, download_video
-from .utils.compressor import compress_video
-from .utils.helpers import create_format_buttons, clean_files, progress, get_video_duration, take_screenshot
-from config import API_ID, API_HASH, BOT_TOKEN, DUMP_CHANNEL, DOWNLOADS_DIR, AUTH_USERS
+from .utils.downloader import (
+    get_video_formats, get_video_info, get_format, download_video, can_stream, stream_video, info_cache,
+    estimate_size, extract_entries, is_playlist_url, select_format
+)
+from .utils.compressor import compress_video, compress_stream, is_passthrough
+from .utils.helpers import (
+    create_format_buttons, progress, track_progress, probe_media, take_screenshot,
+    format_duration, format_size, create_quality_buttons
+)
+from .utils.scheduler import JobScheduler
+from .utils.broker import JobBroker, default_worker_id
+from .utils.metrics import encode_metrics, timed, HANDLER_SECONDS, ACTIVE_JOBS, STAGE_JOBS, DISK_BYTES
+from .utils.results import ResultCache, youtube_source_key, telegram_source_key
+from .utils.pipeline import Pipeline, StageFailed
+from .utils.presets import is_adaptive, parse_target
+from .utils.encode_cache import encode_cache
+from .utils.callbacks import CallbackSessions
+from .utils.status import status_editor
+from .utils.parallel_download import download_media
+from .utils.sessions import SessionPool
+from .utils.partials import ResumableDownloads
+from .utils.workspace import ScratchDirs, DiskQuota, DiskFull
+from .utils.uploader import UploadEngine
+from .utils.governor import ResourceGovernor, QuotaExceeded, usage_day
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, DUMP_CHANNEL, DOWNLOADS_DIR, AUTH_USERS,
+    JOB_DOWNLOAD_SLOTS, JOB_ENCODE_SLOTS, JOB_UPLOAD_SLOTS, JOB_MAX_ATTEMPTS, INFO_CACHE_PERSIST,
+    STREAM_ENCODE, STREAM_DUMP_COMPRESSED, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL, PARALLEL_DOWNLOAD_CONNECTIONS,
+    PARALLEL_DOWNLOAD_MIN_SIZE, PARALLEL_UPLOAD_CONNECTIONS, PARTIAL_TTL, PARTIAL_GC_INTERVAL,
+    DISK_MIN_FREE, DISK_RESERVE_FACTOR, DISK_DEFAULT_ESTIMATE, BATCH_MAX_ITEMS,
+    CALLBACK_SESSION_SIZE, CALLBACK_SESSION_TTL, CALLBACK_SESSION_PERSIST, ROLE, WORKER_ID, WORKER_MAX_JOBS, WORKER_HEARTBEAT, WORKER_TIMEOUT, BROKER_POLL_INTERVAL,
+    SETTINGS_REFRESH_INTERVAL, USER_FFMPEG_THREADS, USER_NICE, USER_MAX_JOBS, USER_DAILY_BYTES
+)
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-ENCODE_DIR = os.path.join(DOWNLOADS_DIR, "encode")
-os.makedirs(ENCODE_DIR, exist_ok=True)  # Ensure the encode directory exists
 
 class Bot:
     def __init__(self):
-        logging.info("Initializing bot...")
+        logging.info(f"Initializing bot ({ROLE})...")
+        worker = ROLE == 'worker'
+        self.worker_id = WORKER_ID or default_worker_id()
+        # Workers log in with their own session and receive no updates; only the dispatcher answers users
+        session_name = "video_bot_" + re.sub(r'[^\w-]', '_', self.worker_id) if worker else "video_bot"
         self.app = Client(
-            "video_bot",
+            session_name,
             api_id=API_ID,
             api_hash=API_HASH,
-            bot_token=BOT_TOKEN
+            bot_token=BOT_TOKEN,
+            no_updates=worker
         )
         self.db = Database()
-        self.tasks = []  # Track ongoing tasks
-        self.video_urls = {}  # Define video URLs dictionary here
+        if INFO_CACHE_PERSIST:
+            info_cache.db = self.db
+        if ROLE != 'all':
+            # Workers share the encode cache directory, so its size is tracked where they all see it
+            encode_cache.db = self.db
+        self.governor = ResourceGovernor(
+            self.db, AUTH_USERS, USER_FFMPEG_THREADS, USER_NICE, USER_MAX_JOBS, USER_DAILY_BYTES
+        )
+        # Workers only claim jobs within the user's cap across all workers, so they need no cap of their own
+        self.scheduler = JobScheduler(self.db, {
+            'download': JOB_DOWNLOAD_SLOTS,
+            'encode': JOB_ENCODE_SLOTS,
+            'upload': JOB_UPLOAD_SLOTS,
+        }, dispatch_only=ROLE == 'dispatcher', retry_attempts=JOB_MAX_ATTEMPTS if worker else None,
+            priority_users=AUTH_USERS, user_cap=None if worker else self.governor.job_cap)
+        self.scheduler.register('youtube', self.run_youtube_job)
+        self.scheduler.register('compress', self.run_compress_job)
+        self.results = ResultCache(self.db, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL)
+        # Workers on one machine keep separate job and partial directories so they never share files
+        own_dir = (self.worker_id,) if worker else ()
+        self.scratch = ScratchDirs(os.path.join(DOWNLOADS_DIR, "jobs", *own_dir))
+        self.quota = DiskQuota(self.db, DOWNLOADS_DIR, DISK_MIN_FREE, self.worker_id)
+        self.downloads = ResumableDownloads(self.db, os.path.join(DOWNLOADS_DIR, "partials", *own_dir))
+        self.broker = JobBroker(
+            self.db, self.scheduler, self.worker_id, WORKER_MAX_JOBS, JOB_MAX_ATTEMPTS,
+            WORKER_HEARTBEAT, BROKER_POLL_INTERVAL, USER_MAX_JOBS
+        ) if worker else None
+        self.sessions = SessionPool(self.app)
+        self.uploader = UploadEngine(self.app, self.sessions, PARALLEL_UPLOAD_CONNECTIONS)
+        self.status_messages = {}  # job_id -> status message of running jobs
+        self.callbacks = CallbackSessions(
+            CALLBACK_SESSION_SIZE, CALLBACK_SESSION_TTL, self.db if CALLBACK_SESSION_PERSIST else None
+        )
+        ACTIVE_JOBS.set_function(lambda: len(self.scheduler.tasks))
+        STAGE_JOBS.set_function(self._stage_gauge)
+        DISK_BYTES.set_function(lambda: {
+            (('kind', key),): value for key, value in self.quota.stats().items() if key != 'jobs'
+        })
         self.setup_handlers()
 
     def setup_handlers(self):
@@ -54,33 +125,53 @@ class Bot:
             return wrapper
 
         @self.app.on_message(filters.command("start"))
+        @timed(HANDLER_SECONDS, handler="start_command")
         async def start_command(_, message: Message):
             logging.info("Received /start command")
             await message.reply_text(
                 "Hello! I can help you download and compress videos.\n"
                 "Commands:\n"
                 "/yl <url> - Download YouTube video\n"
+                "/yl <url> <url> ... or /yl <playlist> - Download several videos at one quality\n"
                 "/set <ffmpeg_code> - Set custom FFmpeg code\n"
+                "/set auto [size=50M] [bitrate=1500k] [height=720] - Let the bot pick encode settings per video\n"
                 "/add - Reply to video/document to compress\n"
                 "/cancel - Cancel ongoing tasks\n"
                 "/permit <user_id> - Authorize a specific user (owner only)\n"
-                "/authorize - Authorize a group (owner only)"
+                "/authorize - Authorize a group (owner only)\n"
+                "/stats - Show cache and queue statistics (owner only)\n"
+                "/usage [user_id] - Show today's usage per user, or one user's recent usage (owner only)\n"
+                "/invalidate <url> - Forget cached results for a video (owner only)\n"
+                "/purgecache [days] - Drop cached results (owner only)"
             )
 
         @self.app.on_message(filters.command("cancel"))
+        @timed(HANDLER_SECONDS, handler="cancel_tasks")
         @restricted_command
         async def cancel_tasks(_, message: Message):
             logging.info("Received /cancel command")
-            if not self.tasks:
+            user_id = message.from_user.id
+            cancel_all = user_id in AUTH_USERS and len(message.command) > 1 and message.command[1] == "all"
+            if self.scheduler.dispatch_only:
+                # Jobs run in worker processes, which pick up the request with their next heartbeat
+                job_ids = [row[0] for row in await self.db.get_active_jobs(None if cancel_all else user_id)]
+                if not job_ids:
+                    await message.reply_text("No ongoing tasks to cancel.")
+                    return
+                await self.db.request_cancel(job_ids)
+                await message.reply_text("All ongoing tasks have been canceled.")
+                return
+            jobs = list(self.scheduler.jobs.values()) if cancel_all else self.scheduler.user_jobs(user_id)
+            if not jobs:
                 await message.reply_text("No ongoing tasks to cancel.")
                 return
-            
-            for task in self.tasks:
-                task.cancel()  # Cancel the task
-            self.tasks.clear()  # Clear the task list
+
+            for job in jobs:
+                self.scheduler.cancel(job.job_id)
             await message.reply_text("All ongoing tasks have been canceled.")
 
         @self.app.on_message(filters.command("permit") & filters.user(AUTH_USERS))
+        @timed(HANDLER_SECONDS, handler="permit_user")
         async def permit_user(_, message: Message):
             logging.info("Received /permit command")
             if len(message.command) < 2:
@@ -94,7 +185,124 @@ class Bot:
             except ValueError:
                 await message.reply_text("Invalid user ID.")
 
+        @self.app.on_message(filters.command("stats") & filters.user(AUTH_USERS))
+        @timed(HANDLER_SECONDS, handler="stats_command")
+        async def stats_command(_, message: Message):
+            logging.info("Received /stats command")
+            stats = info_cache.stats()
+            queues = "\n".join(
+                f"{stage}: {active} running, {waiting} waiting"
+                for stage, (active, waiting) in self.scheduler.queue_summary().items()
+            )
+            encodes = "\n".join(
+                f"{label}: {item['encodes']} encodes, "
+                + (f"{item['speed']:.2f}x realtime" if item['speed'] else "speed n/a")
+                + (f", {item['fps']:.0f} fps" if item['fps'] else "")
+                for label, item in sorted(encode_metrics.summary().items())
+            ) or "No encodes yet"
+            if self.scheduler.dispatch_only:
+                active = await self.db.get_active_jobs()
+                now = time.time()
+                queues = "\n".join(
+                    [f"queued: {sum(1 for row in active if row[3] == 'queued')}"]
+                    + [f"{worker_id} ({host}): {jobs} jobs, seen {now - seen:.0f}s ago"
+                       for worker_id, host, _, jobs, seen in await self.db.get_workers()]
+                )
+            edits = status_editor.stats()
+            uploads = self.uploader.stats()
+            artifacts = await encode_cache.stats()
+            await message.reply_text(
+                f"Result cache: {self.results.hits} hits, {self.results.misses} misses\n"
+                f"Encode cache: {artifacts['hits']} hits, {artifacts['misses']} misses, "
+                f"{artifacts['entries']} entries, {format_size(artifacts['bytes'])}\n\n"
+                "Video info cache:\n"
+                f"Hits: {stats['hits']} (from database: {stats['db_hits']})\n"
+                f"Misses: {stats['misses']}\n"
+                f"Entries: {stats['size']}\n\n"
+                f"Jobs:\n{queues}\n\n"
+                f"Encode throughput:\n{encodes}\n\n"
+                f"Status edits: {edits['edits']} sent for {edits['requested']} updates, "
+                f"{edits['flood_waits']} flood waits\n"
+                f"Uploads: {uploads['uploads']} files, {format_size(uploads['bytes'])}"
+                + (f" at {uploads['speed']:.2f} MB/s" if uploads['speed'] else "")
+            )
+
+        @self.app.on_message(filters.command("usage") & filters.user(AUTH_USERS))
+        @timed(HANDLER_SECONDS, handler="usage_command")
+        async def usage_command(_, message: Message):
+            logging.info("Received /usage command")
+            governor = self.governor
+            if len(message.command) > 1:
+                try:
+                    user_id = int(message.command[1])
+                except ValueError:
+                    await message.reply_text("Usage: /usage [user_id]")
+                    return
+                history = await self.db.get_usage_history(user_id)
+                limits = governor.limits(user_id)
+                lines = [
+                    f"{day}: {jobs} jobs, {format_size(bytes_in)} in, {format_size(bytes_out)} out, "
+                    f"{format_duration(seconds)}"
+                    for day, jobs, bytes_in, bytes_out, seconds in history
+                ] or ["No usage recorded"]
+                if governor.is_owner(user_id):
+                    budget = "Owner: no limits, priority lane"
+                else:
+                    budget = (
+                        f"Limits: {limits.threads or 'any'} ffmpeg threads, nice {limits.nice}, "
+                        f"{governor.job_cap(user_id) or 'any'} jobs at once, "
+                        + (f"{format_size(governor.daily_bytes)} per day" if governor.daily_bytes else "no daily quota")
+                    )
+                running = len(self.scheduler.user_jobs(user_id))
+                await message.reply_text(
+                    f"Usage of {user_id}:\n" + "\n".join(lines) + f"\n\n{budget}\nJobs in this process: {running}"
+                )
+                return
+
+            day = usage_day()
+            rows = await self.db.get_usage_by_user(day)
+            lines = [
+                f"{user_id}: {jobs} jobs, {format_size(bytes_in + bytes_out)}, {format_duration(seconds)}"
+                + (" (owner)" if governor.is_owner(user_id) else "")
+                for user_id, jobs, bytes_in, bytes_out, seconds in rows
+            ] or ["No usage recorded"]
+            await message.reply_text(f"Usage on {day} (UTC):\n" + "\n".join(lines))
+
+        @self.app.on_message(filters.command("invalidate") & filters.user(AUTH_USERS))
+        @timed(HANDLER_SECONDS, handler="invalidate_command")
+        async def invalidate_command(_, message: Message):
+            logging.info("Received /invalidate command")
+            replied = message.reply_to_message
+            media = replied and (replied.video or replied.document)
+            if media:
+                source_key = telegram_source_key(media)
+            elif len(message.command) > 1:
+                target = message.command[1]
+                if target.startswith(("yt:", "tg:")):
+                    source_key = target
+                else:
+                    info = await get_video_info(target)
+                    source_key = youtube_source_key(info)
+            else:
+                await message.reply_text("Reply to a video or give a URL to invalidate its cached results.")
+                return
+            removed = await self.results.invalidate(source_key)
+            await message.reply_text(f"Removed {removed} cached results for {source_key}.")
+
+        @self.app.on_message(filters.command("purgecache") & filters.user(AUTH_USERS))
+        @timed(HANDLER_SECONDS, handler="purge_cache_command")
+        async def purge_cache_command(_, message: Message):
+            logging.info("Received /purgecache command")
+            try:
+                days = float(message.command[1]) if len(message.command) > 1 else None
+            except ValueError:
+                await message.reply_text("Usage: /purgecache [older_than_days]")
+                return
+            removed = await self.results.purge(days * 86400 if days is not None else None)
+            await message.reply_text(f"Removed {removed} cached results.")
+
         @self.app.on_message(filters.command("authorize") & filters.group & filters.user(AUTH_USERS))
+        @timed(HANDLER_SECONDS, handler="authorize_group")
         async def authorize_group(_, message: Message):
             logging.info("Received /authorize command")
             group_id = message.chat.id
@@ -102,6 +310,7 @@ class Bot:
             await message.reply_text("This group is now authorized to use the bot.")
         
         @self.app.on_message(filters.group)
+        @timed(HANDLER_SECONDS, handler="group_message_handler")
         async def group_message_handler(_, message: Message):
             group_id = message.chat.id
             if not await self.db.is_group_authorized(group_id):
@@ -111,6 +320,7 @@ class Bot:
         
 
         @self.app.on_message(filters.command("yl"))
+        @timed(HANDLER_SECONDS, handler="youtube_command")
         @restricted_command
         async def youtube_command(_, message: Message):
             logging.info("Received /yl command")
@@ -118,99 +328,129 @@ class Bot:
                 await message.reply_text("Please provide a YouTube URL")
                 return
 
+            urls = message.text.split()[1:]
+            if len(urls) > 1 or is_playlist_url(urls[0]):
+                await start_batch(message, urls)
+                return
+
             status_msg = await message.reply_text("Fetching video information...")
             try:
-                url = message.text.split(None, 1)[1]
-                formats, title = await get_video_formats(url)
-                keyboard = create_format_buttons(formats)
+                url = urls[0]
+                ffmpeg_code = await self.db.get_ffmpeg_code(message.from_user.id)
+                formats, title = await get_video_formats(url, ffmpeg_code)
+                if not formats:
+                    # Sources without heights (e.g. direct links) still get one button
+                    info = await get_video_info(url)
+                    format_id = select_format(info)
+                    if format_id is None:
+                        await status_msg.edit_text(f"No downloadable video found for: {title}")
+                        return
+                    formats = [{
+                        'format_id': format_id, 'resolution': 'Best', 'ext': 'auto', 'fps': 'N/A',
+                        'size': estimate_size(info, format_id),
+                    }]
+                token = await self.callbacks.create('formats', message.from_user.id, url=url, title=title, formats=formats)
 
                 await status_msg.edit_text(
                     f"Select format for: {title}",
-                    reply_markup=keyboard
+                    reply_markup=create_format_buttons(formats, token)
                 )
-                user_id = message.from_user.id
-                self.video_urls[user_id] = url  # Store video URL in the dictionary
             except Exception as e:
                 await status_msg.edit_text(f"Error: {str(e)}")
                 logging.error(f"Error in youtube_command: {e}")
 
-        @self.app.on_callback_query(filters.regex(r"^dl_"))
-        async def download_callback(_, callback_query: CallbackQuery):
-            format_id = callback_query.data.split("_")[1]
-            user_id = callback_query.from_user.id
-            url = self.video_urls.get(user_id)  # Use the instance variable here
+        async def start_batch(message: Message, urls):
+            status_msg = await message.reply_text("Fetching videos...")
+            try:
+                # Playlists are listed with one flat extraction each; full extraction happens per job
+                listed = await asyncio.gather(*(
+                    extract_entries(url) if is_playlist_url(url) else asyncio.sleep(0, [{'url': url, 'title': url}])
+                    for url in urls
+                ))
+            except Exception as e:
+                await status_msg.edit_text(f"Error: {str(e)}")
+                logging.error(f"Error listing batch: {e}")
+                return
+            entries = list({entry['url']: entry for group in listed for entry in group}.values())
+            if not entries:
+                await status_msg.edit_text("No videos found.")
+                return
+            note = ""
+            if len(entries) > BATCH_MAX_ITEMS:
+                note = f" (only the first {BATCH_MAX_ITEMS} will be processed)"
+                entries = entries[:BATCH_MAX_ITEMS]
+            token = await self.callbacks.create('batch', message.from_user.id, entries=entries)
+            await status_msg.edit_text(
+                f"Found {len(entries)} videos{note}. Choose one quality for all of them:",
+                reply_markup=create_quality_buttons(token)
+            )
 
-            if not url:
+        @self.app.on_callback_query(filters.regex(r"^batch_"))
+        @timed(HANDLER_SECONDS, handler="batch_callback")
+        async def batch_callback(_, callback_query: CallbackQuery):
+            _, token, max_height = callback_query.data.split("_")
+            batch = await self.callbacks.get(token, 'batch', callback_query.from_user.id)
+            if batch is None:
                 await callback_query.answer("Session expired. Please try again.", show_alert=True)
                 return
-
+            refusal = await self.governor.check_quota(callback_query.from_user.id)
+            if refusal:
+                await callback_query.answer(refusal, show_alert=True)
+                return
+            await self.callbacks.close(token)
             await callback_query.answer("Processing...")
-            status_msg = await callback_query.message.reply_text("Downloading...")
 
-            input_path = None
-            output_path = None
+            # Every item is its own job, so the scheduler overlaps one item's download with another's encode
+            max_height = int(max_height)
+            for entry in batch['entries']:
+                status_msg = await callback_query.message.reply_text(f"Queued: {entry['title']}")
+                job = await self.scheduler.submit('youtube', batch['user_id'], callback_query.message.chat.id, {
+                    'url': entry['url'],
+                    'max_height': max_height,
+                    'status_msg_id': status_msg.id,
+                    'reply_to_message_id': callback_query.message.id,
+                })
+                self._track_status(job, status_msg)
+            quality = "best quality" if max_height == 0 else f"up to {max_height}p"
+            await callback_query.message.edit_text(f"Queued {len(batch['entries'])} videos at {quality}.")
 
-            try:
-                formats, title = await get_video_formats(url)
-                sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
-                input_path = os.path.join(DOWNLOADS_DIR, f"{sanitized_title}.mp4")
-                output_path = os.path.join(ENCODE_DIR, f"{sanitized_title}_compressed.mp4")
-
-                download_task = asyncio.create_task(
-                    download_video(url, format_id, input_path, status_msg)
-                )
-                self.tasks.append(download_task)
-                success = await download_task
+        @self.app.on_callback_query(filters.regex(r"^dl_"))
+        @timed(HANDLER_SECONDS, handler="download_callback")
+        async def download_callback(_, callback_query: CallbackQuery):
+            # Format ids may contain underscores; tokens never do
+            _, token, format_id = callback_query.data.split("_", 2)
+            user_id = callback_query.from_user.id
+            session = await self.callbacks.get(token, 'formats', user_id)
+            if session is None:
+                await callback_query.answer("Session expired. Please try again.", show_alert=True)
+                return
+            url = session['url']
+            await self.callbacks.close(token)
 
-                if success and os.path.exists(input_path):
-                    await self.app.send_video(
-                        DUMP_CHANNEL,
-                        input_path,
-                        progress=progress,
-                        progress_args=(status_msg, "Uploading to dump channel...")
-                    )
+            await callback_query.answer("Processing...")
+            info = await get_video_info(url)
+            ffmpeg_code = await self.db.get_ffmpeg_code(user_id)
+            if await self._send_cached_result(
+                callback_query.message.chat.id, youtube_source_key(info), format_id, ffmpeg_code,
+                reply_to_message_id=callback_query.message.id
+            ):
+                return
+            refusal = await self.governor.check_quota(user_id)
+            if refusal:
+                await callback_query.message.reply_text(refusal)
+                return
 
-                    ffmpeg_code = await self.db.get_ffmpeg_code(user_id)
-                    await status_msg.edit_text("Compressing...")
-                    
-                    compress_task = asyncio.create_task(
-                        compress_video(input_path, output_path, ffmpeg_code)
-                    )
-                    self.tasks.append(compress_task)
-                    success = await compress_task
-
-                    if success and os.path.exists(output_path):
-                        duration = await get_video_duration(output_path)
-                        thumb_image_path = await take_screenshot(output_path)
-
-                        await self.app.send_video(
-                            callback_query.message.chat.id,
-                            output_path,
-                            caption=f"{sanitized_title}\nDuration: {duration} seconds",
-                            duration=duration,
-                            thumb=thumb_image_path,
-                            width=1280,
-                            height=720,
-                            reply_to_message_id=callback_query.message.id,
-                            progress=progress,
-                            progress_args=(status_msg, "Uploading compressed video...")
-                        )
-                        await status_msg.delete()
-                        if os.path.exists(thumb_image_path):
-                            os.remove(thumb_image_path)
-                    else:
-                        await status_msg.edit_text("Compression failed!")
-                else:
-                    await status_msg.edit_text("Download failed!")
-            except Exception as e:
-                await status_msg.edit_text(f"Error: {str(e)}")
-                logging.error(f"Error in download_callback: {e}")
-            finally:
-                clean_files(input_path, output_path)
-                if user_id in self.video_urls:
-                    del self.video_urls[user_id]
+            status_msg = await callback_query.message.reply_text("Queued...")
+            job = await self.scheduler.submit('youtube', user_id, callback_query.message.chat.id, {
+                'url': url,
+                'format_id': format_id,
+                'status_msg_id': status_msg.id,
+                'reply_to_message_id': callback_query.message.id,
+            })
+            self._track_status(job, status_msg)
 
         @self.app.on_message(filters.command("get"))
+        @timed(HANDLER_SECONDS, handler="get_ffmpeg")
         @restricted_command
         async def get_ffmpeg(_, message: Message):
             logging.info("Received /get command")
@@ -232,6 +472,7 @@ class Bot:
                 logging.error(f"Error in get_ffmpeg command: {e}")
 
         @self.app.on_message(filters.command("set"))
+        @timed(HANDLER_SECONDS, handler="set_ffmpeg")
         @restricted_command
         async def set_ffmpeg(_, message: Message):
             logging.info("Received /set command")
@@ -241,143 +482,493 @@ class Bot:
 
             user_id = message.from_user.id
             ffmpeg_code = message.text.split(None, 1)[1]
+            if is_adaptive(ffmpeg_code):
+                try:
+                    parse_target(ffmpeg_code)
+                except ValueError as e:
+                    await message.reply_text(f"Invalid adaptive preset: {e}")
+                    return
 
             await self.db.set_ffmpeg_code(user_id, ffmpeg_code)
             await message.reply_text("Your FFmpeg code has been set!")
+        async def enqueue_compress(message: Message, replied: Message):
+            media = replied.video or replied.document
+            ffmpeg_code = await self.db.get_ffmpeg_code(message.from_user.id)
+            if await self._send_cached_result(message.chat.id, telegram_source_key(media), None, ffmpeg_code):
+                return
+            refusal = await self.governor.check_quota(message.from_user.id)
+            if refusal:
+                await message.reply_text(refusal)
+                return
+
+            status_msg = await message.reply_text("Queued...")
+            job = await self.scheduler.submit('compress', message.from_user.id, message.chat.id, {
+                'source_chat_id': replied.chat.id,
+                'source_msg_id': replied.id,
+                'status_msg_id': status_msg.id,
+            })
+            self._track_status(job, status_msg)
+
         @self.app.on_message(filters.command("add") & filters.reply)
+        @timed(HANDLER_SECONDS, handler="compress_command")
         async def compress_command(_, message: Message):
             replied = message.reply_to_message
             if not (replied.video or replied.document):
                 await message.reply_text("Please reply to a video/document")
                 return
 
-            status_msg = await message.reply_text("Processing...")
-            input_path = None
-            output_path = None
+            await enqueue_compress(message, replied)
 
-            try:
-                title = replied.video.file_name if replied.video else replied.document.file_name
-                sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
-                input_path = os.path.join(DOWNLOADS_DIR, f"{sanitized_title}_input.mp4")
-                
-                # Create a task for downloading
-                download_task = asyncio.create_task(
-                    replied.download(input_path, progress=progress, progress_args=(status_msg, "Downloading..."))
+            @self.app.on_message(filters.forwarded & (filters.video | filters.document))
+            @timed(HANDLER_SECONDS, handler="compress_command")
+            async def compress_command(_, message: Message):
+                replied = message.reply_to_message
+                if not (replied.video or replied.document):
+                    await message.reply_text("Please forward a video or document.")
+                    return
+
+                await enqueue_compress(message, replied)
+
+    def _stage_gauge(self):
+        values = {}
+        for stage, (active, waiting) in self.scheduler.queue_summary().items():
+            values[(('stage', stage), ('state', 'active'))] = active
+            values[(('stage', stage), ('state', 'waiting'))] = waiting
+        return values
+
+    def _track_status(self, job, status_msg):
+        """Keep the status message of a job that runs in this process; workers fetch their own."""
+        if not self.scheduler.dispatch_only:
+            self.status_messages[job.job_id] = status_msg
+
+    async def _status_message(self, job):
+        """Return the job's status message, fetching or re-creating it after a restart."""
+        status_msg = self.status_messages.get(job.job_id)
+        if status_msg is None:
+            status_msg = await self.app.get_messages(job.chat_id, job.payload['status_msg_id'])
+            if status_msg is None or status_msg.empty:
+                status_msg = await self.app.send_message(job.chat_id, "Resuming...")
+            self.status_messages[job.job_id] = status_msg
+        return status_msg
+
+    async def _charge(self, job, started, bytes_in, output_path):
+        """Count a finished job's download, upload and run time against its user's daily usage."""
+        bytes_out = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        await self.governor.charge(job.user_id, bytes_in or 0, bytes_out, time.monotonic() - started)
+
+    async def _send_cached_result(self, chat_id, source_key, format_id, ffmpeg_code, reply_to_message_id=None):
+        """Send a previously uploaded result instead of running the pipeline again.
+
+        Returns True if a cached upload was sent.
+        """
+        result = await self.results.lookup(source_key, format_id, ffmpeg_code)
+        if result is None:
+            return False
+        try:
+            await self.app.send_video(
+                chat_id,
+                result['file_id'],
+                caption=result['caption'],
+                duration=result['duration'] or 0,
+                width=result['width'] or 0,
+                height=result['height'] or 0,
+                reply_to_message_id=reply_to_message_id
+            )
+        except Exception as e:
+            logging.error(f"Cached result for {source_key} could not be sent, discarding it: {e}")
+            await self.results.discard(result)
+            return False
+        logging.info(f"Answered {source_key} from the result cache")
+        return True
+
+    def _queue_notifier(self, status_msg, stage):
+        """Returns a callback that shows the job's position while it waits for a stage slot."""
+        async def notify(position):
+            if position:
+                status_editor.update(status_msg, f"Queued for {stage} (position {position})")
+        return notify
+
+    def _disk_notifier(self, status_msg):
+        """Returns a callback that tells the user the job waits for disk space."""
+        async def notify(needed, available):
+            status_editor.update(
+                status_msg,
+                f"Waiting for disk space ({format_size(needed)} needed, {format_size(max(available, 0))} available)"
+            )
+        return notify
+
+    def _encode_progress(self, status_msg):
+        """Returns a callback that shows ffmpeg's progress on the status message."""
+        async def report(event):
+            lines = ["Compressing..." if event.percent is None else f"Compressing... {event.percent:.1f}%"]
+            details = [f"{event.speed:.2f}x", f"{event.fps:.0f} fps"]
+            if event.bitrate:
+                details.append(f"{event.bitrate:.0f} kbit/s")
+            lines.append("Speed: " + " | ".join(details))
+            if event.eta is not None:
+                lines.append(f"ETA: {format_duration(event.eta)}")
+            status_editor.update(status_msg, "\n".join(lines))
+        return report
+
+    async def run_youtube_job(self, job):
+        """Download, archive, compress and upload a video requested with /yl."""
+        started = time.monotonic()
+        status_msg = await self._status_message(job)
+        url = job.payload['url']
+        format_id = job.payload.get('format_id')
+
+        uploaded = None
+
+        try:
+            info = await get_video_info(url)  # Served from the cache filled by /yl
+            title = info.get('title') or 'video'
+            ffmpeg_code = await self.db.get_ffmpeg_code(job.user_id)
+            limits = self.governor.limits(job.user_id)
+            if format_id is None:
+                # Batch items carry a height limit instead of a format
+                max_height = job.payload.get('max_height')
+                format_id = select_format(info, max_height, ffmpeg_code)
+                if format_id is None:
+                    await status_editor.finish(status_msg, f"No format up to {max_height}p for {title}")
+                    return False
+                if await self._send_cached_result(
+                    job.chat_id, youtube_source_key(info), format_id, ffmpeg_code,
+                    reply_to_message_id=job.payload['reply_to_message_id']
+                ):
+                    await status_editor.delete(status_msg)
+                    return True
+            sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
+            # Downloads live in a directory per source and format so a rerun continues them
+            part_key = self.downloads.key(youtube_source_key(info), format_id)
+            input_path = self.downloads.path(part_key, sanitized_title)
+            work_dir = self.scratch.create(job.job_id)
+            spool_path = os.path.join(work_dir, f"{sanitized_title}.mp4")
+            output_path = os.path.join(work_dir, f"{sanitized_title}_compressed.mp4")
+            estimate = estimate_size(info, format_id) or DISK_DEFAULT_ESTIMATE
+            # A copy-only code would reproduce the download, so yt-dlp's merge produces the final file
+            passthrough = is_passthrough(ffmpeg_code)
+
+            async def download():
+                async with self.scheduler.stage(job, 'download', self._queue_notifier(status_msg, "download")):
+                    status_editor.update(status_msg, "Downloading...")
+                    async with self.downloads.lock(part_key):
+                        await self.downloads.begin(part_key, url, format_id, input_path)
+                        try:
+                            success = await download_video(
+                                url, format_id, input_path, status_msg,
+                                self.downloads.reporter(part_key, asyncio.get_running_loop()), faststart=passthrough
+                            )
+                        finally:
+                            self.downloads.end(part_key)
+                if not (success and os.path.exists(input_path)):
+                    raise StageFailed("Download failed!")
+
+            async def stream_encode():
+                fmt = get_format(info, format_id)
+                total_bytes = fmt.get('filesize') or fmt.get('filesize_approx')
+                # Download and encode overlap, so the job holds both slots at once
+                async with self.scheduler.stage(job, 'download', self._queue_notifier(status_msg, "download")), \
+                        self.scheduler.stage(job, 'encode', self._queue_notifier(status_msg, "compression")):
+                    status_editor.update(status_msg, "Downloading and compressing...")
+                    success = await compress_stream(
+                        stream_video(url, format_id, status_msg, total_bytes), output_path, ffmpeg_code, spool_path,
+                        limits=limits, source_key=part_key
+                    )
+                if not (success and os.path.exists(output_path)):
+                    raise StageFailed("Compression failed!")
+
+            async def encode():
+                async with self.scheduler.stage(job, 'encode', self._queue_notifier(status_msg, "compression")):
+                    status_editor.update(status_msg, "Compressing...")
+                    success = await compress_video(
+                        input_path, output_path, ffmpeg_code, on_progress=self._encode_progress(status_msg),
+                        limits=limits, source_key=part_key
+                    )
+                if not (success and os.path.exists(output_path)):
+                    raise StageFailed("Compression failed!")
+
+            async def dump():
+                # Runs next to the encode, whose progress owns the status message
+                async with self.scheduler.stage(job, 'upload'):
+                    await self.uploader.send_video(DUMP_CHANNEL, input_path)
+
+            async def dump_uploaded():
+                # Re-send the file the user got instead of uploading it a second time
+                video = uploaded and (uploaded.video or uploaded.document)
+                if video:
+                    await self.app.send_video(DUMP_CHANNEL, video.file_id, caption=uploaded.caption)
+
+            async def upload():
+                nonlocal uploaded
+                media_info = await probe_media(output_path) or {}
+                duration = round(media_info.get('duration') or 0)
+                thumb_image_path = await take_screenshot(output_path, duration=duration)
+
+                caption = f"{sanitized_title}\nDuration: {duration} seconds"
+                width = media_info.get('width') or 1280
+                height = media_info.get('height') or 720
+                async with self.scheduler.stage(job, 'upload', self._queue_notifier(status_msg, "upload")):
+                    uploaded = await self.uploader.send_video(
+                        job.chat_id,
+                        output_path,
+                        caption=caption,
+                        duration=duration,
+                        thumb=thumb_image_path,
+                        width=width,
+                        height=height,
+                        reply_to_message_id=job.payload['reply_to_message_id'],
+                        progress=progress,
+                        progress_args=(status_msg, "Uploading compressed video...", time.monotonic())
+                    )
+                await self.results.store(
+                    youtube_source_key(info), format_id, ffmpeg_code, uploaded, caption, duration, width, height
                 )
-                self.tasks.append(download_task)
-                await download_task
 
+            pipeline = Pipeline()
+            if passthrough:
+                # The output is the download itself, so it is uploaded once and re-sent to the dump channel
+                pipeline.add('download', download)
+                pipeline.add('encode', encode, after=['download'])
+                pipeline.add('upload', upload, after=['encode'])
+                pipeline.add('dump', dump_uploaded, after=['upload'])
+            elif STREAM_ENCODE and STREAM_DUMP_COMPRESSED and can_stream(info, format_id) and not is_adaptive(ffmpeg_code):
+                # The original never touches the disk, so the dump channel gets the compressed file
+                pipeline.add('encode', stream_encode)
+                pipeline.add('upload', upload, after=['encode'])
+                pipeline.add('dump', dump_uploaded, after=['upload'])
+            else:
+                # The original is archived while it is being compressed
+                pipeline.add('download', download)
+                pipeline.add('dump', dump, after=['download'])
+                pipeline.add('encode', encode, after=['download'])
+                pipeline.add('upload', upload, after=['encode'])
+            # The quota is checked again here, so a batch queued at once cannot run far past it
+            async with self.governor.reserve(job.user_id, estimate):
+                async with self.quota.reserve(
+                    job.job_id, estimate * DISK_RESERVE_FACTOR, self._disk_notifier(status_msg)
+                ):
+                    await pipeline.run()
+                # Streamed downloads leave no file behind, so they are charged at the format's estimate
+                await self._charge(
+                    job, started, os.path.getsize(input_path) if os.path.exists(input_path) else estimate, output_path
+                )
+            await self.downloads.finish(part_key)
+
+            await status_editor.delete(status_msg)
+            return True
+        except (StageFailed, DiskFull, QuotaExceeded) as e:
+            await status_editor.finish(status_msg, str(e))
+            return False
+        except Exception as e:
+            await status_editor.finish(status_msg, f"Error: {str(e)}")
+            logging.error(f"Error in youtube job {job.job_id}: {e}")
+            raise
+        finally:
+            # A failed or cancelled download stays in place for the next attempt
+            self.scratch.remove(job.job_id)
+            self.status_messages.pop(job.job_id, None)
+
+    async def run_compress_job(self, job):
+        """Download, archive, compress and upload a Telegram video sent with /add."""
+        started = time.monotonic()
+        status_msg = await self._status_message(job)
+
+        try:
+            replied = await self.app.get_messages(job.payload['source_chat_id'], job.payload['source_msg_id'])
+            if replied is None or replied.empty or not (replied.video or replied.document):
+                await status_editor.finish(status_msg, "The original video is no longer available.")
+                return False
+
+            media = replied.video or replied.document
+            title = media.file_name
+            sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
+            ffmpeg_code = await self.db.get_ffmpeg_code(job.user_id)
+            limits = self.governor.limits(job.user_id)
+            is_mp4 = replied.video is not None or getattr(media, 'mime_type', None) == 'video/mp4'
+            if is_passthrough(ffmpeg_code) and is_mp4:
+                # Copying every stream into MP4 would reproduce the file Telegram already has;
+                # other containers still get remuxed below
+                sent = await self.app.send_cached_media(job.chat_id, media.file_id, caption=sanitized_title)
+                await replied.forward(DUMP_CHANNEL)
+                await self.results.store(
+                    telegram_source_key(media), None, ffmpeg_code, sent, sanitized_title,
+                    getattr(media, 'duration', 0), getattr(media, 'width', 0), getattr(media, 'height', 0)
+                )
+                await self.governor.charge(job.user_id, 0, media.file_size or 0, time.monotonic() - started)
+                await status_editor.delete(status_msg)
+                return True
+            work_dir = self.scratch.create(job.job_id)
+            # Large files download faster over several connections than through a single stream
+            parallel = PARALLEL_DOWNLOAD_CONNECTIONS > 1 and (media.file_size or 0) >= PARALLEL_DOWNLOAD_MIN_SIZE
+            part_key = self.downloads.key(telegram_source_key(media), None)
+            if parallel:
+                # The parts and their bitmap outlive a failed attempt, so a retry only fetches what is missing
+                input_path = self.downloads.path(part_key, f"{sanitized_title}_input")
+            else:
+                input_path = os.path.join(work_dir, f"{sanitized_title}_input.mp4")
+            output_path = os.path.join(work_dir, f"{sanitized_title}_compressed.mp4")
+            estimate = media.file_size or DISK_DEFAULT_ESTIMATE
+
+            async def download():
+                async with self.scheduler.stage(job, 'download', self._queue_notifier(status_msg, "download")):
+                    if parallel:
+                        async with self.downloads.lock(part_key):
+                            await self.downloads.begin(part_key, telegram_source_key(media), None, input_path)
+                            try:
+                                await download_media(
+                                    self.sessions, media, input_path, PARALLEL_DOWNLOAD_CONNECTIONS,
+                                    progress=progress, progress_args=(status_msg, "Downloading...")
+                                )
+                                return
+                            except (RPCError, IOError, RuntimeError) as e:
+                                logging.warning(f"Parallel download failed, falling back to a single connection: {e}")
+                            finally:
+                                self.downloads.end(part_key)
+                    await replied.download(input_path, progress=progress, progress_args=(status_msg, "Downloading..."))
+
+            async def stream_encode():
+                # Download and encode overlap, so the job holds both slots at once
+                async with self.scheduler.stage(job, 'download', self._queue_notifier(status_msg, "download")), \
+                        self.scheduler.stage(job, 'encode', self._queue_notifier(status_msg, "compression")):
+                    status_editor.update(status_msg, "Downloading and compressing...")
+                    chunks = track_progress(
+                        self.app.stream_media(replied), media.file_size, status_msg, "Downloading and compressing..."
+                    )
+                    success = await compress_stream(
+                        chunks, output_path, ffmpeg_code, input_path, limits=limits, source_key=telegram_source_key(media)
+                    )
+                if not (success and os.path.exists(output_path)):
+                    raise StageFailed("Compression failed! Please try again later.")
+
+            async def encode():
+                # Compress into the job's directory
+                async with self.scheduler.stage(job, 'encode', self._queue_notifier(status_msg, "compression")):
+                    status_editor.update(status_msg, "Compressing...")
+                    success = await compress_video(
+                        input_path, output_path, ffmpeg_code, on_progress=self._encode_progress(status_msg),
+                        limits=limits, source_key=telegram_source_key(media)
+                    )
+                if not (success and os.path.exists(output_path)):
+                    raise StageFailed("Compression failed! Please try again later.")
+
+            async def dump():
                 # Forward the file to the dump channel
                 await replied.forward(DUMP_CHANNEL)
 
-                # Compress and save in ENCODE_DIR
-                output_path = os.path.join(ENCODE_DIR, f"{sanitized_title}_compressed.mp4")
-                ffmpeg_code = await self.db.get_ffmpeg_code(message.from_user.id)  # Ensure this is awaited
-                
-                await status_msg.edit_text("Compressing...")
-                
-                # Create a task for compression
-                compress_task = asyncio.create_task(
-                    compress_video(input_path, output_path, ffmpeg_code)
-                )
-                self.tasks.append(compress_task)
-                success = await compress_task
-
-                if success and os.path.exists(output_path):
-                    duration = await get_video_duration(output_path)
-                    thumb_image_path = await take_screenshot(output_path)
-                    
-                    await self.app.send_video(
-                        message.chat.id,
+            async def upload():
+                media_info = await probe_media(output_path) or {}
+                duration = round(media_info.get('duration') or 0)
+                thumb_image_path = await take_screenshot(output_path, duration=duration)
+
+                width = media_info.get('width') or 1280
+                height = media_info.get('height') or 720
+                async with self.scheduler.stage(job, 'upload', self._queue_notifier(status_msg, "upload")):
+                    sent = await self.uploader.send_video(
+                        job.chat_id,
                         output_path,
                         caption=sanitized_title,
                         duration=duration,
                         thumb=thumb_image_path,
-                        width=1280,
-                        height=720,
+                        width=width,
+                        height=height,
                         progress=progress,
-                        progress_args=(status_msg, "Uploading compressed video...")
+                        progress_args=(status_msg, "Uploading compressed video...", time.monotonic())
                     )
-                    await status_msg.delete()
-                    if os.path.exists(thumb_image_path):
-                        os.remove(thumb_image_path)
-                else:
-                    await status_msg.edit_text("Compression failed! Please try again later.")
-            except Exception as e:
-                await status_msg.edit_text(f"Error: {str(e)}")
-            finally:
-                clean_files(input_path, output_path)
-
-            @self.app.on_message(filters.forwarded & (filters.video | filters.document))
-            async def compress_command(_, message: Message):
-                replied = message.reply_to_message
-                if not (replied.video or replied.document):
-                    await message.reply_text("Please forward a video or document.")
-                    return
+                await self.results.store(
+                    telegram_source_key(media), None, ffmpeg_code, sent, sanitized_title, duration, width, height
+                )
 
-                status_msg = await message.reply_text("Processing...")
+            pipeline = Pipeline()
+            if STREAM_ENCODE and not parallel and not is_adaptive(ffmpeg_code):
+                pipeline.add('dump', dump)
+                pipeline.add('encode', stream_encode)
+            else:
+                pipeline.add('download', download)
+                pipeline.add('dump', dump, after=['download'])
+                pipeline.add('encode', encode, after=['download'])
+            pipeline.add('upload', upload, after=['encode'])
+            async with self.governor.reserve(job.user_id, estimate):
+                async with self.quota.reserve(
+                    job.job_id, estimate * DISK_RESERVE_FACTOR, self._disk_notifier(status_msg)
+                ):
+                    await pipeline.run()
+                await self._charge(job, started, media.file_size, output_path)
+            if parallel:
+                await self.downloads.finish(part_key)
+
+            await status_editor.delete(status_msg)
+            return True
+        except (StageFailed, DiskFull, QuotaExceeded) as e:
+            await status_editor.finish(status_msg, str(e))
+            return False
+        except Exception as e:
+            await status_editor.finish(status_msg, f"Error: {str(e)}")
+            logging.error(f"Error in compress job {job.job_id}: {e}")
+            raise
+        finally:
+            self.scratch.remove(job.job_id)
+            self.status_messages.pop(job.job_id, None)
+
+    async def collect_partials(self):
+        """Periodically remove interrupted downloads nobody resumed."""
+        while True:
+            try:
+                await self.downloads.gc(PARTIAL_TTL)
+            except Exception as e:
+                logging.error(f"Failed to collect partial downloads: {e}")
+            await asyncio.sleep(PARTIAL_GC_INTERVAL)
 
-                input_path = None
-                output_path = None
+    async def follow_settings(self):
+        """Pick up authorization and ffmpeg code changes that other processes wrote to the shared database."""
+        while True:
+            await asyncio.sleep(SETTINGS_REFRESH_INTERVAL)
+            try:
+                await self.db.refresh_caches()
+            except Exception as e:
+                logging.error(f"Failed to refresh cached settings: {e}")
 
-                try:
-                    title = replied.video.file_name if replied.video else replied.document.file_name
-                    sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
-                    input_path = os.path.join(DOWNLOADS_DIR, f"{sanitized_title}_input.mp4")
-                    
-                    # Create a task for downloading
-                    download_task = asyncio.create_task(
-                        replied.download(input_path, progress=progress, progress_args=(status_msg, "Downloading..."))
-                    )
-                    self.tasks.append(download_task)
-                    await download_task
-
-                    # Forward the file to the dump channel
-                    await replied.forward(DUMP_CHANNEL)
-
-                    # Compress and save in ENCODE_DIR
-                    output_path = os.path.join(ENCODE_DIR, f"{sanitized_title}_compressed.mp4")
-                    ffmpeg_code = await self.db.get_ffmpeg_code(message.from_user.id)  # Make sure this is awaited
-                    
-                    await status_msg.edit_text("Compressing...")
-                    
-                    # Create a task for compression
-                    compress_task = asyncio.create_task(
-                        compress_video(input_path, output_path, ffmpeg_code)
-                    )
-                    self.tasks.append(compress_task)
-                    success = await compress_task
-
-                    if success and os.path.exists(output_path):
-                        duration = await get_video_duration(output_path)
-                        thumb_image_path = await take_screenshot(output_path)
-
-                        await self.app.send_video(
-                            message.chat.id,
-                            output_path,
-                            caption=sanitized_title,
-                            duration=duration,
-                            thumb=thumb_image_path,
-                            width=1280,
-                            height=720,
-                            progress=progress,
-                            progress_args=(status_msg, "Uploading compressed video...")
+    async def supervise_workers(self):
+        """Reassign the jobs of workers that stopped heartbeating and report jobs that ran out of attempts."""
+        while True:
+            try:
+                for job_id, chat_id, payload, attempts in await self.db.reap_stale_jobs(
+                    WORKER_TIMEOUT, JOB_MAX_ATTEMPTS
+                ):
+                    logging.error(f"Job {job_id} failed after {attempts} attempts on lost workers")
+                    status_msg_id = json.loads(payload).get('status_msg_id')
+                    if status_msg_id:
+                        await self.app.edit_message_text(
+                            chat_id, status_msg_id, f"Failed after {attempts} attempts: the worker stopped responding."
                         )
-                        await status_msg.delete()
-                        if os.path.exists(thumb_image_path):
-                            os.remove(thumb_image_path)
-                    else:
-                        await status_msg.edit_text("Compression failed! Please try again later.")
-                except Exception as e:
-                    await status_msg.edit_text(f"Error: {str(e)}")
-                finally:
-                    clean_files(input_path, output_path)
-
+            except Exception as e:
+                logging.error(f"Failed to supervise workers: {e}")
+            await asyncio.sleep(WORKER_HEARTBEAT)
 
     async def run(self):
         await self.app.start()  # This starts the bot and its tasks
         logging.info("Bot is running...")
+        if self.scheduler.dispatch_only:
+            # Workers run the jobs and own their files; the dispatcher only watches over them
+            asyncio.create_task(self.supervise_workers())
+            asyncio.create_task(self.follow_settings())
+            await asyncio.Event().wait()
+        # Files of jobs that will not be resumed were orphaned by a crash
+        unfinished = {row[0] for row in await self.db.get_unfinished_jobs()}
+        self.scratch.sweep(unfinished, legacy_dirs=(DOWNLOADS_DIR, os.path.join(DOWNLOADS_DIR, "encode")))
+        await self.quota.sweep()
+        await self.scheduler.resume(JOB_MAX_ATTEMPTS)
+        asyncio.create_task(self.collect_partials())
         await asyncio.Event().wait()  # Keep the bot running indefinitely
+
+    async def run_worker(self):
+        """Run queued jobs for a dispatcher until cancelled; no Telegram updates are handled."""
+        await self.app.start()
+        logging.info(f"Worker {self.worker_id} is running...")
+        # A worker's jobs are requeued when it stops, so nothing in its own directory is still needed
+        self.scratch.sweep(set())
+        asyncio.create_task(self.collect_partials())
+        asyncio.create_task(self.follow_settings())
+        await self.broker.work()
 # Ensure the bot is not run directly
 if __name__ == "__main__":
     bot = Bot()
@@ -1,6 +1,8 @@
 import aiosqlite
 import logging
+import time
 from config import DB_NAME, DEFAULT_FFMPEG
+from bot.utils.metrics import DB_QUERY_SECONDS
 
 # Initialize logger
 LOGGER = logging.getLogger(__name__)
@@ -9,118 +11,858 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
 )
 
+class _TimedConnection:
+    """Wraps the aiosqlite connection to record the latency of every statement."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def execute(self, sql, parameters=None):
+        started = time.monotonic()
+        try:
+            return await self._conn.execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.monotonic() - started, statement=sql.split(None, 1)[0].upper())
+
+    async def executemany(self, sql, parameters):
+        started = time.monotonic()
+        try:
+            return await self._conn.executemany(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.monotonic() - started, statement=sql.split(None, 1)[0].upper())
+
+    async def commit(self):
+        started = time.monotonic()
+        try:
+            await self._conn.commit()
+        finally:
+            DB_QUERY_SECONDS.observe(time.monotonic() - started, statement="COMMIT")
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
 class Database:
+    """Async access to the bot's SQLite file.
+
+    Dispatcher and worker processes may share the file. Every settings change bumps a version
+    row, and `refresh_caches()` reloads the in-memory caches when another process moved it.
+    """
+
     def __init__(self):
         self.db_name = DB_NAME
+        self.conn = None
+        self.settings_version = None
+        # Write-through caches so authorization checks need no I/O
+        self.authorized_users = set()
+        self.authorized_groups = set()
+        self.ffmpeg_codes = {}
 
     async def initialize(self):
-        """Initialize the database by creating necessary tables."""
+        """Initialize the database by creating necessary tables and loading the caches."""
         await self.create_tables()
+        await self.load_caches()
+
+    async def connection(self):
+        """Return the shared connection, opening it on first use.
+
+        A single long-lived connection keeps one worker thread and lets sqlite3
+        reuse its prepared statement cache across calls.
+        """
+        if self.conn is None:
+            self.conn = _TimedConnection(await aiosqlite.connect(self.db_name, cached_statements=256))
+            await self.conn.execute("PRAGMA journal_mode=WAL")
+            await self.conn.execute("PRAGMA synchronous=NORMAL")
+            # Dispatcher and worker processes share the file, so wait for each other's writes
+            await self.conn.execute("PRAGMA busy_timeout=10000")
+            LOGGER.info("Database connection opened.")
+        return self.conn
+
+    async def close(self):
+        """Close the shared connection."""
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def load_caches(self):
+        """Load authorized users, groups and ffmpeg settings into memory."""
+        conn = await self.connection()
+        # Read first, so a change made while loading is picked up by the next refresh
+        self.settings_version = await self._settings_version(conn)
+        cursor = await conn.execute("SELECT user_id FROM authorized_users")
+        self.authorized_users = {row[0] for row in await cursor.fetchall()}
+        cursor = await conn.execute("SELECT group_id FROM authorized_groups")
+        self.authorized_groups = {row[0] for row in await cursor.fetchall()}
+        cursor = await conn.execute("SELECT user_id, ffmpeg_code FROM ffmpeg_settings")
+        self.ffmpeg_codes = dict(await cursor.fetchall())
+        LOGGER.info(
+            f"Loaded {len(self.authorized_users)} users, {len(self.authorized_groups)} groups "
+            f"and {len(self.ffmpeg_codes)} ffmpeg settings."
+        )
+
+    @staticmethod
+    async def _settings_version(conn):
+        cursor = await conn.execute("SELECT version FROM settings_version WHERE id = 0")
+        return (await cursor.fetchone())[0]
+
+    @staticmethod
+    async def _bump_settings_version(conn):
+        """Mark the cached tables as changed; call before committing the change."""
+        await conn.execute("UPDATE settings_version SET version = version + 1 WHERE id = 0")
+
+    async def refresh_caches(self):
+        """Reload the caches if a settings change was committed since they were loaded."""
+        if await self._settings_version(await self.connection()) != self.settings_version:
+            await self.load_caches()
 
     async def create_tables(self):
         """Create tables if they don't exist."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS authorized_users (
-                    user_id INTEGER PRIMARY KEY
-                )
-            ''')
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS authorized_groups (
-                    group_id INTEGER PRIMARY KEY
-                )
-            ''')
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS ffmpeg_settings (
-                    user_id INTEGER PRIMARY KEY,
-                    ffmpeg_code TEXT
-                )
-            ''')
-            await conn.commit()
+        conn = await self.connection()
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS authorized_users (
+                user_id INTEGER PRIMARY KEY
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS authorized_groups (
+                group_id INTEGER PRIMARY KEY
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS ffmpeg_settings (
+                user_id INTEGER PRIMARY KEY,
+                ffmpeg_code TEXT
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS settings_version (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER
+            )
+        ''')
+        await conn.execute("INSERT OR IGNORE INTO settings_version (id, version) VALUES (0, 0)")
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS video_info (
+                url TEXT PRIMARY KEY,
+                info TEXT,
+                created_at REAL
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                payload TEXT,
+                state TEXT,
+                stage TEXT,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at REAL,
+                updated_at REAL,
+                worker_id TEXT,
+                heartbeat_at REAL,
+                cancel_requested INTEGER DEFAULT 0
+            )
+        ''')
+        await self._add_columns(conn, 'jobs', {
+            'worker_id': 'TEXT', 'heartbeat_at': 'REAL', 'cancel_requested': 'INTEGER DEFAULT 0'
+        })
+        await conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                pid INTEGER,
+                host TEXT,
+                active_jobs INTEGER,
+                started_at REAL,
+                heartbeat_at REAL
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS disk_reservations (
+                job_id INTEGER PRIMARY KEY,
+                worker_id TEXT,
+                host TEXT,
+                nbytes INTEGER,
+                created_at REAL
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS encode_cache_entries (
+                directory TEXT PRIMARY KEY,
+                size INTEGER,
+                last_used REAL
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                source_key TEXT,
+                format_id TEXT,
+                code_hash TEXT,
+                file_id TEXT,
+                caption TEXT,
+                duration INTEGER,
+                width INTEGER,
+                height INTEGER,
+                created_at REAL,
+                last_used REAL,
+                PRIMARY KEY (source_key, format_id, code_hash)
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS usage (
+                user_id INTEGER,
+                day TEXT,
+                jobs INTEGER DEFAULT 0,
+                bytes_in INTEGER DEFAULT 0,
+                bytes_out INTEGER DEFAULT 0,
+                job_seconds REAL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS callback_sessions (
+                token TEXT PRIMARY KEY,
+                data TEXT,
+                created_at REAL
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS partial_downloads (
+                part_key TEXT PRIMARY KEY,
+                url TEXT,
+                format_id TEXT,
+                path TEXT,
+                downloaded_bytes INTEGER DEFAULT 0,
+                total_bytes INTEGER,
+                created_at REAL,
+                updated_at REAL
+            )
+        ''')
+        await conn.commit()
         LOGGER.info("Database tables created or verified.")
 
+    @staticmethod
+    async def _add_columns(conn, table, columns):
+        """Add columns that databases created by older versions are missing."""
+        cursor = await conn.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in await cursor.fetchall()}
+        for name, definition in columns.items():
+            if name not in existing:
+                await conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                LOGGER.info(f"Added column {table}.{name}")
+
     async def add_authorized_user(self, user_id):
         """Add a user to the authorized_users table."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            await conn.execute(
-                "INSERT OR IGNORE INTO authorized_users (user_id) VALUES (?)",
-                (user_id,)
-            )
-            await conn.commit()
+        conn = await self.connection()
+        await conn.execute(
+            "INSERT OR IGNORE INTO authorized_users (user_id) VALUES (?)",
+            (user_id,)
+        )
+        await self._bump_settings_version(conn)
+        await conn.commit()
+        self.authorized_users.add(user_id)
         LOGGER.info(f"User {user_id} authorized.")
 
     async def remove_authorized_user(self, user_id):
         """Remove a user from the authorized_users table."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            await conn.execute(
-                "DELETE FROM authorized_users WHERE user_id = ?",
-                (user_id,)
-            )
-            await conn.commit()
+        conn = await self.connection()
+        await conn.execute(
+            "DELETE FROM authorized_users WHERE user_id = ?",
+            (user_id,)
+        )
+        await self._bump_settings_version(conn)
+        await conn.commit()
+        self.authorized_users.discard(user_id)
         LOGGER.info(f"User {user_id} authorization removed.")
 
     async def is_user_authorized(self, user_id):
         """Check if a user is authorized."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            cursor = await conn.execute(
-                "SELECT 1 FROM authorized_users WHERE user_id = ?",
-                (user_id,)
-            )
-            result = await cursor.fetchone()
-            return result is not None
+        return user_id in self.authorized_users
 
     async def add_authorized_group(self, group_id):
         """Add a group to the authorized_groups table."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            await conn.execute(
-                "INSERT OR IGNORE INTO authorized_groups (group_id) VALUES (?)",
-                (group_id,)
-            )
-            await conn.commit()
+        conn = await self.connection()
+        await conn.execute(
+            "INSERT OR IGNORE INTO authorized_groups (group_id) VALUES (?)",
+            (group_id,)
+        )
+        await self._bump_settings_version(conn)
+        await conn.commit()
+        self.authorized_groups.add(group_id)
         LOGGER.info(f"Group {group_id} authorized.")
 
     async def remove_authorized_group(self, group_id):
         """Remove a group from the authorized_groups table."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            await conn.execute(
-                "DELETE FROM authorized_groups WHERE group_id = ?",
-                (group_id,)
-            )
-            await conn.commit()
+        conn = await self.connection()
+        await conn.execute(
+            "DELETE FROM authorized_groups WHERE group_id = ?",
+            (group_id,)
+        )
+        await self._bump_settings_version(conn)
+        await conn.commit()
+        self.authorized_groups.discard(group_id)
         LOGGER.info(f"Group {group_id} authorization removed.")
 
     async def is_group_authorized(self, group_id):
         """Check if a group is authorized."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            cursor = await conn.execute(
-                "SELECT 1 FROM authorized_groups WHERE group_id = ?",
-                (group_id,)
-            )
-            result = await cursor.fetchone()
-            return result is not None
+        return group_id in self.authorized_groups
 
     async def set_ffmpeg_code(self, user_id, ffmpeg_code):
         """Set or update the ffmpeg code for a specific user."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            await conn.execute(
-                '''
-                INSERT INTO ffmpeg_settings (user_id, ffmpeg_code)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET ffmpeg_code = excluded.ffmpeg_code
-                ''',
-                (user_id, ffmpeg_code)
-            )
-            await conn.commit()
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            INSERT INTO ffmpeg_settings (user_id, ffmpeg_code)
+            VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET ffmpeg_code = excluded.ffmpeg_code
+            ''',
+            (user_id, ffmpeg_code)
+        )
+        await self._bump_settings_version(conn)
+        await conn.commit()
+        self.ffmpeg_codes[user_id] = ffmpeg_code
         LOGGER.info(f"FFmpeg code for user {user_id} set to: {ffmpeg_code}")
 
     async def get_ffmpeg_code(self, user_id):
         """Retrieve the ffmpeg code for a user, or use the default if none is set."""
-        async with aiosqlite.connect(self.db_name) as conn:
-            cursor = await conn.execute(
-                "SELECT ffmpeg_code FROM ffmpeg_settings WHERE user_id = ?",
-                (user_id,)
-            )
-            result = await cursor.fetchone()
-            ffmpeg_code = result[0] if result else DEFAULT_FFMPEG
+        ffmpeg_code = self.ffmpeg_codes.get(user_id, DEFAULT_FFMPEG)
         LOGGER.info(f"Retrieved FFmpeg code for user {user_id}: {ffmpeg_code}")
         return ffmpeg_code
+
+    async def get_video_info(self, url, max_age):
+        """Return (info JSON, created_at) cached for a URL if it is younger than `max_age` seconds, or None."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "SELECT info, created_at FROM video_info WHERE url = ? AND created_at > ?",
+            (url, time.time() - max_age)
+        )
+        return await cursor.fetchone()
+
+    async def set_video_info(self, url, info):
+        """Store the info JSON for a URL, replacing any older entry."""
+        conn = await self.connection()
+        await conn.execute(
+            "INSERT OR REPLACE INTO video_info (url, info, created_at) VALUES (?, ?, ?)",
+            (url, info, time.time())
+        )
+        await conn.commit()
+
+    async def prune_video_info(self, max_age):
+        """Delete cached info entries older than `max_age` seconds."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "DELETE FROM video_info WHERE created_at <= ?",
+            (time.time() - max_age,)
+        )
+        await conn.commit()
+        LOGGER.info(f"Pruned {cursor.rowcount} cached video info entries.")
+
+    async def add_usage(self, user_id, day, bytes_in, bytes_out, job_seconds, jobs=1):
+        """Add to a user's usage for `day`; reservations pass `jobs=0` and refund with negative bytes."""
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            INSERT INTO usage (user_id, day, jobs, bytes_in, bytes_out, job_seconds) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                jobs = jobs + excluded.jobs, bytes_in = bytes_in + excluded.bytes_in,
+                bytes_out = bytes_out + excluded.bytes_out, job_seconds = job_seconds + excluded.job_seconds
+            ''',
+            (user_id, day, jobs, bytes_in, bytes_out, job_seconds)
+        )
+        await conn.commit()
+
+    async def book_usage(self, user_id, day, nbytes, limit):
+        """Add `nbytes` to a user's usage for `day` only if they used less than `limit` so far.
+
+        The check and the booking are one statement, so jobs starting at once in different
+        processes cannot all pass the same check. Returns whether the bytes were booked.
+        """
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            INSERT INTO usage (user_id, day, jobs, bytes_in, bytes_out, job_seconds)
+            SELECT ?, ?, 0, ?, 0, 0
+            WHERE COALESCE((SELECT bytes_in + bytes_out FROM usage WHERE user_id = ? AND day = ?), 0) < ?
+            ON CONFLICT(user_id, day) DO UPDATE SET bytes_in = bytes_in + excluded.bytes_in
+            ''',
+            (user_id, day, nbytes, user_id, day, limit)
+        )
+        await conn.commit()
+        return cursor.rowcount > 0
+
+    async def get_usage(self, user_id, day):
+        """Return (jobs, bytes_in, bytes_out, job_seconds) of a user on `day`, or None."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "SELECT jobs, bytes_in, bytes_out, job_seconds FROM usage WHERE user_id = ? AND day = ?",
+            (user_id, day)
+        )
+        return await cursor.fetchone()
+
+    async def get_usage_by_user(self, day, limit=20):
+        """Return (user_id, jobs, bytes_in, bytes_out, job_seconds) for `day`, heaviest users first."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            SELECT user_id, jobs, bytes_in, bytes_out, job_seconds FROM usage WHERE day = ?
+            ORDER BY bytes_in + bytes_out DESC LIMIT ?
+            ''',
+            (day, limit)
+        )
+        return await cursor.fetchall()
+
+    async def get_usage_history(self, user_id, days=7):
+        """Return (day, jobs, bytes_in, bytes_out, job_seconds) of a user's most recent days."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            SELECT day, jobs, bytes_in, bytes_out, job_seconds FROM usage WHERE user_id = ?
+            ORDER BY day DESC LIMIT ?
+            ''',
+            (user_id, days)
+        )
+        return await cursor.fetchall()
+
+    async def save_callback_session(self, token, data):
+        """Persist the JSON state behind an inline keyboard."""
+        conn = await self.connection()
+        await conn.execute(
+            "INSERT OR REPLACE INTO callback_sessions (token, data, created_at) VALUES (?, ?, ?)",
+            (token, data, time.time())
+        )
+        await conn.commit()
+
+    async def get_callback_session(self, token, max_age):
+        """Return (data, created_at) of a session younger than `max_age` seconds, or None."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "SELECT data, created_at FROM callback_sessions WHERE token = ? AND created_at > ?",
+            (token, time.time() - max_age)
+        )
+        return await cursor.fetchone()
+
+    async def delete_callback_session(self, token):
+        conn = await self.connection()
+        await conn.execute("DELETE FROM callback_sessions WHERE token = ?", (token,))
+        await conn.commit()
+
+    async def prune_callback_sessions(self, max_age):
+        """Delete sessions whose buttons have expired."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "DELETE FROM callback_sessions WHERE created_at <= ?",
+            (time.time() - max_age,)
+        )
+        await conn.commit()
+        LOGGER.info(f"Pruned {cursor.rowcount} expired callback sessions.")
+
+    async def create_job(self, kind, user_id, chat_id, payload):
+        """Insert a queued job and return its id."""
+        now = time.time()
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            INSERT INTO jobs (kind, user_id, chat_id, payload, state, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?)
+            ''',
+            (kind, user_id, chat_id, payload, now, now)
+        )
+        await conn.commit()
+        return cursor.lastrowid
+
+    async def set_job_state(self, job_id, state, stage=None, error=None):
+        """Update a job's state, keeping the previous stage and error unless given."""
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            UPDATE jobs SET state = ?, stage = COALESCE(?, stage), error = COALESCE(?, error), updated_at = ?
+            WHERE job_id = ?
+            ''',
+            (state, stage, error, time.time(), job_id)
+        )
+        await conn.commit()
+
+    async def increment_job_attempts(self, job_id):
+        """Count another attempt at running a job."""
+        conn = await self.connection()
+        await conn.execute(
+            "UPDATE jobs SET attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+            (time.time(), job_id)
+        )
+        await conn.commit()
+
+    async def get_unfinished_jobs(self):
+        """Return the jobs that were queued or running, oldest first."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            SELECT job_id, kind, user_id, chat_id, payload, state, stage, attempts
+            FROM jobs WHERE state IN ('queued', 'running') ORDER BY job_id
+            '''
+        )
+        return await cursor.fetchall()
+
+    async def get_active_jobs(self, user_id=None):
+        """Return (job_id, kind, user_id, state, stage, worker_id) of queued and running jobs."""
+        conn = await self.connection()
+        sql = '''
+            SELECT job_id, kind, user_id, state, stage, worker_id
+            FROM jobs WHERE state IN ('queued', 'running')
+        '''
+        if user_id is None:
+            cursor = await conn.execute(sql + " ORDER BY job_id")
+        else:
+            cursor = await conn.execute(sql + " AND user_id = ? ORDER BY job_id", (user_id,))
+        return await cursor.fetchall()
+
+    async def claim_job(self, worker_id, kinds, max_attempts, priority_users=(), user_max_jobs=0):
+        """Atomically assign a queued job of the given kinds to a worker and return its row.
+
+        Jobs of `priority_users` are claimed before everyone else's. Other users are served
+        fewest running jobs first, so one user's backlog cannot crowd out the rest, and with
+        `user_max_jobs` a user's job is only claimed while they have fewer jobs running on
+        all workers together.
+        """
+        now = time.time()
+        placeholders = ", ".join("?" for _ in kinds)
+        priority = ", ".join("?" for _ in priority_users) or "NULL"
+        conn = await self.connection()
+        cursor = await conn.execute(
+            f'''
+            WITH running AS (SELECT user_id, COUNT(*) AS jobs FROM jobs WHERE state = 'running' GROUP BY user_id)
+            UPDATE jobs SET state = 'running', worker_id = ?, heartbeat_at = ?, attempts = attempts + 1,
+                updated_at = ?
+            WHERE job_id = (
+                SELECT queued.job_id FROM jobs AS queued LEFT JOIN running ON running.user_id = queued.user_id
+                WHERE queued.state = 'queued' AND queued.kind IN ({placeholders}) AND queued.attempts < ?
+                    AND queued.cancel_requested = 0
+                    AND (queued.user_id IN ({priority}) OR ? = 0 OR COALESCE(running.jobs, 0) < ?)
+                ORDER BY queued.user_id IN ({priority}) DESC, COALESCE(running.jobs, 0), queued.job_id LIMIT 1
+            )
+            RETURNING job_id, kind, user_id, chat_id, payload, state, stage, attempts
+            ''',
+            (worker_id, now, now, *kinds, max_attempts, *priority_users, user_max_jobs, user_max_jobs,
+             *priority_users)
+        )
+        row = await cursor.fetchone()
+        await conn.commit()
+        return row
+
+    async def heartbeat_worker(self, worker_id, pid, host, active_jobs):
+        """Record that a worker is alive, extend the lease on its jobs and return job ids to cancel."""
+        now = time.time()
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            INSERT INTO workers (worker_id, pid, host, active_jobs, started_at, heartbeat_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(worker_id) DO UPDATE SET
+                pid = excluded.pid, host = excluded.host, active_jobs = excluded.active_jobs,
+                heartbeat_at = excluded.heartbeat_at
+            ''',
+            (worker_id, pid, host, active_jobs, now, now)
+        )
+        await conn.execute(
+            "UPDATE jobs SET heartbeat_at = ? WHERE worker_id = ? AND state = 'running'",
+            (now, worker_id)
+        )
+        cursor = await conn.execute(
+            "SELECT job_id FROM jobs WHERE worker_id = ? AND state = 'running' AND cancel_requested = 1",
+            (worker_id,)
+        )
+        rows = await cursor.fetchall()
+        await conn.commit()
+        return [row[0] for row in rows]
+
+    async def requeue_job(self, job_id, error=None):
+        """Put a running job back in the queue so any worker can take it."""
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            UPDATE jobs SET state = 'queued', worker_id = NULL, heartbeat_at = NULL,
+                error = COALESCE(?, error), updated_at = ?
+            WHERE job_id = ? AND state = 'running'
+            ''',
+            (error, time.time(), job_id)
+        )
+        await conn.commit()
+
+    async def release_worker(self, worker_id, max_attempts):
+        """Requeue the running jobs of a worker that is shutting down and forget the worker.
+
+        Jobs that used their last attempt could never be claimed again, so they are failed
+        instead; returns their job ids.
+        """
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            UPDATE jobs SET state = 'failed', error = 'Worker stopped', updated_at = ?
+            WHERE worker_id = ? AND state = 'running' AND attempts >= ?
+            RETURNING job_id
+            ''',
+            (time.time(), worker_id, max_attempts)
+        )
+        failed = [row[0] for row in await cursor.fetchall()]
+        await conn.execute(
+            '''
+            UPDATE jobs SET state = 'queued', worker_id = NULL, heartbeat_at = NULL, updated_at = ?
+            WHERE worker_id = ? AND state = 'running'
+            ''',
+            (time.time(), worker_id)
+        )
+        await conn.execute("DELETE FROM disk_reservations WHERE worker_id = ?", (worker_id,))
+        await conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+        await conn.commit()
+        return failed
+
+    async def reap_stale_jobs(self, timeout, max_attempts):
+        """Requeue running jobs whose worker stopped heartbeating; fail those out of attempts.
+
+        Returns the (job_id, chat_id, payload, attempts) rows that were failed.
+        """
+        cutoff = time.time() - timeout
+        conn = await self.connection()
+        stale = "state = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)"
+        cursor = await conn.execute(
+            f"SELECT job_id, chat_id, payload, attempts FROM jobs WHERE {stale} AND attempts >= ?",
+            (cutoff, max_attempts)
+        )
+        failed = await cursor.fetchall()
+        await conn.execute(
+            f'''
+            UPDATE jobs SET state = 'failed', error = 'Worker lost', updated_at = ?
+            WHERE {stale} AND attempts >= ?
+            ''',
+            (time.time(), cutoff, max_attempts)
+        )
+        cursor = await conn.execute(
+            f"UPDATE jobs SET state = 'queued', worker_id = NULL, heartbeat_at = NULL, updated_at = ? WHERE {stale}",
+            (time.time(), cutoff)
+        )
+        if cursor.rowcount:
+            LOGGER.warning(f"Requeued {cursor.rowcount} jobs of unresponsive workers.")
+        await conn.execute(
+            "DELETE FROM disk_reservations WHERE worker_id IN (SELECT worker_id FROM workers WHERE heartbeat_at < ?)",
+            (cutoff,)
+        )
+        await conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (cutoff,))
+        await conn.commit()
+        return failed
+
+    async def request_cancel(self, job_ids):
+        """Cancel queued jobs outright and ask the workers running the others to stop them."""
+        if not job_ids:
+            return
+        placeholders = ", ".join("?" for _ in job_ids)
+        conn = await self.connection()
+        await conn.execute(
+            f"UPDATE jobs SET state = 'cancelled', updated_at = ? WHERE state = 'queued' AND job_id IN ({placeholders})",
+            (time.time(), *job_ids)
+        )
+        await conn.execute(
+            f"UPDATE jobs SET cancel_requested = 1 WHERE state = 'running' AND job_id IN ({placeholders})",
+            tuple(job_ids)
+        )
+        await conn.commit()
+
+    async def reserve_disk(self, job_id, worker_id, host, nbytes, available):
+        """Record a job's disk reservation if the host's reservations plus `nbytes` fit in `available` bytes.
+
+        The check and the insert are one statement, so concurrent workers cannot both take the
+        last free space. Returns whether the reservation was made.
+        """
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            INSERT OR REPLACE INTO disk_reservations (job_id, worker_id, host, nbytes, created_at)
+            SELECT ?, ?, ?, ?, ?
+            WHERE (SELECT COALESCE(SUM(nbytes), 0) FROM disk_reservations WHERE host = ? AND job_id != ?) + ? <= ?
+            ''',
+            (job_id, worker_id, host, nbytes, time.time(), host, job_id, nbytes, available)
+        )
+        await conn.commit()
+        return cursor.rowcount > 0
+
+    async def get_disk_reserved(self, host):
+        """Return (bytes, jobs) reserved on a host."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0), COUNT(*) FROM disk_reservations WHERE host = ?", (host,)
+        )
+        return await cursor.fetchone()
+
+    async def release_disk(self, job_id):
+        """Drop a job's disk reservation."""
+        conn = await self.connection()
+        await conn.execute("DELETE FROM disk_reservations WHERE job_id = ?", (job_id,))
+        await conn.commit()
+
+    async def drop_orphaned_disk_reservations(self, host):
+        """Delete reservations on a host made by processes that are not registered workers, e.g. after a crash."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "DELETE FROM disk_reservations WHERE host = ? AND worker_id NOT IN (SELECT worker_id FROM workers)",
+            (host,)
+        )
+        await conn.commit()
+        if cursor.rowcount:
+            LOGGER.info(f"Dropped {cursor.rowcount} disk reservations of stopped processes.")
+
+    async def get_workers(self):
+        """Return (worker_id, host, pid, active_jobs, heartbeat_at) of registered workers."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            "SELECT worker_id, host, pid, active_jobs, heartbeat_at FROM workers ORDER BY worker_id"
+        )
+        return await cursor.fetchall()
+
+    async def get_result(self, source_key, format_id, code_hash, max_age):
+        """Return (file_id, caption, duration, width, height) of a cached result and mark it used."""
+        conn = await self.connection()
+        cursor = await conn.execute(
+            '''
+            SELECT file_id, caption, duration, width, height FROM results
+            WHERE source_key = ? AND format_id = ? AND code_hash = ? AND created_at > ?
+            ''',
+            (source_key, format_id, code_hash, time.time() - max_age)
+        )
+        result = await cursor.fetchone()
+        if result:
+            await conn.execute(
+                "UPDATE results SET last_used = ? WHERE source_key = ? AND format_id = ? AND code_hash = ?",
+                (time.time(), source_key, format_id, code_hash)
+            )
+            await conn.commit()
+        return result
+
+    async def save_result(self, source_key, format_id, code_hash, file_id, caption, duration, width, height):
+        """Store the uploaded file_id for a source, format and ffmpeg code."""
+        now = time.time()
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            INSERT OR REPLACE INTO results
+            (source_key, format_id, code_hash, file_id, caption, duration, width, height, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (source_key, format_id, code_hash, file_id, caption, duration, width, height, now, now)
+        )
+        await conn.commit()
+        LOGGER.info(f"Cached result for {source_key} ({format_id or 'file'}, {code_hash}).")
+
+    async def delete_result(self, source_key, format_id, code_hash):
+        """Delete a single cached result."""
+        conn = await self.connection()
+        await conn.execute(
+            "DELETE FROM results WHERE source_key = ? AND format_id = ? AND code_hash = ?",
+            (source_key, format_id, code_hash)
+        )
+        await conn.commit()
+
+    async def delete_results(self, source_key):
+        """Delete every cached result of a source and return how many were removed."""
+        conn = await self.connection()
+        cursor = await conn.execute("DELETE FROM results WHERE source_key = ?", (source_key,))
+        await conn.commit()
+        LOGGER.info(f"Invalidated {cursor.rowcount} cached results for {source_key}.")
+        return cursor.rowcount
+
+    async def evict_results(self, max_entries, max_age):
+        """Drop expired results and the least recently used ones beyond `max_entries`."""
+        conn = await self.connection()
+        await conn.execute("DELETE FROM results WHERE created_at <= ?", (time.time() - max_age,))
+        await conn.execute(
+            '''
+            DELETE FROM results WHERE rowid NOT IN (
+                SELECT rowid FROM results ORDER BY last_used DESC LIMIT ?
+            )
+            ''',
+            (max_entries,)
+        )
+        await conn.commit()
+
+    async def purge_results(self, max_age=None):
+        """Delete results older than `max_age` seconds, or all of them; returns the count."""
+        conn = await self.connection()
+        if max_age is None:
+            cursor = await conn.execute("DELETE FROM results")
+        else:
+            cursor = await conn.execute("DELETE FROM results WHERE created_at <= ?", (time.time() - max_age,))
+        await conn.commit()
+        LOGGER.info(f"Purged {cursor.rowcount} cached results.")
+        return cursor.rowcount
+
+    async def add_cache_entries(self, entries, replace=False):
+        """Record (directory, size, last_used) of encode cache entries; existing ones are kept unless `replace`."""
+        conn = await self.connection()
+        await conn.executemany(
+            f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO encode_cache_entries (directory, size, last_used) "
+            "VALUES (?, ?, ?)",
+            entries
+        )
+        await conn.commit()
+
+    async def touch_cache_entry(self, directory, last_used):
+        """Mark an encode cache entry as used."""
+        conn = await self.connection()
+        await conn.execute(
+            "UPDATE encode_cache_entries SET last_used = ? WHERE directory = ?",
+            (last_used, directory)
+        )
+        await conn.commit()
+
+    async def delete_cache_entries(self, directories):
+        """Forget encode cache entries."""
+        conn = await self.connection()
+        await conn.executemany(
+            "DELETE FROM encode_cache_entries WHERE directory = ?",
+            [(directory,) for directory in directories]
+        )
+        await conn.commit()
+
+    async def get_cache_entries(self):
+        """Return (directory, size, last_used) of every encode cache entry."""
+        conn = await self.connection()
+        cursor = await conn.execute("SELECT directory, size, last_used FROM encode_cache_entries")
+        return await cursor.fetchall()
+
+    async def save_partial(self, part_key, url, format_id, path):
+        """Record a resumable download, keeping the progress of an earlier attempt; returns its bytes so far."""
+        now = time.time()
+        conn = await self.connection()
+        await conn.execute(
+            '''
+            INSERT INTO partial_downloads (part_key, url, format_id, path, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (part_key) DO UPDATE SET url = excluded.url, path = excluded.path, updated_at = excluded.updated_at
+            ''',
+            (part_key, url, format_id, path, now, now)
+        )
+        await conn.commit()
+        cursor = await conn.execute("SELECT downloaded_bytes FROM partial_downloads WHERE part_key = ?", (part_key,))
+        result = await cursor.fetchone()
+        return result[0] if result else 0
+
+    async def update_partial(self, part_key, downloaded_bytes, total_bytes):
+        """Store the progress of a resumable download."""
+        conn = await self.connection()
+        await conn.execute(
+            "UPDATE partial_downloads SET downloaded_bytes = ?, total_bytes = ?, updated_at = ? WHERE part_key = ?",
+            (downloaded_bytes, total_bytes, time.time(), part_key)
+        )
+        await conn.commit()
+
+    async def delete_partial(self, part_key):
+        """Forget a resumable download."""
+        conn = await self.connection()
+        await conn.execute("DELETE FROM partial_downloads WHERE part_key = ?", (part_key,))
+        await conn.commit()
+
+    async def get_partials(self):
+        """Return (part_key, path, updated_at) of every recorded resumable download."""
+        conn = await self.connection()
+        cursor = await conn.execute("SELECT part_key, path, updated_at FROM partial_downloads")
+        return await cursor.fetchall()
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import socket
+from bot.utils.scheduler import Job
+
+LOGGER = logging.getLogger(__name__)
+
+
+class JobBroker:
+    """Hands jobs from the shared jobs table to this worker process and keeps its leases alive.
+
+    The dispatcher only inserts queued jobs; workers claim them with an atomic update,
+    heartbeat while they run them, and the dispatcher requeues the jobs of workers whose
+    heartbeat stopped (see `Database.reap_stale_jobs`). The per-user cap of `user_max_jobs`
+    is enforced by the claim itself, so it holds across all workers.
+    """
+
+    def __init__(self, db, scheduler, worker_id, max_jobs, max_attempts, heartbeat, poll_interval, user_max_jobs=0):
+        self.db = db
+        self.scheduler = scheduler
+        self.worker_id = worker_id
+        self.max_jobs = max_jobs
+        self.max_attempts = max_attempts
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.user_max_jobs = user_max_jobs
+        self.claimed = 0
+
+    async def work(self):
+        """Claim and run jobs until cancelled, then hand unfinished ones back to the queue."""
+        heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        LOGGER.info(f"Worker {self.worker_id} waiting for jobs")
+        try:
+            while True:
+                if len(self.scheduler.tasks) < self.max_jobs and await self._claim():
+                    continue
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            heartbeat_task.cancel()
+            tasks = list(self.scheduler.tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(heartbeat_task, *tasks, return_exceptions=True)
+            failed = await self.db.release_worker(self.worker_id, self.max_attempts)
+            for job_id in failed:
+                LOGGER.error(f"Job {job_id} failed: worker stopped during its last attempt")
+            LOGGER.info(f"Worker {self.worker_id} released {len(tasks) - len(failed)} jobs")
+
+    async def _claim(self):
+        row = await self.db.claim_job(
+            self.worker_id, list(self.scheduler.handlers), self.max_attempts, sorted(self.scheduler.priority_users),
+            self.user_max_jobs
+        )
+        if row is None:
+            return False
+        job = Job.from_row(row)
+        self.claimed += 1
+        LOGGER.info(f"Worker {self.worker_id} claimed job {job.job_id} ({job.kind}), attempt {job.attempts}")
+        self.scheduler.adopt(job)
+        return True
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                cancelled = await self.db.heartbeat_worker(
+                    self.worker_id, os.getpid(), socket.gethostname(), len(self.scheduler.tasks)
+                )
+                for job_id in cancelled:
+                    if self.scheduler.cancel(job_id):
+                        LOGGER.info(f"Cancelled job {job_id} on request")
+            except Exception as e:
+                LOGGER.error(f"Heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat)
+
+
+def default_worker_id():
+    """Worker id used when WORKER_ID is not set: host name and process id."""
+    return f"{socket.gethostname()}-{os.getpid()}"
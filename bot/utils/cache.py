@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+# Fields kept from a yt-dlp info dict; the full dict is large and holds expiring stream URLs
+INFO_FIELDS = ('id', 'title', 'duration', 'extractor', 'webpage_url', 'is_live')
+FORMAT_FIELDS = (
+    'format_id', 'ext', 'height', 'width', 'fps', 'vcodec', 'acodec',
+    'filesize', 'filesize_approx', 'tbr', 'vbr', 'abr', 'protocol', 'container'
+)
+
+
+def slim_info(info):
+    """Reduce a yt-dlp info dict to the fields the bot actually uses."""
+    slim = {key: info.get(key) for key in INFO_FIELDS}
+    slim['formats'] = [
+        {key: f.get(key) for key in FORMAT_FIELDS}
+        for f in info.get('formats') or []
+    ]
+    return slim
+
+
+class TTLCache:
+    """A small LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        return self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class InfoCache:
+    """Caches extracted video info per URL in memory, optionally backed by the database.
+
+    Only lookups that run the extraction count as misses.
+    """
+
+    def __init__(self, maxsize, ttl, db=None):
+        self.memory = TTLCache(maxsize, ttl)
+        self.db = db
+        self.db_hits = 0
+        self.misses = 0
+        self.inflight = {}  # url -> future, so concurrent lookups share one extraction
+
+    async def get(self, url, loader):
+        """Return the cached info for `url`, calling `loader()` to extract it on a miss."""
+        info = self.memory.get(url)
+        if info is not None:
+            return info
+
+        persisted = await self._load_persisted(url)
+        if persisted is not None:
+            info, created_at = persisted
+            self.db_hits += 1
+            # Expire when the stored entry does, not a full TTL after it was read back
+            self.memory.set(url, info, ttl=created_at + self.memory.ttl - time.time())
+            return info
+
+        if url in self.inflight:
+            return await asyncio.shield(self.inflight[url])
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[url] = future
+        self.misses += 1
+        try:
+            info = slim_info(await loader())
+            self.memory.set(url, info)
+            await self._persist(url, info)
+            future.set_result(info)
+            return info
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so waiter-less failures are not logged
+            raise
+        finally:
+            del self.inflight[url]
+
+    def invalidate(self, url):
+        self.memory.pop(url)
+
+    async def _load_persisted(self, url):
+        if self.db is None:
+            return None
+        try:
+            row = await self.db.get_video_info(url, self.memory.ttl)
+            return (json.loads(row[0]), row[1]) if row else None
+        except Exception as e:
+            LOGGER.error(f"Failed to read cached info for {url}: {e}")
+            return None
+
+    async def _persist(self, url, info):
+        if self.db is None:
+            return
+        try:
+            await self.db.set_video_info(url, json.dumps(info))
+        except Exception as e:
+            LOGGER.error(f"Failed to persist info for {url}: {e}")
+
+    def stats(self):
+        return {
+            'hits': self.memory.hits,
+            'misses': self.misses,
+            'db_hits': self.db_hits,
+            'size': len(self.memory),
+        }
@@ -0,0 +1,48 @@
+import json
+import logging
+import secrets
+import time
+from bot.utils.cache import TTLCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CallbackSessions:
+    """State behind inline keyboards, addressed by a short token carried in the callback data.
+
+    Sessions expire after `ttl` seconds, at most `maxsize` are kept in memory, and with a
+    database they are also persisted so buttons keep working after a restart.
+    """
+
+    def __init__(self, maxsize, ttl, db=None):
+        self.cache = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.db = db
+
+    async def create(self, kind, user_id, **data):
+        """Store a new session and return its token (8 hex characters, so never an underscore)."""
+        token = secrets.token_hex(4)
+        session = {'kind': kind, 'user_id': user_id, **data}
+        self.cache.set(token, session)
+        if self.db is not None:
+            await self.db.save_callback_session(token, json.dumps(session))
+        return token
+
+    async def get(self, token, kind, user_id):
+        """Return the session if it exists, is of `kind` and belongs to `user_id`, else None."""
+        session = self.cache.get(token)
+        if session is None and self.db is not None:
+            row = await self.db.get_callback_session(token, self.ttl)
+            if row is not None:
+                data, created_at = row
+                session = json.loads(data)
+                self.cache.set(token, session, ttl=self.ttl - (time.time() - created_at))
+        if session is None or session['kind'] != kind or session['user_id'] != user_id:
+            return None
+        return session
+
+    async def close(self, token):
+        """Forget a session once its buttons have been used."""
+        self.cache.pop(token)
+        if self.db is not None:
+            await self.db.delete_callback_session(token)
@@ -1,17 +1,599 @@
 import asyncio
+import logging
 import os
+import shlex
+import shutil
+import time
+from config import PARALLEL_ENCODE, PARALLEL_ENCODE_MIN_DURATION, PARALLEL_ENCODE_WORKERS
+from bot.utils.encode_cache import encode_cache
+from bot.utils.helpers import probe_media
+from bot.utils.metrics import encode_metrics, preset_label
+from bot.utils.presets import is_adaptive, parse_target, plan_encode
+from bot.utils.results import code_hash
 
-async def compress_video(input_path, output_path, ffmpeg_code):
+LOGGER = logging.getLogger(__name__)
+
+# How much of a stream to inspect before deciding whether ffmpeg can read it from a pipe
+SNIFF_BYTES = 64 * 1024
+# Shortest segment worth a separate ffmpeg process in a parallel encode
+MIN_SEGMENT_SECONDS = 30
+# Options that only affect audio, left out of a first pass and of its cache key
+AUDIO_OPTIONS = ('-c:a', '-acodec', '-codec:a', '-b:a', '-ab', '-ar', '-ac', '-af', '-filter:a', '-q:a', '-aq')
+# Options a segmented encode cannot reproduce: explicit stream selection, multi-stream filters and trimming
+SEGMENT_UNSAFE_OPTIONS = ('-map', '-filter_complex', '-lavfi', '-ss', '-t', '-to', '-shortest', '-frames',
+                          '-vframes', '-itsoffset', '-c:s', '-scodec', '-codec:s')
+
+class EncodeProgress:
+    """One snapshot of ffmpeg's `-progress` output."""
+
+    def __init__(self, out_time=0.0, fps=0.0, speed=0.0, bitrate=None, total_size=0, duration=None):
+        self.out_time = out_time  # Seconds of output written so far
+        self.fps = fps
+        self.speed = speed  # Multiple of realtime
+        self.bitrate = bitrate  # kbit/s
+        self.total_size = total_size  # Bytes
+        self.duration = duration  # Seconds of input, when known
+
+    @property
+    def percent(self):
+        if not self.duration:
+            return None
+        return min(self.out_time / self.duration * 100, 100.0)
+
+    @property
+    def eta(self):
+        """Seconds until the encode finishes at the current speed, when known."""
+        if not self.duration or not self.speed:
+            return None
+        return max(self.duration - self.out_time, 0) / self.speed
+
+def _number(value):
+    try:
+        return float(value.rstrip('x').replace('kbits/s', ''))
+    except (AttributeError, ValueError):
+        return None
+
+def parse_progress(fields, duration=None):
+    """Build an EncodeProgress from one block of `key=value` pairs written by `-progress`."""
+    out_time_us = _number(fields.get('out_time_us'))
+    return EncodeProgress(
+        out_time=max(out_time_us or 0, 0) / 1_000_000,
+        fps=_number(fields.get('fps')) or 0.0,
+        speed=_number(fields.get('speed')) or 0.0,
+        bitrate=_number(fields.get('bitrate')),
+        total_size=int(_number(fields.get('total_size')) or 0),
+        duration=duration,
+    )
+
+async def _read_progress(stream, on_progress, duration):
+    """Parse `-progress` blocks from ffmpeg's stdout and await `on_progress` for each."""
+    fields = {}
+    async for line in stream:
+        key, _, value = line.decode(errors='replace').strip().partition('=')
+        fields[key] = value
+        # Blocks written before the first frame report out_time as N/A
+        if key == 'progress' and _number(fields.get('out_time_us')) is not None:
+            try:
+                await on_progress(parse_progress(fields, duration))
+            except Exception as e:
+                LOGGER.error(f"Progress callback failed: {e}")
+        if key == 'progress':
+            fields = {}
+
+async def _run_ffmpeg(args, on_progress=None, duration=None, limits=None):
+    """Run vegapunk (ffmpeg) with a shell argument string and return (returncode, stderr).
+
+    With `on_progress`, ffmpeg reports through `-progress pipe:1` and each parsed
+    EncodeProgress is awaited on the callback. `limits` (a ResourceLimits) sets the
+    niceness of the process; its thread cap is applied to the arguments by the caller.
+    """
+    if on_progress:
+        args = f'-progress pipe:1 -nostats {args}'
+    process = await asyncio.create_subprocess_shell(
+        f'vegapunk -y {args}',
+        stdout=asyncio.subprocess.PIPE if on_progress else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        preexec_fn=limits.preexec if limits else None
+    )
+    try:
+        # Drain stderr concurrently so a chatty ffmpeg never blocks on a full pipe
+        stderr_task = asyncio.create_task(process.stderr.read())
+        if on_progress:
+            await _read_progress(process.stdout, on_progress, duration)
+        stderr = await stderr_task
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stderr.decode(errors='replace').strip()
+
+def is_copy_only(ffmpeg_code):
+    """Whether every codec option in the ffmpeg arguments is a stream copy."""
+    args = shlex.split(ffmpeg_code)
+    codecs = [
+        value for option, value in zip(args, args[1:])
+        if option in ('-c', '-codec', '-vcodec', '-acodec', '-scodec') or option.startswith(('-c:', '-codec:'))
+    ]
+    return bool(codecs) and all(value == 'copy' for value in codecs)
+
+def is_two_pass(ffmpeg_code):
+    """Whether the arguments are the second pass of a two-pass encode."""
+    args = shlex.split(ffmpeg_code)
+    return any(option == '-pass' and value == '2' for option, value in zip(args, args[1:]))
+
+def first_pass_args(ffmpeg_code):
+    """The analysis pass matching second-pass arguments: same video settings, no audio."""
+    args = shlex.split(ffmpeg_code)
+    first = []
+    skip = False
+    for option, value in zip(args, args[1:] + ['']):
+        if skip:
+            skip = False
+            continue
+        if option in AUDIO_OPTIONS or option == '-movflags':
+            skip = True
+            continue
+        if option == '-pass':
+            first += ['-pass', '1']
+            skip = True
+            continue
+        first.append(option)
+    return shlex.join(first + ['-an'])
+
+def can_segment(ffmpeg_code, probe):
+    """Whether encoding the input in segments gives the same result as one ffmpeg pass.
+
+    That holds for one video and at most one audio stream and codes that neither select
+    streams nor trim; anything else (subtitles, extra tracks, `-map`) is encoded in one pass.
+    """
+    args = shlex.split(ffmpeg_code)
+    if any(arg in SEGMENT_UNSAFE_OPTIONS or arg.startswith('-frames:') for arg in args):
+        return False
+    streams = (probe or {}).get('streams') or {}
+    return streams.get('video') == 1 and streams.get('audio', 0) <= 1 and set(streams) <= {'video', 'audio'}
+
+def split_stream_args(ffmpeg_code):
+    """Split arguments into (video, audio, muxer) parts for a segmented encode.
+
+    The video part is run on every segment, the audio part once over the whole input and the
+    muxer part (e.g. `-movflags`) when both are joined. Codec options without a stream
+    specifier apply to video and audio, as they would in one pass.
+    """
+    args = shlex.split(ffmpeg_code)
+    video, audio, mux = [], [], []
+    index = 0
+    while index < len(args):
+        option = args[index]
+        value = args[index + 1:index + 2]
+        if option in AUDIO_OPTIONS:
+            audio += [option, *value]
+            index += 2
+        elif option == '-movflags':
+            mux += [option, *value]
+            index += 2
+        elif option in ('-c', '-codec'):
+            video += [option, *value]
+            audio += ['-c:a', *value]
+            index += 2
+        elif option == '-an':
+            audio.append(option)
+            index += 1
+        else:
+            video.append(option)
+            index += 1
+    return shlex.join(video + ['-an']), shlex.join(audio), shlex.join(mux)
+
+def is_passthrough(ffmpeg_code):
+    """Whether the arguments copy every stream unchanged, so an ffmpeg pass would only rewrite the container."""
+    args = shlex.split(ffmpeg_code)
+    if len(args) % 2 or not is_copy_only(ffmpeg_code):
+        return False
+    for option, value in zip(args[::2], args[1::2]):
+        codec_option = option in ('-c', '-codec', '-vcodec', '-acodec', '-scodec') or option.startswith(('-c:', '-codec:'))
+        if not (codec_option or (option == '-map' and value == '0')):
+            return False
+    return True
+
+def same_container(input_path, output_path):
+    """Whether `input_path` already is the MP4 that `output_path` asks for."""
+    if os.path.splitext(output_path)[1].lower() not in ('.mp4', '.m4v', '.mov'):
+        return False
+    with open(input_path, 'rb') as f:
+        return f.read(8)[4:8] == b'ftyp'
+
+def _with_metrics(ffmpeg_code, on_progress):
+    """Wrap a progress callback so every event also reaches the encode metrics."""
+    label = preset_label(ffmpeg_code)
+
+    async def report(event):
+        encode_metrics.observe(label, event)
+        if on_progress:
+            await on_progress(event)
+    return report
+
+async def input_key(input_path, source_key=None):
+    """Encode cache identity of an input: its source when the caller knows it, else its content hash."""
+    if source_key:
+        return encode_cache.source_key(source_key)
+    return await encode_cache.content_key(input_path)
+
+async def compress_video(input_path, output_path, ffmpeg_code, on_progress=None, limits=None, source_key=None):
+    """Encode a file with the user's ffmpeg arguments, splitting long inputs across all cores.
+
+    `on_progress(event)` is awaited with an EncodeProgress whenever ffmpeg reports progress.
+    Adaptive codes ('auto ...') are resolved against a probe of the input first, and codes that
+    copy every stream into the container the input already has only link the input. With
+    `limits` every ffmpeg process runs with at most `limits.threads` threads in total.
+    `source_key` (e.g. a Telegram file or a YouTube format) identifies the input in the
+    encode cache; without it the input is hashed.
+    """
+    if is_passthrough(ffmpeg_code) and same_container(input_path, output_path):
+        LOGGER.info(f"Copy-only code, reusing {os.path.basename(input_path)} without an ffmpeg pass")
+        return link_or_copy(input_path, output_path)
+    probe = await probe_media(input_path)
+    duration = round(probe['duration']) if probe and probe['duration'] else None
+    if is_adaptive(ffmpeg_code):
+        plan = plan_encode(probe, parse_target(ffmpeg_code))
+        LOGGER.info(f"Adaptive plan for {os.path.basename(input_path)}: {plan.action} ({plan.reason})")
+        if plan.action == 'passthrough':
+            return link_or_copy(input_path, output_path)
+        ffmpeg_code = plan.ffmpeg_code
+    report = _with_metrics(ffmpeg_code, on_progress)
+    started = time.monotonic()
+    success = False
+    two_pass = is_two_pass(ffmpeg_code)
+    workers = min(PARALLEL_ENCODE_WORKERS, limits.threads) if limits and limits.threads else PARALLEL_ENCODE_WORKERS
+    if PARALLEL_ENCODE and workers > 1 and not is_copy_only(ffmpeg_code) and not two_pass:
+        if duration and duration >= PARALLEL_ENCODE_MIN_DURATION and not can_segment(ffmpeg_code, probe):
+            LOGGER.info("Input streams or options need a single pass, not splitting the encode")
+        elif duration and duration >= PARALLEL_ENCODE_MIN_DURATION:
+            success = await compress_segmented(
+                input_path, output_path, ffmpeg_code, duration, workers=workers, on_progress=report, limits=limits,
+                audio=bool(probe['streams'].get('audio')), content_key=await input_key(input_path, source_key)
+            )
+            if not success:
+                LOGGER.warning("Segmented encode failed, retrying as a single encode")
+    if not success and two_pass:
+        success = await encode_two_pass(
+            input_path, output_path, ffmpeg_code, on_progress=report, duration=duration, limits=limits,
+            content_key=await input_key(input_path, source_key)
+        )
+    elif not success:
+        success = await encode_file(
+            input_path, output_path, ffmpeg_code, on_progress=report, duration=duration, limits=limits
+        )
+    if success:
+        encode_metrics.record_encode(preset_label(ffmpeg_code), duration, time.monotonic() - started)
+    return success
+
+async def _gather_or_cancel(*aws):
+    """Like asyncio.gather, but when one awaitable fails the others are cancelled and awaited first.
+
+    Cancelling an ffmpeg run kills its process, so nothing keeps writing into a directory the
+    caller is about to remove.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def link_or_copy(input_path, output_path):
+    """Make `output_path` the same file as `input_path`, hardlinked when the filesystem allows."""
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    try:
+        os.link(input_path, output_path)
+    except OSError:
+        shutil.copyfile(input_path, output_path)
+    return True
+
+async def encode_file(input_path, output_path, ffmpeg_code, on_progress=None, duration=None, limits=None):
+    if limits:
+        ffmpeg_code = limits.apply(ffmpeg_code)
     # Ensure the output path is set to overwrite
-    cmd = f'vegapunk -y -i "{input_path}" {ffmpeg_code} "{output_path}"'
+    returncode, stderr = await _run_ffmpeg(
+        f'-i "{input_path}" {ffmpeg_code} "{output_path}"', on_progress=on_progress, duration=duration,
+        limits=limits
+    )
+
+    if returncode != 0:
+        print(f"FFmpeg error: {stderr}")
+    return os.path.exists(output_path)
+
+async def encode_two_pass(input_path, output_path, ffmpeg_code, on_progress=None, duration=None, limits=None,
+                          content_key=None):
+    """Run both passes of a two-pass encode, skipping the first when the encode cache has its log."""
+    work_dir = f"{output_path}.passlog"
+    os.makedirs(work_dir, exist_ok=True)
+    passlog = os.path.join(work_dir, 'pass')
+    first_pass = first_pass_args(ffmpeg_code)
+    try:
+        content_key = content_key or await encode_cache.content_key(input_path)
+        key = encode_cache.key(content_key, 'passlog', code_hash(first_pass))
+        if await encode_cache.restore(key, work_dir):
+            LOGGER.info(f"Reusing the cached first pass for {os.path.basename(input_path)}")
+        else:
+            # The thread limit is left out of the cache key so limited and owner jobs share the log
+            limited = limits.apply(first_pass) if limits else first_pass
+            returncode, stderr = await _run_ffmpeg(
+                f'-i "{input_path}" {limited} -passlogfile "{passlog}" -f null /dev/null',
+                on_progress=on_progress, duration=duration, limits=limits
+            )
+            if returncode != 0:
+                LOGGER.error(f"FFmpeg first pass error: {stderr}")
+                return False
+            await encode_cache.store(key, [os.path.join(work_dir, name) for name in os.listdir(work_dir)])
+        return await encode_file(
+            input_path, output_path, f'{ffmpeg_code} -passlogfile "{passlog}"', on_progress=on_progress,
+            duration=duration, limits=limits
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+async def keyframe_index(path, content_key):
+    """Keyframe timestamps of the first video stream, from the encode cache when possible."""
+    key = encode_cache.key(content_key, 'keyframes')
+    cached = await encode_cache.read(key, 'keyframes.txt')
+    if cached is not None:
+        return [float(line) for line in cached.decode().splitlines() if line.strip()]
+    try:
+        # Packet flags are read without decoding, so this is far quicker than a decode pass
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+            "-of", "csv=p=0", path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    except OSError as e:
+        LOGGER.error(f"Failed to run ffprobe: {e}")
+        return None
+    if process.returncode != 0:
+        LOGGER.error(f"ffprobe keyframe scan failed: {stderr.decode(errors='replace').strip()}")
+        return None
+    keyframes = []
+    for line in stdout.decode(errors='replace').splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                keyframes.append(float(pts_time))
+            except ValueError:
+                continue
+    keyframes.sort()
+    await encode_cache.put(key, 'keyframes.txt', "".join(f"{t:.6f}\n" for t in keyframes).encode())
+    return keyframes
+
+def split_points(keyframes, duration, segment_seconds):
+    """Keyframes to cut at so segments are about `segment_seconds` long and none is tiny."""
+    points = []
+    target = segment_seconds
+    for time_ in keyframes:
+        if time_ >= target and duration - time_ >= MIN_SEGMENT_SECONDS / 2:
+            points.append(time_)
+            target = time_ + segment_seconds
+    return points
+
+async def compress_segmented(input_path, output_path, ffmpeg_code, duration, workers=PARALLEL_ENCODE_WORKERS,
+                             on_progress=None, limits=None, audio=True, content_key=None):
+    """Split the video stream at keyframes, encode the pieces in parallel and join them losslessly.
+
+    The audio stream is encoded once over the whole input, next to the video segments, and
+    muxed back in while the segments are joined, so it has no gaps at segment boundaries.
+    Pass `audio=False` for inputs without an audio stream.
+    Callers check `can_segment` first. Encoded segments and the audio track are kept in the
+    encode cache, so a retry of the same input and code only encodes what is missing.
+    """
+    work_dir = f"{output_path}.segments"
+    os.makedirs(work_dir, exist_ok=True)
+    ext = os.path.splitext(output_path)[1] or '.mp4'
+    video_args, audio_args, mux_args = split_stream_args(ffmpeg_code)
+    try:
+        # Aim for two segments per worker so a slow segment does not leave cores idle at the end
+        segment_seconds = max(MIN_SEGMENT_SECONDS, duration / (workers * 2))
+        content_key = content_key or await encode_cache.content_key(input_path)
+        keyframes = await keyframe_index(input_path, content_key)
+        points = split_points(keyframes, duration, segment_seconds) if keyframes else None
+        if points:
+            layout = ",".join(f"{point:.6f}" for point in points)
+            split = f'-segment_times {layout}'
+        else:
+            layout = f"every {segment_seconds:.0f}"
+            split = f'-segment_time {segment_seconds:.0f}'
+        returncode, stderr = await _run_ffmpeg(
+            f'-i "{input_path}" -map 0:v:0 -c copy -f segment '
+            f'{split} -reset_timestamps 1 "{work_dir}/source_%04d.mkv"', limits=limits
+        )
+        if returncode != 0:
+            LOGGER.error(f"FFmpeg split error: {stderr}")
+            return False
+        sources = sorted(name for name in os.listdir(work_dir) if name.startswith('source_'))
+        LOGGER.info(f"Encoding {len(sources)} segments with {workers} workers")
+
+        # One thread per process; options in the user's code still take precedence unless limited
+        threads = max(1, ((limits and limits.threads) or os.cpu_count() or 1) // workers)
+        segment_code = f"{video_args} -threads {threads}" if limits and limits.threads else video_args
+        semaphore = asyncio.Semaphore(workers)
+        latest = {}  # source -> last EncodeProgress of that segment
+        running = set()
+
+        async def report(source, event):
+            latest[source] = event
+            if on_progress:
+                # Throughput adds up across the segments that are encoding right now
+                await on_progress(EncodeProgress(
+                    out_time=sum(e.out_time for e in latest.values()),
+                    fps=sum(latest[s].fps for s in running if s in latest),
+                    speed=sum(latest[s].speed for s in running if s in latest),
+                    total_size=sum(e.total_size for e in latest.values()),
+                    duration=duration,
+                ))
+
+        async def encode_segment(source):
+            target = os.path.join(work_dir, source.replace('source_', 'encoded_').replace('.mkv', ext))
+            key = encode_cache.key(content_key, 'video-segment', f"{code_hash(video_args)}|{layout}|{source}")
+            if await encode_cache.restore(key, work_dir):
+                LOGGER.info(f"Reusing cached segment {source}")
+                return target
+            async with semaphore:
+                running.add(source)
+                try:
+                    returncode, stderr = await _run_ffmpeg(
+                        f'-i "{os.path.join(work_dir, source)}" -threads {threads} {segment_code} "{target}"',
+                        on_progress=lambda event: report(source, event), limits=limits
+                    )
+                finally:
+                    running.discard(source)
+            if returncode != 0:
+                raise RuntimeError(f"Segment {source} failed: {stderr}")
+            await encode_cache.store(key, [target])
+            return target
+
+        async def encode_audio():
+            target = os.path.join(work_dir, 'audio.mka')
+            key = encode_cache.key(content_key, 'audio', code_hash(audio_args))
+            if await encode_cache.restore(key, work_dir):
+                LOGGER.info("Reusing the cached audio track")
+                return target
+            returncode, stderr = await _run_ffmpeg(
+                f'-i "{input_path}" -map 0:a:0 -vn {audio_args} "{target}"', limits=limits
+            )
+            if returncode != 0:
+                raise RuntimeError(f"Audio encode failed: {stderr}")
+            await encode_cache.store(key, [target])
+            return target
+
+        has_audio = audio and '-an' not in shlex.split(audio_args)
+        try:
+            *targets, audio_path = await _gather_or_cancel(
+                *(encode_segment(source) for source in sources),
+                encode_audio() if has_audio else asyncio.sleep(0)
+            )
+        except RuntimeError as e:
+            LOGGER.error(str(e))
+            return False
+
+        list_path = os.path.join(work_dir, 'segments.txt')
+        with open(list_path, 'w') as f:
+            f.writelines(f"file '{os.path.abspath(target)}'\n" for target in targets)
+        audio_input, audio_map = (f'-i "{audio_path}"', '-map 1:a:0') if audio_path else ('', '')
+        returncode, stderr = await _run_ffmpeg(
+            f'-f concat -safe 0 -i "{list_path}" {audio_input} -map 0:v:0 {audio_map} -c copy {mux_args} "{output_path}"',
+            limits=limits
+        )
+        if returncode != 0:
+            LOGGER.error(f"FFmpeg concat error: {stderr}")
+            return False
+        return os.path.exists(output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def is_streamable(head):
+    """Guess from the first bytes of a file whether ffmpeg can decode it without seeking."""
+    if head[:4] == b'\x1a\x45\xdf\xa3' or head[:3] == b'FLV':
+        return True  # Matroska/WebM and FLV are written front to back
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:
+        return True  # MPEG-TS
+    if head[4:8] != b'ftyp':
+        return False
+
+    # MP4/MOV: only readable from a pipe when the moov atom comes before the media data
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], 'big')
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if size == 1 and offset + 16 <= len(head):
+            size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+async def _spool(head, chunks, path):
+    """Write the sniffed head and the rest of the stream to `path`."""
+    with open(path, 'wb') as f:
+        f.write(head)
+        async for chunk in chunks:
+            f.write(chunk)
+
+async def compress_stream(chunks, output_path, ffmpeg_code, spool_path, on_progress=None, limits=None,
+                          source_key=None):
+    """Encode an async byte stream by piping it into ffmpeg's stdin as it arrives.
+
+    Streams that need seeking (e.g. MP4 with the moov atom at the end) are written
+    to `spool_path` instead and compressed from disk; the caller removes that file.
+    """
+    try:
+        return await _compress_stream(chunks, output_path, ffmpeg_code, spool_path, on_progress, limits, source_key)
+    finally:
+        # Stop the source (e.g. a yt-dlp process) if ffmpeg gave up before it was exhausted
+        await chunks.aclose()
+
+async def _compress_stream(chunks, output_path, ffmpeg_code, spool_path, on_progress, limits, source_key):
+    head = b''
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= SNIFF_BYTES:
+            break
+
+    if is_adaptive(ffmpeg_code) or not is_streamable(head):
+        # Adaptive presets are planned from a probe, which needs the whole file
+        LOGGER.info("Input needs seeking, falling back to a staged encode")
+        await _spool(head, chunks, spool_path)
+        return await compress_video(
+            spool_path, output_path, ffmpeg_code, on_progress=on_progress, limits=limits, source_key=source_key
+        )
+
+    started = time.monotonic()
+    code = limits.apply(ffmpeg_code) if limits else ffmpeg_code
+    cmd = f'vegapunk -y -progress pipe:1 -nostats -i pipe:0 {code} "{output_path}"'
     process = await asyncio.create_subprocess_shell(
         cmd,
+        stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+        stderr=asyncio.subprocess.PIPE,
+        preexec_fn=limits.preexec if limits else None
     )
-    stdout, stderr = await process.communicate()
-    
+    # Drain stderr concurrently so a chatty ffmpeg never blocks on a full pipe
+    stderr_task = asyncio.create_task(process.stderr.read())
+    report = _with_metrics(ffmpeg_code, on_progress)
+    encoded = {'out_time': 0.0}
+
+    async def track(event):
+        encoded['out_time'] = event.out_time
+        await report(event)
+
+    # The input length is unknown on a pipe, so events carry no percentage or ETA
+    progress_task = asyncio.create_task(_read_progress(process.stdout, track, None))
+    try:
+        process.stdin.write(head)
+        await process.stdin.drain()
+        async for chunk in chunks:
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+        process.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        LOGGER.error("FFmpeg closed its input early")
+    except BaseException:
+        process.kill()
+        await process.wait()
+        stderr_task.cancel()
+        progress_task.cancel()
+        raise
+
+    stderr = await stderr_task
+    await progress_task
+    await process.wait()
     if process.returncode != 0:
-        print(f"FFmpeg error: {stderr.decode().strip()}")
+        LOGGER.error(f"FFmpeg error: {stderr.decode().strip()}")
+        return False
+    encode_metrics.record_encode(preset_label(ffmpeg_code), encoded['out_time'], time.monotonic() - started)
     return os.path.exists(output_path)
-
@@ -2,18 +2,21 @@ import os
 import logging
 import yt_dlp
 import asyncio
-from pyrogram.types import Message
-from config import DEFAULT_FFMPEG, DOWNLOADS_DIR, COOKIES_PATH
-from bot.utils.compressor import compress_video
-from bot.database.db_manager import Database
+import functools
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import COOKIES_PATH, MAX_CONCURRENT_EXTRACTIONS, MAX_CONCURRENT_DOWNLOADS, INFO_CACHE_SIZE, INFO_CACHE_TTL
+from bot.utils.formats import rank_formats, estimate_total_size
+from bot.utils.cache import InfoCache
+from bot.utils.status import status_editor
+from bot.utils.metrics import EXTRACT_SECONDS, DOWNLOAD_SPEED
 
 # Initialize logging
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Initialize the database
-db = Database()
-
 # Default yt-dlp options with cookies path
 ydl_opts = {
     'quiet': False,
@@ -29,114 +32,259 @@ ydl_opts = {
     'merge_output_format': 'mp4'
 }
 
-# Throttle decorator to limit function calls
-def throttle(rate_limit_seconds):
-    """Decorator to throttle function calls."""
-    def decorator(func):
-        last_called = [None]  # Use a list to hold the timestamp
-
-        async def wrapped(*args, **kwargs):
-            now = asyncio.get_event_loop().time()
-            if last_called[0] is None or (now - last_called[0] >= rate_limit_seconds):
-                last_called[0] = now
-                return await func(*args, **kwargs)
-        return wrapped
-    return decorator
-
-def _on_progress(status_msg, loop):
+def _cancel_hook(cancel_event):
+    """Returns a progress hook that aborts the download once `cancel_event` is set."""
+    def hook(d):
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Download cancelled by user")
+    return hook
+
+class DownloadEngine:
+    """Runs blocking yt-dlp extraction and downloads on bounded thread pools."""
+
+    def __init__(self, max_extractions=MAX_CONCURRENT_EXTRACTIONS, max_downloads=MAX_CONCURRENT_DOWNLOADS):
+        self.extract_pool = ThreadPoolExecutor(max_workers=max_extractions, thread_name_prefix="ytdl-extract")
+        self.download_pool = ThreadPoolExecutor(max_workers=max_downloads, thread_name_prefix="ytdl-download")
+
+    @staticmethod
+    def _extract(url, opts):
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    @staticmethod
+    def _download(url, opts, cancel_event):
+        # The job may have been cancelled while it was still waiting for a worker
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Cancelled before start")
+        opts = dict(opts)
+        opts['progress_hooks'] = list(opts.get('progress_hooks', [])) + [_cancel_hook(cancel_event)]
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            return ydl.download([url])
+
+    async def extract_info(self, url, opts):
+        """Run `extract_info` in the extraction pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        with EXTRACT_SECONDS.time():
+            return await loop.run_in_executor(self.extract_pool, functools.partial(self._extract, url, opts))
+
+    async def download(self, url, opts):
+        """Run a download in the download pool.
+
+        Cancelling the awaiting task also stops the yt-dlp thread at its next progress callback.
+        """
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        try:
+            return await loop.run_in_executor(
+                self.download_pool, functools.partial(self._download, url, opts, cancel_event)
+            )
+        except asyncio.CancelledError:
+            cancel_event.set()
+            LOGGER.info(f"Download of {url} cancelled")
+            raise
+
+    def shutdown(self):
+        """Drop queued work and release the worker threads."""
+        self.extract_pool.shutdown(wait=False, cancel_futures=True)
+        self.download_pool.shutdown(wait=False, cancel_futures=True)
+
+engine = DownloadEngine()
+info_cache = InfoCache(INFO_CACHE_SIZE, INFO_CACHE_TTL)  # The bot attaches its database when persistence is enabled
+
+def _on_progress(status_msg, loop, on_bytes=None):
     """Returns a function that acts as a progress hook for yt-dlp."""
     def hook(d):
         if d['status'] == 'finished':
             LOGGER.info("Download completed")
-            if status_msg:
-                asyncio.run_coroutine_threadsafe(status_msg.edit_text("Download completed successfully!"), loop)
+            status_editor.update_threadsafe(loop, status_msg, "Download completed successfully!")
         elif d['status'] == 'downloading':
-            download_speed = d.get('speed', 0)
             downloaded_bytes = d.get('downloaded_bytes', 0)
             total_bytes = d.get('total_bytes', d.get('total_bytes_estimate', 0))
+            if on_bytes:
+                on_bytes(downloaded_bytes, total_bytes)
             if total_bytes:
+                # Every chunk only replaces the pending text; the status editor decides when to send it
                 progress = downloaded_bytes / total_bytes * 100
-                LOGGER.info(f"Download progress: {progress:.2f}%")
-                if status_msg:
-                    asyncio.run_coroutine_threadsafe(
-                        update_progress(status_msg, progress),
-                        loop
-                    )
+                status_editor.update_threadsafe(loop, status_msg, f"Downloading... {progress:.2f}% completed")
 
     return hook
 
-async def get_video_formats(url):
-    """Extracts video formats from a URL using cookies."""
+async def get_video_info(url):
+    """Returns the (slimmed) info dict for a URL, extracting it only on a cache miss."""
+    return await info_cache.get(url, lambda: engine.extract_info(url, ydl_opts))
+
+def is_playlist_url(url):
+    """Whether a URL points at a playlist or channel rather than a single video."""
+    return 'list=' in url or '/playlist' in url or '/channel/' in url or '/@' in url
+
+async def extract_entries(url):
+    """Lists the videos of a playlist with one flat extraction; returns [{'url', 'title'}]."""
+    opts = dict(ydl_opts, extract_flat='in_playlist', quiet=True)
+    info = await engine.extract_info(url, opts)
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return [{'url': info.get('webpage_url') or url, 'title': info.get('title') or url}]
+    return [
+        {'url': entry.get('url') or entry.get('webpage_url'), 'title': entry.get('title') or entry.get('id')}
+        for entry in info.get('entries') or []
+        if entry and (entry.get('url') or entry.get('webpage_url'))
+    ]
+
+def select_format(info, max_height=None, ffmpeg_code=None):
+    """Id of the best video format no taller than `max_height` (any height when not given), or None.
+
+    Among formats of the chosen height the one ranked best for `ffmpeg_code` wins.
+    """
+    ranked = [f for f in rank_formats(info, ffmpeg_code, min_height=1) if not max_height or f['resolution'] <= max_height]
+    if ranked:
+        return ranked[-1]['format_id']
+    # Formats without a height (e.g. direct links) are compared by bitrate and size alone
+    candidates = [
+        f for f in info.get('formats', [])
+        if f.get('vcodec') != 'none' and (not max_height or (f.get('height') or 0) <= max_height)
+    ]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda f: (
+        f.get('height') or 0, f.get('tbr') or 0, f.get('filesize') or f.get('filesize_approx') or 0
+    ))
+    return best.get('format_id')
+
+async def get_video_formats(url, ffmpeg_code=None):
+    """Extracts video formats from a URL using cookies, one per height ranked for `ffmpeg_code`."""
     try:
-        global ydl_opts
-        # Ensure cookies are used in get_video_formats
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = [
-                {
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext'),
-                    'resolution': f.get('height'),
-                    'fps': f.get('fps', 'N/A'),
-                }
-                for f in info.get('formats', [])
-                if f.get('vcodec') != 'none' and (f.get('height', 0) >= 360) and (f.get('filesize') is not None and f.get('filesize') > 0)
-            ]
-
-            title = info.get('title', 'No title available')
-            LOGGER.info("Formats extracted successfully")
-
-            # Log available formats for the bot's response
-            formatted_formats = [f"{fmt['resolution']}p ({fmt['ext']}, {fmt['fps']} FPS)" for fmt in formats]
-            LOGGER.info(f"Available formats: {', '.join(formatted_formats)}")
-
-            return formats, title
+        info = await get_video_info(url)
+        formats = rank_formats(info, ffmpeg_code)
+
+        title = info.get('title', 'No title available')
+        LOGGER.info("Formats extracted successfully")
+
+        # Log available formats for the bot's response
+        formatted_formats = [f"{fmt['resolution']}p ({fmt['vcodec']}, {fmt['fps']} FPS)" for fmt in formats]
+        LOGGER.info(f"Available formats: {', '.join(formatted_formats)}")
+
+        return formats, title
     except Exception as e:
         LOGGER.error(f"Error fetching video formats: {e}")
         return [], "Error"
 
-@throttle(5)  # Throttle updates to every 5 seconds
-async def update_progress(status_msg: Message, progress: float):
-    """Update progress message in a throttled manner."""
-    try:
-        if status_msg:
-            await status_msg.edit_text(f"Downloading... {progress:.2f}% completed")
-    except Exception as e:
-        if "MESSAGE_ID_INVALID" in str(e):
-            LOGGER.error("Failed to update progress: The message ID is invalid. It may have been deleted or expired.")
-        else:
-            LOGGER.error(f"Failed to update progress: {e}")
+def format_selector(format_id):
+    """yt-dlp format expression for a chosen format; formats without audio get the best audio merged in.
+
+    A format that already has audio is selected alone, as yt-dlp keeps one audio stream.
+    """
+    return f"{format_id}+bestaudio/best"
 
-async def download_video(url, format_id, output_path, status_msg):
-    """Downloads video based on a specified format_id using cookies."""
+async def download_video(url, format_id, output_path, status_msg, on_bytes=None, faststart=False):
+    """Downloads video based on a specified format_id using cookies.
+
+    Interrupted downloads leave `.part` files next to `output_path`; calling this again with
+    the same path continues them with range requests. `on_bytes(downloaded, total)` is
+    called from the download thread. With `faststart` the result is remuxed to MP4 with the
+    index at the front inside yt-dlp's own merge or remux step, so it can be sent as is.
+    """
     try:
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
 
         download_opts = {
-            'format': f"{format_id}+bestaudio/best",
+            'format': format_selector(format_id),
             'outtmpl': output_path,
             'quiet': False,
             'no_warnings': True,
             'cookies': COOKIES_PATH,  # Ensures cookies path is resolved
             'logger': LOGGER,
-            'progress_hooks': [_on_progress(status_msg, loop)],
-            'merge_output_format': 'mp4'
+            'progress_hooks': [_on_progress(status_msg, loop, on_bytes)],
+            'merge_output_format': 'mp4',
+            'continuedl': True,
+            'nopart': False
         }
+        if faststart:
+            # The remuxer derives its output name from the source extension, so let yt-dlp pick it
+            download_opts['outtmpl'] = f"{os.path.splitext(output_path)[0]}.%(ext)s"
+            download_opts['postprocessors'] = [{'key': 'FFmpegVideoRemuxer', 'preferedformat': 'mp4'}]
+            download_opts['postprocessor_args'] = {
+                'merger': ['-movflags', '+faststart'],
+                'videoremuxer': ['-movflags', '+faststart'],
+            }
 
-        with yt_dlp.YoutubeDL(download_opts) as ydl:
-            ydl.download([url])
-            LOGGER.info("Download completed successfully")
+        started = time.monotonic()
+        await engine.download(url, download_opts)
+        LOGGER.info("Download completed successfully")
 
-            if os.path.exists(output_path):
-                LOGGER.info(f"Output file exists: {output_path}")
-                return True
-            else:
-                LOGGER.error("Output path does not exist after download.")
-                return False
+        if os.path.exists(output_path):
+            LOGGER.info(f"Output file exists: {output_path}")
+            elapsed = time.monotonic() - started
+            if elapsed > 0:
+                DOWNLOAD_SPEED.observe(os.path.getsize(output_path) / 1024 / 1024 / elapsed, source="youtube")
+            return True
+        else:
+            LOGGER.error("Output path does not exist after download.")
+            return False
+    except yt_dlp.utils.DownloadCancelled as e:
+        LOGGER.info(f"Download cancelled: {e}")
+        return False
     except yt_dlp.DownloadError as e:
         LOGGER.error(f"Download error: {e}")
         return False
     except Exception as e:
         LOGGER.error(f"Unexpected error: {e}")
         return False
+
+# Protocols yt-dlp can write to stdout without a separate merge step
+STREAM_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def get_format(info, format_id):
+    """Returns the format entry with the given id from an info dict, or None."""
+    return next((f for f in info.get('formats', []) if f.get('format_id') == format_id), None)
+
+def estimate_size(info, format_id):
+    """Expected download size in bytes of a format plus the best audio merged into it, or None."""
+    fmt = get_format(info, format_id)
+    if fmt is None:
+        return None
+    return estimate_total_size(info, fmt)
+
+def can_stream(info, format_id):
+    """Whether a format can be piped straight into ffmpeg instead of being downloaded first."""
+    fmt = get_format(info, format_id)
+    if fmt is None:
+        return False
+    has_audio = fmt.get('acodec') not in (None, 'none')
+    has_video = fmt.get('vcodec') not in (None, 'none')
+    return has_audio and has_video and fmt.get('protocol') in STREAM_PROTOCOLS
+
+async def stream_video(url, format_id, status_msg, total_bytes=None):
+    """Yields the bytes of a single-file format as yt-dlp downloads it."""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'yt_dlp',
+        # The same expression as a staged download, so both produce the same file for a result key
+        '-f', format_selector(format_id),
+        '-o', '-',
+        '--quiet', '--no-warnings', '--no-part',
+        '--cookies', COOKIES_PATH,
+        url,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+    received = 0
+    try:
+        while True:
+            chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if total_bytes and status_msg:
+                status_editor.update(status_msg, f"Downloading... {min(received / total_bytes * 100, 100):.2f}% completed")
+            yield chunk
+        await process.wait()
+        if process.returncode != 0:
+            stderr = await stderr_task
+            raise yt_dlp.DownloadError(stderr.decode().strip() or "yt-dlp exited with an error")
+        LOGGER.info(f"Streamed {received} bytes from {url}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from config import ENCODE_CACHE_DIR, ENCODE_CACHE_MAX_BYTES
+
+LOGGER = logging.getLogger(__name__)
+
+HASH_CHUNK = 1024 * 1024
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entry_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ArtifactCache:
+    """Bounded LRU disk cache for encode artifacts keyed by input content.
+
+    Each entry is a directory of files (a two-pass log, a keyframe index, an encoded
+    segment, ...). Entries are hardlinked in and out, so a hit costs no copying, and the
+    least recently used entries are removed once the cache outgrows `max_bytes`.
+
+    Sizes and last use are tracked in memory, so storing and eviction never walk the cache
+    directory; `load` fills that index from disk once at startup. With `db` set the index
+    lives in the shared database instead, so worker processes sharing the directory
+    enforce one limit together. Another process may evict an entry at any time, so a
+    failed read of an entry counts as a miss.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+        self.index = {}  # entry directory -> [last used, bytes], when there is no db
+
+    async def load(self):
+        """Index the entries already on disk, e.g. from an earlier run, and evict down to the limit."""
+        entries = await asyncio.to_thread(self._scan)
+        if self.db is None:
+            for directory, entry in entries.items():
+                self.index.setdefault(directory, entry)
+        else:
+            await self.db.add_cache_entries(
+                [(directory, size, last_used) for directory, (last_used, size) in entries.items()]
+            )
+        await self.evict()
+        LOGGER.info(f"Encode cache holds {len(await self._entries())} entries")
+
+    async def content_key(self, path):
+        """Identify a file by a hash of its whole content, so renamed copies share entries."""
+        return await asyncio.to_thread(_file_hash, path)
+
+    def source_key(self, source):
+        """Identify an input by where it came from, e.g. a Telegram file or a YouTube format."""
+        return hashlib.sha256(f"source|{source}".encode()).hexdigest()
+
+    @staticmethod
+    def key(content_key, kind, params=""):
+        return hashlib.sha1(f"{content_key}|{kind}|{params}".encode()).hexdigest()
+
+    def directory(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    async def lookup(self, key):
+        """Return the entry directory for `key` and mark it as recently used, or None."""
+        directory = self.directory(key)
+        if not self.max_bytes or not os.path.isdir(directory):
+            self.misses += 1
+            await self._forget(directory)
+            return None
+        try:
+            os.utime(directory)
+        except OSError:
+            # Evicted by another process just now
+            self.misses += 1
+            await self._forget(directory)
+            return None
+        await self._touch(directory)
+        self.hits += 1
+        return directory
+
+    async def restore(self, key, destination_dir):
+        """Link every file of an entry into `destination_dir`; returns whether there was an entry."""
+        directory = await self.lookup(key)
+        if directory is None:
+            return False
+        try:
+            await asyncio.to_thread(self._link_all, directory, destination_dir)
+        except OSError as e:
+            LOGGER.warning(f"Encode cache entry {key} vanished while restoring it: {e}")
+            self._lost_hit()
+            return False
+        return True
+
+    async def read(self, key, name):
+        """Return the content of file `name` of an entry, or None."""
+        directory = await self.lookup(key)
+        if directory is None:
+            return None
+        try:
+            return await asyncio.to_thread(_read_file, os.path.join(directory, name))
+        except OSError as e:
+            LOGGER.warning(f"Encode cache entry {key} vanished while reading it: {e}")
+            self._lost_hit()
+            return None
+
+    def _lost_hit(self):
+        self.hits -= 1
+        self.misses += 1
+
+    @staticmethod
+    def _link_all(directory, destination_dir):
+        for name in os.listdir(directory):
+            target = os.path.join(destination_dir, name)
+            if os.path.exists(target):
+                os.remove(target)
+            _link(os.path.join(directory, name), target)
+
+    async def store(self, key, paths):
+        """Add the files in `paths` as one entry, replacing any older entry with the same key."""
+        def fill(staging):
+            for path in paths:
+                _link(path, os.path.join(staging, os.path.basename(path)))
+        await self._commit(key, fill)
+
+    async def put(self, key, name, data):
+        """Add `data` (bytes) as an entry holding the single file `name`."""
+        def fill(staging):
+            with open(os.path.join(staging, name), 'wb') as f:
+                f.write(data)
+        await self._commit(key, fill)
+
+    async def _commit(self, key, fill):
+        if not self.max_bytes:
+            return
+        directory = self.directory(key)
+        try:
+            # Copying across filesystems and removing an old entry can take long for big segments
+            size = await asyncio.to_thread(self._replace, directory, fill)
+        except OSError as e:
+            LOGGER.error(f"Failed to cache {key}: {e}")
+            return
+        await self._record(directory, size)
+        await self.evict()
+
+    @staticmethod
+    def _replace(directory, fill):
+        staging = f"{directory}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(staging, exist_ok=True)
+            fill(staging)
+            size = _entry_size(staging)
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(staging, directory)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return size
+
+    def _scan(self):
+        entries = {}
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            for name in os.listdir(os.path.join(self.root, prefix)):
+                directory = os.path.join(self.root, prefix, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    entries[directory] = [os.stat(directory).st_mtime, _entry_size(directory)]
+                except OSError:
+                    continue
+        return entries
+
+    async def _entries(self):
+        if self.db is None:
+            return self.index
+        return {directory: [last_used, size] for directory, size, last_used in await self.db.get_cache_entries()}
+
+    async def _touch(self, directory):
+        if self.db is None:
+            self.index.setdefault(directory, [0, 0])[0] = time.time()
+        else:
+            await self.db.touch_cache_entry(directory, time.time())
+
+    async def _record(self, directory, size):
+        if self.db is None:
+            self.index[directory] = [time.time(), size]
+        else:
+            await self.db.add_cache_entries([(directory, size, time.time())], replace=True)
+
+    async def _forget(self, *directories):
+        if self.db is None:
+            for directory in directories:
+                self.index.pop(directory, None)
+        else:
+            await self.db.delete_cache_entries(directories)
+
+    async def evict(self):
+        """Remove least recently used entries until the cache fits in `max_bytes`."""
+        entries = await self._entries()
+        total = sum(size for _, size in entries.values())
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for directory, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            victims.append(directory)
+            total -= size
+        await self._forget(*victims)
+        await asyncio.to_thread(_remove_all, victims)
+        for directory in victims:
+            LOGGER.info(f"Evicted encode cache entry {os.path.basename(directory)}")
+
+    async def stats(self):
+        entries = await self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size in entries.values()),
+        }
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _remove_all(directories):
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+encode_cache = ArtifactCache(ENCODE_CACHE_DIR, ENCODE_CACHE_MAX_BYTES)
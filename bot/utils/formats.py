@@ -0,0 +1,84 @@
+import logging
+from bot.utils.compressor import is_copy_only
+from bot.utils.presets import is_adaptive
+
+LOGGER = logging.getLogger(__name__)
+
+# Shortest format offered in the /yl keyboard
+MIN_HEIGHT = 360
+# Video codecs from most to least efficient; a smaller download at the same height
+CODEC_EFFICIENCY = ('av1', 'vp9', 'hevc', 'h264')
+# Codecs a copy into the bot's mp4 output keeps playable in Telegram, best first
+COPYABLE_CODECS = ('h264', 'hevc')
+
+
+def codec_family(vcodec):
+    """Map a yt-dlp codec string such as 'avc1.64001F' or 'vp09.00.40.08' to a family name."""
+    vcodec = (vcodec or '').lower()
+    for prefix, family in (('avc', 'h264'), ('h264', 'h264'), ('hev', 'hevc'), ('hvc', 'hevc'),
+                           ('h265', 'hevc'), ('vp09', 'vp9'), ('vp9', 'vp9'), ('av01', 'av1'), ('av1', 'av1')):
+        if vcodec.startswith(prefix):
+            return family
+    return vcodec or None
+
+
+def estimate_format_size(fmt, duration):
+    """Bytes of one format from its size fields, or from its bitrate and the video duration."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    bitrate = fmt.get('tbr') or ((fmt.get('vbr') or 0) + (fmt.get('abr') or 0))
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+
+def estimate_total_size(info, fmt):
+    """Bytes downloaded for a format, including the best audio merged into a video-only format."""
+    size = estimate_format_size(fmt, info.get('duration'))
+    if size is None:
+        return None
+    if fmt.get('acodec') in (None, 'none'):
+        size += max((
+            estimate_format_size(f, info.get('duration')) or 0
+            for f in info.get('formats', [])
+            if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+        ), default=0)
+    return size
+
+
+def prefers_copy(ffmpeg_code):
+    """Whether the user's code may keep the source video stream, so copyable codecs save an encode."""
+    return bool(ffmpeg_code) and (is_copy_only(ffmpeg_code) or is_adaptive(ffmpeg_code))
+
+
+def rank_formats(info, ffmpeg_code=None, min_height=MIN_HEIGHT):
+    """One format per height, lowest first, each with its estimated download size.
+
+    Per height the format whose codec `ffmpeg_code` can copy wins when it copies streams,
+    otherwise the most efficient codec; ties go to the higher bitrate.
+    """
+    copy = prefers_copy(ffmpeg_code)
+    best = {}
+    for f in info.get('formats', []):
+        height = f.get('height') or 0
+        if f.get('vcodec') == 'none' or height < min_height:
+            continue
+        family = codec_family(f.get('vcodec'))
+        candidate = {
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'resolution': height,
+            'fps': f.get('fps') or 'N/A',
+            'vcodec': family,
+            'size': estimate_total_size(info, f),
+            'copyable': family in COPYABLE_CODECS,
+        }
+        if copy:
+            preference = COPYABLE_CODECS.index(family) if family in COPYABLE_CODECS else len(COPYABLE_CODECS)
+        else:
+            preference = CODEC_EFFICIENCY.index(family) if family in CODEC_EFFICIENCY else len(CODEC_EFFICIENCY)
+        key = (preference, -(f.get('tbr') or 0))
+        if height not in best or key < best[height][0]:
+            best[height] = (key, candidate)
+    return [best[height][1] for height in sorted(best)]
@@ -0,0 +1,106 @@
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from bot.utils.helpers import format_size
+
+LOGGER = logging.getLogger(__name__)
+
+
+def usage_day(timestamp=None):
+    """UTC date that usage is counted against, e.g. '2024-05-01'."""
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+class QuotaExceeded(Exception):
+    """The user has used up today's byte budget."""
+
+
+class ResourceLimits:
+    """CPU limits applied to the ffmpeg processes of one job; None or 0 means no limit."""
+
+    def __init__(self, threads=None, nice=0):
+        self.threads = threads
+        self.nice = nice
+
+    def apply(self, ffmpeg_code):
+        """Append `-threads`, which wins over any thread count in the user's own arguments."""
+        return f"{ffmpeg_code} -threads {self.threads}" if self.threads else ffmpeg_code
+
+    def preexec(self):
+        """Runs in the forked child before ffmpeg starts; children of the shell inherit it."""
+        if self.nice:
+            os.nice(self.nice)
+
+
+class ResourceGovernor:
+    """Per-user budgets: ffmpeg threads and priority, running-job caps and daily byte quotas.
+
+    Owners bypass every limit and get the priority lane in the stage queues.
+    """
+
+    def __init__(self, db, owners, threads, nice, max_jobs, daily_bytes):
+        self.db = db
+        self.owners = frozenset(owners)
+        self.threads = threads
+        self.nice = nice
+        self.max_jobs = max_jobs
+        self.daily_bytes = daily_bytes
+
+    def is_owner(self, user_id):
+        return user_id in self.owners
+
+    def limits(self, user_id):
+        """ResourceLimits for the ffmpeg processes of a user's job."""
+        if self.is_owner(user_id):
+            return ResourceLimits()
+        # Each job is capped on its own; the kernel spreads the jobs over all cores
+        return ResourceLimits(self.threads or None, self.nice)
+
+    def job_cap(self, user_id):
+        """Jobs the user may have running at once, or None for no cap."""
+        return None if self.is_owner(user_id) or not self.max_jobs else self.max_jobs
+
+    async def check_quota(self, user_id):
+        """Return why the user may not start more work today, or None if they may."""
+        if self.is_owner(user_id) or not self.daily_bytes:
+            return None
+        used = await self.used_today(user_id)
+        return self._refusal(used) if used >= self.daily_bytes else None
+
+    def _refusal(self, used):
+        return (f"Daily limit reached: {format_size(used)} of {format_size(self.daily_bytes)} used. "
+                "It resets at 00:00 UTC.")
+
+    @asynccontextmanager
+    async def reserve(self, user_id, nbytes):
+        """Book a starting job's estimated bytes against today's usage while the block runs.
+
+        Raises QuotaExceeded if the budget is already used up. The check and the booking are a
+        single statement on the usage table, so jobs that start in other processes see it, and
+        it is refunded on exit; the job charges what it really used before that.
+        """
+        if self.is_owner(user_id) or not self.daily_bytes:
+            yield
+            return
+        day = usage_day()
+        if not await self.db.book_usage(user_id, day, nbytes, self.daily_bytes):
+            raise QuotaExceeded(self._refusal(await self.used_today(user_id)))
+        try:
+            yield
+        finally:
+            try:
+                await self.db.add_usage(user_id, day, -nbytes, 0, 0.0, jobs=0)
+            except Exception as e:
+                LOGGER.error(f"Failed to refund the reservation of user {user_id}: {e}")
+
+    async def used_today(self, user_id):
+        row = await self.db.get_usage(user_id, usage_day())
+        return (row[1] + row[2]) if row else 0
+
+    async def charge(self, user_id, bytes_in=0, bytes_out=0, seconds=0.0):
+        """Count one finished job against the user's usage for today."""
+        try:
+            await self.db.add_usage(user_id, usage_day(), bytes_in, bytes_out, seconds)
+        except Exception as e:
+            LOGGER.error(f"Failed to record usage for user {user_id}: {e}")
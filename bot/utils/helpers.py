@@ -1,9 +1,11 @@
 import os
+import asyncio
+import json
 import logging
+from collections import Counter
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-import subprocess
 import time
-from config import DOWNLOADS_DIR
+from bot.utils.status import status_editor
 
 # Initialize logger with custom format
 LOGGER = logging.getLogger(__name__)
@@ -12,8 +14,11 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
 )
 
-def create_format_buttons(formats):
-    """Creates an inline keyboard with video format options in two-column layout."""
+def create_format_buttons(formats, token):
+    """Creates an inline keyboard with video format options in two-column layout.
+
+    `token` names the callback session that holds the URL the formats belong to.
+    """
     buttons = []
     row = []
     for format in formats:
@@ -21,10 +26,12 @@ def create_format_buttons(formats):
         resolution = format['resolution']
         ext = format['ext']
         fps = format.get('fps', 'N/A')  # Default to 'N/A' if fps is not available
-        
-        # Create a button with resolution, format, and fps
+
+        # Create a button with resolution, format, fps and the estimated download size
         button_label = f"{resolution} ({ext}, {fps} FPS)"
-        row.append(InlineKeyboardButton(button_label, callback_data=f"dl_{format_id}"))
+        if format.get('size'):
+            button_label += f" ~{format_size(format['size'])}"
+        row.append(InlineKeyboardButton(button_label, callback_data=f"dl_{token}_{format_id}"))
 
         # Add the row to buttons every two buttons
         if len(row) == 2:
@@ -37,6 +44,17 @@ def create_format_buttons(formats):
 
     return InlineKeyboardMarkup(buttons)
 
+# Quality choices offered for a batch; 0 means the best available
+BATCH_QUALITIES = (0, 1080, 720, 480, 360)
+
+def create_quality_buttons(token):
+    """Creates an inline keyboard choosing one maximum height for every video of a batch."""
+    buttons = [
+        InlineKeyboardButton("Best" if height == 0 else f"Best ≤{height}p", callback_data=f"batch_{token}_{height}")
+        for height in BATCH_QUALITIES
+    ]
+    return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
 def format_size(size_bytes):
     """Convert a file size in bytes into a human-readable string."""
     if size_bytes is None or size_bytes < 0:
@@ -48,55 +66,115 @@ def format_size(size_bytes):
         size_bytes /= 1024
     return f"{size_bytes:.2f} PB"
 
-def clean_files(*files):
-    """Remove specified files if they exist."""
-    for file in files:
-        try:
-            if os.path.exists(file):
-                if os.path.isfile(file):
-                    os.remove(file)
-                    LOGGER.info(f"Deleted file: {file}")
-                else:
-                    LOGGER.warning(f"Skipped deletion. {file} is a directory.")
-            else:
-                LOGGER.info(f"File not found and skipped: {file}")
-        except Exception as e:
-            LOGGER.error(f"Failed to delete file {file}: {e}")
-
-async def progress(current, total, message, text="Downloading", last_update=None):
-    """Update progress message with current download percentage."""
+def format_duration(seconds):
+    """Convert a number of seconds into a short string such as '1h 02m' or '3m 05s'."""
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+async def progress(current, total, message, text="Downloading", started=None):
+    """Queue the current percentage for `message`; the status editor rate-limits the edits.
+
+    With `started` (a time.monotonic() value) the transfer rate is shown as well.
+    """
+    if not total:
+        return
+    line = f"{current * 100 / total:.1f}% completed"
+    elapsed = time.monotonic() - started if started is not None else 0
+    if elapsed > 0:
+        line += f" at {current / 1024 / 1024 / elapsed:.2f} MB/s"
+    status_editor.update(message, f"{text}\n{line}")
+
+async def track_progress(chunks, total, message, text="Downloading"):
+    """Pass an async byte stream through while reporting progress on `message`."""
+    current = 0
     try:
-        if last_update is None:
-            last_update = time.time()  # Set last_update to current time if it's None
-        
-        percent = current * 100 / total
-        current_time = time.time()
-        
-        # Update progress message every 5 seconds
-        if current_time - last_update >= 5:
-            await message.edit_text(
-                text=f"{text}\n{percent:.1f}% completed"
-            )
-            return current_time  # Return the current time as the new last_update
-        return last_update  # Return the original last_update if no update occurred
+        async for chunk in chunks:
+            current += len(chunk)
+            if total:
+                await progress(min(current, total), total, message, text)
+            yield chunk
+    finally:
+        await chunks.aclose()
 
-    except Exception as e:
-        LOGGER.error(f"Failed to update progress: {e}")
-
-async def get_video_duration(video_path):
-    result = subprocess.run(
-        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", video_path],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    return round(float(result.stdout)) if result.returncode == 0 else None
-
-async def take_screenshot(path):
-    """Capture a screenshot from the video and save it as thumb.jpg in DOWNLOADS_DIR."""
-    thumb_path = os.path.join(DOWNLOADS_DIR, "thumb.jpg")
+def _to_number(value, cast=float):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+def _frame_rate(value):
+    """Parse an ffprobe rate such as '30000/1001'."""
+    numerator, _, denominator = (value or '').partition('/')
+    numerator, denominator = _to_number(numerator), _to_number(denominator or 1)
+    return numerator / denominator if numerator and denominator else None
+
+async def probe_media(path):
+    """Probe a media file once for duration, dimensions, codecs and bitrate.
+
+    Returns a dict, or None if ffprobe cannot read the file.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    except OSError as e:
+        LOGGER.error(f"Failed to run ffprobe: {e}")
+        return None
+    if process.returncode != 0:
+        LOGGER.error(f"ffprobe failed for {path}: {stderr.decode(errors='replace').strip()}")
+        return None
+
+    data = json.loads(stdout or b'{}')
+    streams = data.get('streams', [])
+    fmt = data.get('format', {})
+    video = next((st for st in streams if st.get('codec_type') == 'video'), {})
+    audio = next((st for st in streams if st.get('codec_type') == 'audio'), {})
+    return {
+        'duration': _to_number(fmt.get('duration')) or _to_number(video.get('duration')),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'fps': _frame_rate(video.get('avg_frame_rate')) or _frame_rate(video.get('r_frame_rate')),
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name'),
+        'bitrate': _to_number(fmt.get('bit_rate'), int),
+        'video_bitrate': _to_number(video.get('bit_rate'), int),
+        'size': _to_number(fmt.get('size'), int),
+        'format_name': fmt.get('format_name'),
+        'has_subtitles': any(st.get('codec_type') == 'subtitle' for st in streams),
+        'streams': dict(Counter(st.get('codec_type') for st in streams)),  # e.g. {'video': 1, 'audio': 2}
+    }
+
+async def take_screenshot(path, thumb_path=None, duration=None):
+    """Capture a frame from the video as a JPEG thumbnail.
+
+    The thumbnail is written next to the video unless `thumb_path` is given, so
+    concurrent jobs never share one file. Returns the path, or None on failure.
+    """
+    thumb_path = thumb_path or f"{os.path.splitext(path)[0]}_thumb.jpg"
+    # One second in, unless the clip is shorter than two seconds
+    offset = min(1.0, duration / 2) if duration else 1.0
     try:
-        subprocess.call(["ffmpeg", "-i", path, "-ss", "00:00:01.000", "-vframes", "1", thumb_path])
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-v", "error", "-ss", f"{offset:.3f}", "-i", path,
+            "-vframes", "1", "-vf", "scale='min(320,iw)':-2", thumb_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0 or not os.path.exists(thumb_path):
+            LOGGER.error(f"Failed to take screenshot: {stderr.decode(errors='replace').strip()}")
+            return None
         LOGGER.info(f"Screenshot taken and saved to {thumb_path}")
     except Exception as e:
         LOGGER.error(f"Failed to take screenshot: {e}")
+        return None
     return thumb_path
@@ -0,0 +1,212 @@
+import asyncio
+import bisect
+import functools
+import logging
+import shlex
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+
+def preset_label(ffmpeg_code):
+    """Short label such as 'libx264/veryfast' identifying the video codec and preset in use."""
+    try:
+        args = shlex.split(ffmpeg_code)
+    except ValueError:
+        return "custom"
+    options = dict(zip(args, args[1:]))
+    codec = options.get('-c:v') or options.get('-vcodec') or options.get('-c') or 'default'
+    if codec == 'copy':
+        return 'copy'
+    return f"{codec}/{options.get('-preset', 'default')}"
+
+
+class EncodeMetrics:
+    """Collects encode progress events and finished encodes per preset label."""
+
+    def __init__(self):
+        self.samples = defaultdict(lambda: {'events': 0, 'speed_sum': 0.0, 'fps_sum': 0.0})
+        self.encodes = defaultdict(lambda: {'count': 0, 'media_seconds': 0.0, 'wall_seconds': 0.0})
+
+    def observe(self, label, event):
+        """Record one progress event."""
+        if not event.speed:
+            return
+        sample = self.samples[label]
+        sample['events'] += 1
+        sample['speed_sum'] += event.speed
+        sample['fps_sum'] += event.fps
+
+    def record_encode(self, label, media_seconds, wall_seconds):
+        """Record a finished encode of `media_seconds` of video that took `wall_seconds`."""
+        encode = self.encodes[label]
+        encode['count'] += 1
+        encode['media_seconds'] += media_seconds or 0
+        encode['wall_seconds'] += wall_seconds
+        if media_seconds and wall_seconds:
+            ENCODE_SPEED.observe(media_seconds / wall_seconds, preset=label)
+        LOGGER.info(f"Encode with {label}: {media_seconds}s of media in {wall_seconds:.1f}s")
+
+    def summary(self):
+        """Per-label encode count, overall x-realtime throughput and mean sampled fps."""
+        result = {}
+        for label in set(self.samples) | set(self.encodes):
+            sample = self.samples.get(label) or {'events': 0, 'fps_sum': 0.0}
+            encode = self.encodes.get(label) or {'count': 0, 'media_seconds': 0.0, 'wall_seconds': 0.0}
+            result[label] = {
+                'encodes': encode['count'],
+                'speed': encode['media_seconds'] / encode['wall_seconds'] if encode['wall_seconds'] else None,
+                'fps': sample['fps_sum'] / sample['events'] if sample['events'] else None,
+            }
+        return result
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    """Prometheus-style histogram with cumulative buckets, per label set."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self.series = {}  # sorted label items -> [bucket counts, sum, count]
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager observing the seconds its block took."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose current values come from a callback returning a number or {labels: value}."""
+
+    def __init__(self, name, help_text, callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def set_function(self, callback):
+        self.callback = callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if self.callback is None:
+            return lines
+        try:
+            values = self.callback()
+        except Exception as e:
+            LOGGER.error(f"Failed to collect {self.name}: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+
+def timed(histogram, **labels):
+    """Decorator observing how long each call of an async function takes."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _serve_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+            pass  # Headers are not needed
+        parts = request_line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port):
+    """Serve `/metrics` over HTTP; returns the asyncio server."""
+    server = await asyncio.start_server(_serve_request, host, port)
+    LOGGER.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
+
+
+REGISTRY = []
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+MB_PER_SECOND_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200)
+
+EXTRACT_SECONDS = Histogram("bot_extract_seconds", "yt-dlp info extraction latency", SECONDS_BUCKETS)
+DOWNLOAD_SPEED = Histogram("bot_download_mb_per_second", "Download throughput per file", MB_PER_SECOND_BUCKETS)
+ENCODE_SPEED = Histogram(
+    "bot_encode_speed_ratio", "Encode speed as a multiple of realtime", (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+UPLOAD_SPEED = Histogram("bot_upload_mb_per_second", "Upload throughput per file", MB_PER_SECOND_BUCKETS)
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Database statement latency", SECONDS_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram("bot_queue_wait_seconds", "Time jobs waited for a stage slot", SECONDS_BUCKETS)
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Telegram update handler latency", SECONDS_BUCKETS)
+ACTIVE_JOBS = Gauge("bot_active_jobs", "Jobs running or waiting for a stage slot")
+STAGE_JOBS = Gauge("bot_stage_jobs", "Jobs holding or waiting for a stage slot")
+DISK_BYTES = Gauge("bot_disk_bytes", "Free and reserved bytes of the download volume")
+
+encode_metrics = EncodeMetrics()
@@ -0,0 +1,225 @@
+import asyncio
+import inspect
+import logging
+import os
+import time
+from pyrogram import raw
+from pyrogram.errors import FloodWait, FilePartMissing, InternalServerError
+from pyrogram.file_id import FileId
+from bot.utils.metrics import DOWNLOAD_SPEED
+
+LOGGER = logging.getLogger(__name__)
+
+PART_SIZE = 1024 * 1024  # upload.GetFile serves at most 1 MiB per request
+PARTS_SUFFIX = ".parts"
+PART_RETRIES = 3
+# Errors after which the same part is requested again: transport failures and transient server-side misses
+RETRY_ERRORS = (IOError, OSError, asyncio.TimeoutError, FilePartMissing, InternalServerError)
+
+
+class PartBitmap:
+    """Bit per part of a download, saved next to the file so an interrupted download can resume."""
+
+    def __init__(self, path, file_size, part_size=PART_SIZE):
+        self.path = path
+        self.file_size = file_size
+        self.part_size = part_size
+        self.count = max(1, -(-file_size // part_size))
+        self.header = f"{file_size}:{part_size}\n".encode()
+        self.bits = bytearray(-(-self.count // 8))
+
+    def load(self):
+        """Load saved progress; a bitmap for another size or part size is ignored."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if data.startswith(self.header) and len(data) == len(self.header) + len(self.bits):
+            self.bits = bytearray(data[len(self.header):])
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header + bytes(self.bits))
+        os.replace(tmp_path, self.path)
+
+    def __contains__(self, index):
+        return bool(self.bits[index // 8] & (1 << (index % 8)))
+
+    def add(self, index):
+        self.bits[index // 8] |= 1 << (index % 8)
+
+    def missing(self):
+        return [index for index in range(self.count) if index not in self]
+
+    def part_length(self, index):
+        return min(self.part_size, self.file_size - index * self.part_size)
+
+
+class TelegramPartSource:
+    """Fetches byte ranges of a Telegram file over the pooled media sessions of its DC.
+
+    Every call to `connect` rotates to the next session, i.e. the next connection.
+    """
+
+    def __init__(self, pool, file_id, connections):
+        self.pool = pool
+        self.connections = connections
+        self.file_id = FileId.decode(file_id)
+        self.location = raw.types.InputDocumentFileLocation(
+            id=self.file_id.media_id,
+            access_hash=self.file_id.access_hash,
+            file_reference=self.file_id.file_reference,
+            thumb_size=self.file_id.thumbnail_size
+        )
+
+    async def connect(self):
+        session = await self.pool.session(self.file_id.dc_id, self.connections)
+        return TelegramPartConnection(session, self.location)
+
+
+class TelegramPartConnection:
+    def __init__(self, session, location):
+        self.session = session
+        self.location = location
+
+    async def fetch(self, offset, limit):
+        r = await self.session.invoke(
+            raw.functions.upload.GetFile(location=self.location, offset=offset, limit=limit),
+            sleep_threshold=30
+        )
+        if not isinstance(r, raw.types.upload.File):
+            # CDN-hosted files need the sequential client download
+            raise RuntimeError(f"Unsupported GetFile response: {type(r).__name__}")
+        return r.bytes
+
+    async def close(self):
+        pass  # Pooled sessions outlive the download
+
+
+class ParallelDownloader:
+    """Downloads a file part by part over several connections into a preallocated file.
+
+    `source.connect()` must return an object with `fetch(offset, limit) -> bytes` and `close()`,
+    which keeps the downloader independent of MTProto. The bitmap stays next to the finished
+    file, since a preallocated file has its full size from the start; whoever owns the file
+    removes both (see `ResumableDownloads.finish`).
+    """
+
+    def __init__(self, source, file_size, path, connections=4, part_size=PART_SIZE):
+        self.source = source
+        self.file_size = file_size
+        self.path = path
+        self.connections = max(1, connections)
+        self.part_size = part_size
+        self.bitmap = PartBitmap(path + PARTS_SUFFIX, file_size, part_size)
+        self.done_bytes = 0
+
+    def _prepare(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) == self.file_size:
+            self.bitmap.load()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            os.ftruncate(fd, self.file_size)
+            if hasattr(os, 'posix_fallocate') and self.file_size:
+                try:
+                    os.posix_fallocate(fd, 0, self.file_size)
+                except OSError:
+                    pass  # Not supported by every filesystem; the sparse file still works
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    async def run(self, progress=None, progress_args=()):
+        """Download every missing part; returns the path. Progress is reported like pyrogram's."""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        fd = await loop.run_in_executor(None, self._prepare)
+        queue = asyncio.Queue()
+        save_lock = asyncio.Lock()
+        missing = self.bitmap.missing()
+        if not missing:
+            os.close(fd)
+            LOGGER.info(f"{self.path} was already downloaded")
+            return self.path
+        for index in missing:
+            queue.put_nowait(index)
+        self.done_bytes = sum(self.bitmap.part_length(i) for i in range(self.bitmap.count) if i in self.bitmap)
+        if len(missing) < self.bitmap.count:
+            LOGGER.info(f"Resuming {self.path}: {self.bitmap.count - len(missing)}/{self.bitmap.count} parts present")
+
+        async def report():
+            if progress is None:
+                return
+            if inspect.iscoroutinefunction(progress):
+                await progress(self.done_bytes, self.file_size, *progress_args)
+            else:
+                progress(self.done_bytes, self.file_size, *progress_args)
+
+        async def fetch_part(connection, index):
+            offset = index * self.part_size
+            length = self.bitmap.part_length(index)
+            for attempt in range(1, PART_RETRIES + 1):
+                try:
+                    data = await connection.fetch(offset, self.part_size)
+                    if len(data) != length:
+                        raise IOError(f"Part {index} returned {len(data)} bytes, expected {length}")
+                    return data
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except RETRY_ERRORS as e:
+                    if attempt == PART_RETRIES:
+                        raise
+                    LOGGER.warning(f"Retrying part {index} of {self.path} ({attempt}/{PART_RETRIES}): {e}")
+                    await asyncio.sleep(attempt)
+            raise IOError(f"Part {index} of {self.path} kept hitting FloodWait")
+
+        async def worker():
+            connection = await self.source.connect()
+            try:
+                while True:
+                    try:
+                        index = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    data = await fetch_part(connection, index)
+                    await loop.run_in_executor(None, os.pwrite, fd, data, index * self.part_size)
+                    self.bitmap.add(index)
+                    async with save_lock:
+                        await loop.run_in_executor(None, self.bitmap.save)
+                    self.done_bytes += len(data)
+                    await report()
+            finally:
+                await connection.close()
+
+        try:
+            workers = [asyncio.create_task(worker()) for _ in range(min(self.connections, len(missing)))]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+            await loop.run_in_executor(None, os.fsync, fd)
+        finally:
+            os.close(fd)
+
+        if self.bitmap.missing():
+            raise IOError(f"Download of {self.path} is incomplete")
+        fetched = len(missing) * self.part_size
+        DOWNLOAD_SPEED.observe(
+            min(fetched, self.file_size) / 1024 / 1024 / max(time.monotonic() - started, 1e-6), source="telegram"
+        )
+        LOGGER.info(f"Downloaded {self.file_size} bytes to {self.path} over {self.connections} connections")
+        return self.path
+
+
+async def download_media(pool, media, path, connections, progress=None, progress_args=()):
+    """Download a Telegram video or document to `path` over `connections` pooled sessions."""
+    source = TelegramPartSource(pool, media.file_id, connections)
+    downloader = ParallelDownloader(source, media.file_size, path, connections)
+    return await downloader.run(progress, progress_args)
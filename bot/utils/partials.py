@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 10  # Seconds between manifest updates while a download runs
+
+
+class ResumableDownloads:
+    """Keeps yt-dlp downloads in a directory per source and format so they survive restarts.
+
+    yt-dlp continues from its `.part` files with range requests; the database manifest
+    records what is on disk so stale partials can be collected later.
+    """
+
+    def __init__(self, db, root):
+        self.db = db
+        self.root = root
+        self.locks = {}
+        self.active = set()
+
+    @staticmethod
+    def key(source_key, format_id):
+        return f"{source_key}|{format_id}"
+
+    def directory(self, part_key):
+        return os.path.join(self.root, hashlib.sha1(part_key.encode()).hexdigest()[:16])
+
+    def path(self, part_key, title):
+        """Where the finished download of `part_key` is written."""
+        return os.path.join(self.directory(part_key), f"{title}.mp4")
+
+    def lock(self, part_key):
+        """Lock that keeps two jobs from writing the same partial files."""
+        return self.locks.setdefault(part_key, asyncio.Lock())
+
+    async def begin(self, part_key, url, format_id, path):
+        """Record a download before it starts; returns the bytes an earlier attempt got."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.active.add(part_key)
+        downloaded = await self.db.save_partial(part_key, url, format_id, path)
+        if downloaded:
+            LOGGER.info(f"Resuming {part_key} after {downloaded} bytes")
+        return downloaded
+
+    def reporter(self, part_key, loop):
+        """Returns a (downloaded, total) callback for the download thread that updates the manifest."""
+        last = [0.0]
+
+        def report(downloaded, total):
+            now = time.monotonic()
+            if now - last[0] < PROGRESS_INTERVAL:
+                return
+            last[0] = now
+            asyncio.run_coroutine_threadsafe(self.db.update_partial(part_key, downloaded, total), loop)
+        return report
+
+    def end(self, part_key):
+        """The download stopped; its files stay until `finish` or garbage collection."""
+        self.active.discard(part_key)
+
+    async def finish(self, part_key):
+        """Remove a download that is no longer needed, together with its manifest entry."""
+        self.active.discard(part_key)
+        await self.db.delete_partial(part_key)
+        shutil.rmtree(self.directory(part_key), ignore_errors=True)
+        self.locks.pop(part_key, None)
+
+    async def gc(self, max_age):
+        """Delete partial downloads untouched for `max_age` seconds, and untracked directories."""
+        cutoff = time.time() - max_age
+        removed = 0
+        known = set()
+        for part_key, path, updated_at in await self.db.get_partials():
+            directory = self.directory(part_key)
+            known.add(os.path.basename(directory))
+            if part_key in self.active or updated_at > cutoff:
+                continue
+            await self.finish(part_key)
+            removed += 1
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                directory = os.path.join(self.root, name)
+                if name not in known and os.path.getmtime(directory) <= cutoff:
+                    shutil.rmtree(directory, ignore_errors=True)
+                    removed += 1
+        if removed:
+            LOGGER.info(f"Removed {removed} stale partial downloads")
+        return removed
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StageFailed(Exception):
+    """Raised by a stage that failed in an expected way; the message is shown to the user."""
+
+
+class Pipeline:
+    """Runs named async stages concurrently, each as soon as the stages it depends on are done.
+
+    If any stage raises, every stage still running is cancelled and the first error is re-raised.
+    """
+
+    def __init__(self):
+        self.stages = {}  # name -> (coroutine function, names it runs after)
+
+    def add(self, name, func, after=()):
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (func, tuple(after))
+        return self
+
+    async def run(self):
+        """Run every stage and return a dict of their results by name."""
+        tasks = {}
+
+        async def run_stage(name):
+            func, after = self.stages[name]
+            if after:
+                await asyncio.gather(*(tasks[dependency] for dependency in after))
+            return await func()
+
+        # Stages are added after their dependencies, so every awaited task already exists
+        for name in self.stages:
+            tasks[name] = asyncio.create_task(run_stage(name), name=f"stage-{name}")
+
+        try:
+            await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            failed = next((task for task in tasks.values() if task.done() and not task.cancelled()
+                           and task.exception() is not None), None)
+            if failed is not None:
+                raise failed.exception()
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            # Let cancelled stages run their cleanup before the caller removes shared files
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        return {name: task.result() for name, task in tasks.items()}
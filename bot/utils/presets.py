@@ -0,0 +1,181 @@
+import logging
+import os
+import shlex
+from config import ADAPTIVE_MAX_HEIGHT, ADAPTIVE_AUDIO_BITRATE, ADAPTIVE_CPU_BUDGET, ADAPTIVE_PIXELS_PER_CORE
+
+LOGGER = logging.getLogger(__name__)
+
+# Output heights tried from the top down when the bitrate budget is too thin for the source size
+HEIGHT_LADDER = (2160, 1440, 1080, 720, 576, 480, 360, 240)
+# Fewest bits per pixel per frame that still look acceptable in H.264
+MIN_BITS_PER_PIXEL = 0.04
+# x264 presets from slowest to fastest with their throughput relative to `medium`
+PRESET_SPEEDS = (
+    ('slower', 0.3), ('slow', 0.6), ('medium', 1.0), ('fast', 1.5),
+    ('faster', 2.5), ('veryfast', 4.0), ('superfast', 6.0), ('ultrafast', 8.0),
+)
+# Container overhead kept free when aiming for a file size
+SIZE_HEADROOM = 0.95
+# Codecs a Telegram mp4 can carry without re-encoding
+COPY_VIDEO_CODECS = ('h264', 'hevc')
+COPY_AUDIO_CODECS = ('aac', 'mp3')
+
+
+class AdaptiveTarget:
+    """What an adaptive encode aims for, parsed from `/set auto ...`."""
+
+    def __init__(self, size=None, bitrate=None, max_height=ADAPTIVE_MAX_HEIGHT, budget=ADAPTIVE_CPU_BUDGET):
+        self.size = size  # Bytes
+        self.bitrate = bitrate  # kbit/s for audio and video together
+        self.max_height = max_height
+        self.budget = budget  # Encode seconds allowed per second of media
+
+
+class EncodePlan:
+    """The outcome of planning: 'passthrough' (use the input as is), 'remux' or 'encode'."""
+
+    def __init__(self, action, ffmpeg_code=None, reason=""):
+        self.action = action
+        self.ffmpeg_code = ffmpeg_code
+        self.reason = reason
+
+    def __repr__(self):
+        return f"EncodePlan({self.action}, {self.ffmpeg_code!r}, {self.reason!r})"
+
+
+def is_adaptive(ffmpeg_code):
+    """Whether the user asked for adaptive presets instead of raw ffmpeg arguments."""
+    return bool(ffmpeg_code) and ffmpeg_code.split(None, 1)[0].lower() == 'auto'
+
+
+def _parse_amount(value, base):
+    """Parse '50M', '1.5G' or '800k' with the given unit base."""
+    units = {'k': base, 'm': base ** 2, 'g': base ** 3}
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def parse_target(ffmpeg_code):
+    """Parse 'auto [size=50M] [bitrate=1500k] [height=720] [budget=0.5]' into an AdaptiveTarget.
+
+    Raises ValueError for unknown or malformed options.
+    """
+    target = AdaptiveTarget()
+    for option in shlex.split(ffmpeg_code)[1:]:
+        key, _, value = option.partition('=')
+        if key == 'size':
+            target.size = int(_parse_amount(value, 1024))
+        elif key == 'bitrate':
+            target.bitrate = _parse_amount(value, 1000) / 1000
+        elif key == 'height':
+            target.max_height = int(value)
+        elif key == 'budget':
+            target.budget = float(value)
+        else:
+            raise ValueError(f"Unknown adaptive option: {option}")
+    return target
+
+
+def _total_bitrate(target, duration):
+    """Bitrate budget in kbit/s for audio and video together, or None without a target."""
+    budgets = []
+    if target.bitrate:
+        budgets.append(target.bitrate)
+    if target.size and duration:
+        budgets.append(target.size * 8 * SIZE_HEADROOM / duration / 1000)
+    return min(budgets) if budgets else None
+
+
+def _meets_target(probe, target, total_kbps):
+    if probe.get('video_codec') not in COPY_VIDEO_CODECS:
+        return False
+    if target.max_height and (probe.get('height') or 0) > target.max_height:
+        return False
+    if target.size and probe.get('size') and probe['size'] > target.size:
+        return False
+    if total_kbps and probe.get('bitrate') and probe['bitrate'] / 1000 > total_kbps * 1.05:
+        return False
+    return True
+
+
+def _output_height(probe, target, video_kbps):
+    """Tallest ladder height within the limits that the bitrate budget can still feed."""
+    source_height = probe.get('height') or target.max_height or 1080
+    limit = min(source_height, target.max_height or source_height)
+    width = probe.get('width') or 0
+    aspect = width / probe['height'] if width and probe.get('height') else 16 / 9
+    fps = probe.get('fps') or 30
+    candidates = [limit] + [h for h in HEIGHT_LADDER if h < limit]
+    for height in candidates:
+        if video_kbps is None or video_kbps * 1000 / (height * height * aspect * fps) >= MIN_BITS_PER_PIXEL:
+            return height
+    return candidates[-1]
+
+
+def _choose_crf(bits_per_pixel):
+    if bits_per_pixel is None or bits_per_pixel >= 0.1:
+        return 21
+    if bits_per_pixel >= 0.06:
+        return 23
+    return 26
+
+
+def _choose_preset(pixels_per_second, budget):
+    """Slowest preset that encodes within `budget` seconds per media second on this machine."""
+    throughput = ADAPTIVE_PIXELS_PER_CORE * (os.cpu_count() or 1)
+    for preset, speed in PRESET_SPEEDS:
+        if pixels_per_second / (throughput * speed) <= budget:
+            return preset
+    return PRESET_SPEEDS[-1][0]
+
+
+def plan_encode(probe, target):
+    """Pick passthrough, remux or an x264 encode with CRF, size and preset for the probed source.
+
+    Without a probe (ffprobe missing or failing) the source cannot be judged, so it is encoded
+    with settings that respect the height limit.
+    """
+    if probe is None:
+        scale = f"-vf \"scale=-2:'min({target.max_height},ih)'\" " if target.max_height else ""
+        return EncodePlan(
+            'encode', f"-map 0:v:0 -map 0:a? {scale}-c:v libx264 -preset veryfast -crf 23 "
+                      f"-c:a aac -b:a {ADAPTIVE_AUDIO_BITRATE}k -movflags +faststart",
+            "source could not be probed"
+        )
+
+    duration = probe.get('duration')
+    total_kbps = _total_bitrate(target, duration)
+    if _meets_target(probe, target, total_kbps):
+        audio_ok = probe.get('audio_codec') in COPY_AUDIO_CODECS + (None,)
+        if audio_ok and 'mp4' in (probe.get('format_name') or ''):
+            return EncodePlan('passthrough', reason="source already meets the target")
+        audio = "-c:a copy" if audio_ok else f"-c:a aac -b:a {ADAPTIVE_AUDIO_BITRATE}k"
+        return EncodePlan(
+            'remux', f"-map 0:v:0 -map 0:a? -c:v copy {audio} -movflags +faststart",
+            "source streams already meet the target"
+        )
+
+    audio_kbps = ADAPTIVE_AUDIO_BITRATE if probe.get('audio_codec') else 0
+    video_kbps = max(total_kbps - audio_kbps, 100) if total_kbps else None
+    height = _output_height(probe, target, video_kbps)
+    width = (probe.get('width') or 0) * height / probe['height'] if probe.get('height') else height * 16 / 9
+    fps = probe.get('fps') or 30
+    bits_per_pixel = video_kbps * 1000 / (width * height * fps) if video_kbps else None
+    crf = _choose_crf(bits_per_pixel)
+    preset = _choose_preset(width * height * fps, target.budget)
+
+    args = ["-map 0:v:0 -map 0:a?"]
+    if height != probe.get('height'):
+        args.append(f"-vf scale=-2:{height}")
+    args.append(f"-c:v libx264 -preset {preset} -crf {crf}")
+    if video_kbps:
+        # Capped CRF keeps the quality target but never exceeds the size budget
+        args.append(f"-maxrate {video_kbps:.0f}k -bufsize {video_kbps * 2:.0f}k")
+    args.append(f"-c:a aac -b:a {ADAPTIVE_AUDIO_BITRATE}k -movflags +faststart")
+    return EncodePlan(
+        'encode', " ".join(args),
+        f"{probe.get('video_codec')} {probe.get('height')}p at {(probe.get('bitrate') or 0) / 1000:.0f} kbit/s "
+        f"-> {height}p crf {crf} {preset}"
+    )
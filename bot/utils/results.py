@@ -0,0 +1,71 @@
+import hashlib
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def code_hash(ffmpeg_code):
+    """Stable short hash of an ffmpeg argument string, ignoring whitespace differences."""
+    return hashlib.sha256(" ".join(ffmpeg_code.split()).encode()).hexdigest()[:16]
+
+
+def youtube_source_key(info):
+    """Source key for an extracted video, shared by every URL form of the same video."""
+    return f"yt:{info.get('extractor') or 'generic'}:{info.get('id') or info.get('webpage_url')}"
+
+
+def telegram_source_key(media):
+    """Source key for a Telegram video or document, stable across forwards."""
+    return f"tg:{media.file_unique_id}"
+
+
+class ResultCache:
+    """Remembers the Telegram file_id of finished encodes so repeat requests skip the pipeline."""
+
+    def __init__(self, db, max_entries, max_age):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    async def lookup(self, source_key, format_id, ffmpeg_code):
+        """Return the stored result dict for this source, format and ffmpeg code, or None."""
+        row = await self.db.get_result(source_key, format_id or '', code_hash(ffmpeg_code), self.max_age)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        file_id, caption, duration, width, height = row
+        return {
+            'source_key': source_key,
+            'format_id': format_id or '',
+            'code_hash': code_hash(ffmpeg_code),
+            'file_id': file_id,
+            'caption': caption,
+            'duration': duration,
+            'width': width,
+            'height': height,
+        }
+
+    async def store(self, source_key, format_id, ffmpeg_code, sent_message, caption, duration, width, height):
+        """Remember the upload in `sent_message` and evict the oldest entries beyond the limit."""
+        media = sent_message.video or sent_message.document if sent_message else None
+        if media is None:
+            return
+        await self.db.save_result(
+            source_key, format_id or '', code_hash(ffmpeg_code), media.file_id, caption, duration, width, height
+        )
+        await self.db.evict_results(self.max_entries, self.max_age)
+
+    async def discard(self, result):
+        """Forget one entry, e.g. after Telegram rejected its file_id."""
+        await self.db.delete_result(result['source_key'], result['format_id'], result['code_hash'])
+
+    async def invalidate(self, source_key):
+        """Forget every result for a source; returns the number of entries removed."""
+        return await self.db.delete_results(source_key)
+
+    async def purge(self, max_age=None):
+        """Remove entries older than `max_age` seconds, or all of them."""
+        return await self.db.purge_results(max_age)
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from bot.utils.metrics import QUEUE_WAIT_SECONDS
+
+LOGGER = logging.getLogger(__name__)
+
+# Terminal job states; anything else is resumed after a restart
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+
+class Job:
+    """A unit of work tracked in the jobs table."""
+
+    def __init__(self, job_id, kind, user_id, chat_id, payload, state='queued', stage=None, attempts=0):
+        self.job_id = job_id
+        self.kind = kind
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.payload = payload
+        self.state = state
+        self.stage = stage
+        self.attempts = attempts
+
+    @classmethod
+    def from_row(cls, row):
+        job_id, kind, user_id, chat_id, payload, state, stage, attempts = row
+        return cls(job_id, kind, user_id, chat_id, json.loads(payload), state, stage, attempts)
+
+
+class FairSemaphore:
+    """A concurrency limit that hands free slots to waiting users in round-robin order.
+
+    Priority acquisitions wait in their own lane, which is served first in arrival order.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.priority = deque()  # (job_id, future)
+        self.waiters = OrderedDict()  # user_id -> deque of (job_id, future)
+
+    def acquire(self, user_id, job_id, priority=False):
+        """Return a future that resolves once the caller holds a slot."""
+        future = asyncio.get_running_loop().create_future()
+        if self.active < self.limit and not self.waiters and not self.priority:
+            self.active += 1
+            future.set_result(None)
+        elif priority:
+            self.priority.append((job_id, future))
+        else:
+            self.waiters.setdefault(user_id, deque()).append((job_id, future))
+        return future
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def discard(self, future):
+        """Give up a pending or granted acquisition, e.g. when the waiting job is cancelled."""
+        if future.done() and not future.cancelled():
+            self.release()
+            return
+        future.cancel()
+        for entry in self.priority:
+            if entry[1] is future:
+                self.priority.remove(entry)
+                return
+        for user_id, queue in list(self.waiters.items()):
+            for entry in queue:
+                if entry[1] is future:
+                    queue.remove(entry)
+                    break
+            if not queue:
+                del self.waiters[user_id]
+
+    def _wake(self):
+        while self.active < self.limit and self.priority:
+            job_id, future = self.priority.popleft()
+            if future.cancelled():
+                continue
+            self.active += 1
+            future.set_result(None)
+        while self.active < self.limit and self.waiters:
+            user_id, queue = next(iter(self.waiters.items()))
+            job_id, future = queue.popleft()
+            # Rotate so the next free slot goes to a different user
+            del self.waiters[user_id]
+            if queue:
+                self.waiters[user_id] = queue
+            if future.cancelled():
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    def order(self):
+        """Job ids in the order they will be admitted."""
+        queues = [list(queue) for queue in self.waiters.values()]
+        ordered = [job_id for job_id, _ in self.priority]
+        for depth in range(max((len(q) for q in queues), default=0)):
+            ordered.extend(q[depth][0] for q in queues if depth < len(q))
+        return ordered
+
+    def position(self, job_id):
+        """1-based queue position of a waiting job, or 0 if it is not waiting."""
+        order = self.order()
+        return order.index(job_id) + 1 if job_id in order else 0
+
+
+class JobScheduler:
+    """Runs persisted jobs with separate fair concurrency limits per pipeline stage.
+
+    With `dispatch_only` submitted jobs are only persisted, for worker processes to claim.
+    With `retry_attempts` a job that raises is requeued for any worker until it has been
+    tried that many times. Jobs of `priority_users` skip the fair queues of every stage, and
+    `user_cap(user_id)` bounds how many jobs of one user run at once (None for no cap).
+    """
+
+    def __init__(self, db, limits, dispatch_only=False, retry_attempts=None, priority_users=(), user_cap=None):
+        self.db = db
+        self.dispatch_only = dispatch_only
+        self.retry_attempts = retry_attempts
+        self.priority_users = frozenset(priority_users)
+        self.user_cap = user_cap
+        self.user_slots = {}  # user_id -> asyncio.Semaphore
+        self.slots = {stage: FairSemaphore(limit) for stage, limit in limits.items()}
+        self.handlers = {}  # kind -> coroutine function taking a Job, returning success
+        self.jobs = {}  # job_id -> Job
+        self.tasks = {}  # job_id -> asyncio.Task
+        self.cancelled = set()
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    async def submit(self, kind, user_id, chat_id, payload):
+        """Persist a new job and start running it."""
+        job_id = await self.db.create_job(kind, user_id, chat_id, json.dumps(payload))
+        job = Job(job_id, kind, user_id, chat_id, payload)
+        if not self.dispatch_only:
+            self._start(job)
+        LOGGER.info(f"Job {job_id} ({kind}) submitted by user {user_id}")
+        return job
+
+    async def resume(self, max_attempts):
+        """Restart every job that was queued or running when the process stopped."""
+        for row in await self.db.get_unfinished_jobs():
+            job = Job.from_row(row)
+            if job.attempts >= max_attempts or job.kind not in self.handlers:
+                await self.db.set_job_state(job.job_id, 'failed', error="Gave up after restart")
+                continue
+            await self.db.increment_job_attempts(job.job_id)
+            job.attempts += 1
+            LOGGER.info(f"Resuming job {job.job_id} ({job.kind}), attempt {job.attempts}")
+            self._start(job)
+
+    def adopt(self, job):
+        """Run a job that another process queued and this one claimed."""
+        self._start(job)
+
+    def _start(self, job):
+        self.jobs[job.job_id] = job
+        self.tasks[job.job_id] = asyncio.create_task(self._run(job))
+
+    def _user_slot(self, user_id):
+        cap = self.user_cap(user_id) if self.user_cap else None
+        if not cap:
+            return None
+        if user_id not in self.user_slots:
+            self.user_slots[user_id] = asyncio.Semaphore(cap)
+        return self.user_slots[user_id]
+
+    async def _run(self, job):
+        user_slot = self._user_slot(job.user_id)
+        try:
+            # Jobs over the user's cap stay queued until one of their earlier jobs finishes
+            if user_slot is not None:
+                await user_slot.acquire()
+            try:
+                await self.db.set_job_state(job.job_id, 'running')
+                success = await self.handlers[job.kind](job)
+            finally:
+                if user_slot is not None:
+                    user_slot.release()
+            await self.db.set_job_state(job.job_id, 'done' if success else 'failed')
+        except asyncio.CancelledError:
+            # Tasks are also cancelled on shutdown; only a user cancel is final
+            if job.job_id in self.cancelled:
+                await self.db.set_job_state(job.job_id, 'cancelled')
+            raise
+        except Exception as e:
+            LOGGER.error(f"Job {job.job_id} failed: {e}")
+            if self.retry_attempts and job.attempts < self.retry_attempts:
+                await self.db.requeue_job(job.job_id, error=str(e))
+            else:
+                await self.db.set_job_state(job.job_id, 'failed', error=str(e))
+        finally:
+            self.jobs.pop(job.job_id, None)
+            self.tasks.pop(job.job_id, None)
+            self.cancelled.discard(job.job_id)
+
+    @asynccontextmanager
+    async def stage(self, job, name, on_wait=None):
+        """Hold a slot of the given stage for the duration of the block.
+
+        While the job waits, `on_wait(position)` is awaited whenever its queue position changes.
+        """
+        slots = self.slots[name]
+        queued_at = time.monotonic()
+        future = slots.acquire(job.user_id, job.job_id, priority=job.user_id in self.priority_users)
+        try:
+            last_position = None
+            while not future.done():
+                position = slots.position(job.job_id)
+                if on_wait and position != last_position:
+                    last_position = position
+                    await on_wait(position)
+                await asyncio.wait({future}, timeout=5)
+        except BaseException:
+            slots.discard(future)
+            raise
+        # The slot is held from here on, so everything up to the end of the block releases it
+        try:
+            QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued_at, stage=name)
+            job.stage = name
+            await self.db.set_job_state(job.job_id, 'running', stage=name)
+            yield
+        finally:
+            slots.release()
+
+    def cancel(self, job_id):
+        task = self.tasks.get(job_id)
+        if task is None:
+            return False
+        self.cancelled.add(job_id)
+        task.cancel()
+        return True
+
+    def user_jobs(self, user_id):
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+
+    def queue_summary(self):
+        """Number of jobs holding and waiting for each stage."""
+        return {
+            name: (slots.active, len(slots.priority) + sum(len(q) for q in slots.waiters.values()))
+            for name, slots in self.slots.items()
+        }
@@ -0,0 +1,67 @@
+import asyncio
+import itertools
+import logging
+from pyrogram import raw
+from pyrogram.session import Auth, Session
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SessionPool:
+    """Long-lived media sessions per data center, shared by every upload and download.
+
+    Sessions multiplex requests, so concurrent transfers can use the same connections;
+    keeping them open saves the handshake (and the authorization export) for each file.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pools = {}  # dc_id -> list of started sessions
+        self.auth_keys = {}
+        self.counters = {}
+        self.locks = {}
+
+    async def sessions(self, dc_id=None, count=1):
+        """Return at least `count` started sessions to `dc_id` (the bot's own DC by default)."""
+        home_dc = await self.client.storage.dc_id()
+        dc_id = dc_id or home_dc
+        lock = self.locks.setdefault(dc_id, asyncio.Lock())
+        async with lock:
+            pool = self.pools.setdefault(dc_id, [])
+            while len(pool) < count:
+                pool.append(await self._start(dc_id, home_dc, authorize=not pool))
+            return pool[:count] if count else list(pool)
+
+    async def session(self, dc_id=None, count=1):
+        """One session to `dc_id`, rotating over a pool of `count`."""
+        pool = await self.sessions(dc_id, count)
+        counter = self.counters.setdefault(dc_id, itertools.count())
+        return pool[next(counter) % len(pool)]
+
+    async def _start(self, dc_id, home_dc, authorize):
+        test_mode = await self.client.storage.test_mode()
+        if dc_id not in self.auth_keys:
+            self.auth_keys[dc_id] = (
+                await self.client.storage.auth_key() if dc_id == home_dc
+                else await Auth(self.client, dc_id, test_mode).create()
+            )
+        session = Session(self.client, dc_id, self.auth_keys[dc_id], test_mode, is_media=True)
+        await session.start()
+        if dc_id != home_dc and authorize:
+            # The exported authorization is bound to the key, so one import covers every session
+            exported = await self.client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            await session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+        LOGGER.info(f"Started media session {len(self.pools.get(dc_id, [])) + 1} to DC {dc_id}")
+        return session
+
+    def size(self):
+        return {dc_id: len(pool) for dc_id, pool in self.pools.items()}
+
+    async def close(self):
+        for pool in self.pools.values():
+            for session in pool:
+                try:
+                    await session.stop()
+                except Exception as e:
+                    LOGGER.error(f"Failed to stop media session: {e}")
+        self.pools.clear()
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from pyrogram.errors import FloodWait, MessageNotModified, MessageIdInvalid
+from config import STATUS_EDIT_INTERVAL, STATUS_EDITS_PER_SECOND
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _MessageState:
+    """Pending and last delivered text of one status message."""
+
+    def __init__(self, message):
+        self.message = message
+        self.pending = None
+        self.sent = None
+        self.last_edit = float('-inf')
+        self.final = False
+        self.wake = asyncio.Event()
+        self.task = None
+
+
+class StatusEditor:
+    """Edits status messages on behalf of every job.
+
+    Updates are coalesced per message so only the latest text is sent, at most once per
+    `interval` seconds, and all edits share one rate limit that backs off on FloodWait.
+    """
+
+    def __init__(self, interval=STATUS_EDIT_INTERVAL, rate=STATUS_EDITS_PER_SECOND):
+        self.interval = interval
+        self.rate = rate
+        self.states = {}  # (chat_id, message_id) -> _MessageState
+        self.closed = OrderedDict()  # Messages that got their terminal text; late updates are ignored
+        self.tokens = rate
+        self.refilled = None
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+        self.requested = 0
+        self.edits = 0
+        self.flood_waits = 0
+
+    @staticmethod
+    def _key(message):
+        return message.chat.id, message.id
+
+    def update(self, message, text):
+        """Queue `text` for `message`; older text that has not been sent yet is dropped."""
+        if message is None:
+            return None
+        key = self._key(message)
+        if key in self.closed:
+            return None
+        self.requested += 1
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _MessageState(message)
+        state.pending = text
+        if state.task is None:
+            state.task = asyncio.create_task(self._drain(key, state))
+        return state
+
+    def update_threadsafe(self, loop, message, text):
+        """`update` for callers running outside the event loop, such as yt-dlp hooks."""
+        if message is not None:
+            loop.call_soon_threadsafe(self.update, message, text)
+
+    async def finish(self, message, text):
+        """Send a terminal text right away, skipping the per-message interval, and wait until it is delivered."""
+        self.closed.pop(self._key(message), None)
+        state = self.update(message, text)
+        if state is None:
+            return
+        state.final = True
+        state.wake.set()
+        self._close(self._key(message))
+        await asyncio.shield(state.task)
+
+    async def delete(self, message):
+        """Drop anything queued for `message` and delete it."""
+        self.discard(message)
+        await message.delete()
+
+    def discard(self, message):
+        """Drop anything queued for `message` without sending it."""
+        key = self._key(message)
+        self._close(key)
+        state = self.states.pop(key, None)
+        if state is not None and state.task is not None:
+            state.task.cancel()
+
+    def _close(self, key):
+        self.closed[key] = True
+        while len(self.closed) > 1024:
+            self.closed.popitem(last=False)
+
+    async def _acquire(self):
+        """Wait for a slot in the global edit budget."""
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.refilled is not None:
+                    self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def _drain(self, key, state):
+        loop = asyncio.get_running_loop()
+        try:
+            while state.pending is not None:
+                wait = state.last_edit + self.interval - loop.time()
+                if wait > 0 and not state.final:
+                    state.wake.clear()
+                    try:
+                        await asyncio.wait_for(state.wake.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._acquire()
+                text, state.pending = state.pending, None
+                if text == state.sent:
+                    continue
+                try:
+                    await state.message.edit_text(text)
+                    self.edits += 1
+                    state.sent = text
+                except FloodWait as e:
+                    self.flood_waits += 1
+                    self.blocked_until = loop.time() + e.value
+                    LOGGER.warning(f"FloodWait of {e.value}s while editing status messages")
+                    if state.pending is None:
+                        state.pending = text
+                    continue
+                except MessageNotModified:
+                    state.sent = text
+                except MessageIdInvalid:
+                    LOGGER.error("Failed to update status: the message was deleted or expired.")
+                    state.final = True
+                    self._close(key)
+                    break
+                except Exception as e:
+                    LOGGER.error(f"Failed to update status: {e}")
+                state.last_edit = loop.time()
+        finally:
+            state.task = None
+            # Idle states are kept so the next update still honours the interval
+            if state.final and self.states.get(key) is state:
+                del self.states[key]
+
+    def stats(self):
+        return {
+            'requested': self.requested,
+            'edits': self.edits,
+            'flood_waits': self.flood_waits,
+            'active': len(self.states),
+        }
+
+
+status_editor = StatusEditor()
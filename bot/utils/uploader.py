@@ -0,0 +1,190 @@
+import asyncio
+import inspect
+import logging
+import os
+import time
+from hashlib import md5
+from pyrogram import raw, types, utils
+from pyrogram.errors import FloodWait, FilePartMissing
+from bot.utils.metrics import UPLOAD_SPEED
+
+LOGGER = logging.getLogger(__name__)
+
+UPLOAD_PART_SIZE = 512 * 1024  # Largest part size upload.SaveFilePart accepts
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Larger files must be sent with SaveBigFilePart
+PARTS_IN_FLIGHT = 2  # Requests kept outstanding per session
+PART_RETRIES = 3
+
+
+class UploadEngine:
+    """Uploads files part by part over several pooled sessions and sends them as videos."""
+
+    def __init__(self, client, pool, connections=4, part_size=UPLOAD_PART_SIZE):
+        self.client = client
+        self.pool = pool
+        self.connections = max(1, connections)
+        self.part_size = part_size
+        self.uploads = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def _part_request(self, file_id, index, total_parts, data, is_big):
+        if is_big:
+            return raw.functions.upload.SaveBigFilePart(
+                file_id=file_id, file_part=index, file_total_parts=total_parts, bytes=data
+            )
+        return raw.functions.upload.SaveFilePart(file_id=file_id, file_part=index, bytes=data)
+
+    async def _save_part(self, session, fd, file_id, index, total_parts, is_big):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, os.pread, fd, self.part_size, index * self.part_size)
+        request = self._part_request(file_id, index, total_parts, data, is_big)
+        for attempt in range(1, PART_RETRIES + 1):
+            try:
+                if await session.invoke(request):
+                    return len(data)
+                raise IOError(f"Telegram did not accept part {index}")
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except (IOError, OSError, asyncio.TimeoutError) as e:
+                if attempt == PART_RETRIES:
+                    raise
+                LOGGER.warning(f"Retrying upload part {index} ({attempt}/{PART_RETRIES}): {e}")
+                await asyncio.sleep(attempt)
+        raise IOError(f"Upload part {index} kept hitting FloodWait")
+
+    async def upload(self, path, progress=None, progress_args=(), track=True):
+        """Upload `path` and return the InputFile to reference it in a message.
+
+        With `track=False` (e.g. thumbnails) the upload is left out of the stats and speed metrics.
+        """
+        file_size = os.path.getsize(path)
+        if file_size == 0:
+            raise ValueError("File size equals to 0 B")
+        total_parts = -(-file_size // self.part_size)
+        is_big = file_size > BIG_FILE_SIZE
+        file_id = self.client.rnd_id()
+        sessions = await self.pool.sessions(count=self.connections if is_big else 1)
+        queue = asyncio.Queue()
+        for index in range(total_parts):
+            queue.put_nowait(index)
+        sent = 0
+        started = time.monotonic()
+
+        async def worker(session):
+            nonlocal sent
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                sent += await self._save_part(session, fd, file_id, index, total_parts, is_big)
+                if progress is None:
+                    continue
+                if inspect.iscoroutinefunction(progress):
+                    await progress(sent, file_size, *progress_args)
+                else:
+                    progress(sent, file_size, *progress_args)
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            workers = [
+                asyncio.create_task(worker(session))
+                for session in sessions for _ in range(PARTS_IN_FLIGHT if is_big else 1)
+            ]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+            md5_checksum = None if is_big else await asyncio.get_running_loop().run_in_executor(
+                None, self._md5, fd, file_size
+            )
+        finally:
+            os.close(fd)
+
+        elapsed = time.monotonic() - started
+        if track:
+            self.uploads += 1
+            self.bytes += file_size
+            self.seconds += elapsed
+            UPLOAD_SPEED.observe(file_size / 1024 / 1024 / max(elapsed, 1e-6))
+        LOGGER.info(
+            f"Uploaded {os.path.basename(path)}: {file_size / 1024 / 1024:.1f} MB in {elapsed:.1f}s "
+            f"({file_size / 1024 / 1024 / max(elapsed, 1e-6):.2f} MB/s over {len(sessions)} sessions)"
+        )
+        name = os.path.basename(path)
+        if is_big:
+            return raw.types.InputFileBig(id=file_id, parts=total_parts, name=name)
+        return raw.types.InputFile(id=file_id, parts=total_parts, name=name, md5_checksum=md5_checksum)
+
+    @staticmethod
+    def _md5(fd, file_size):
+        digest = md5()
+        offset = 0
+        while offset < file_size:
+            data = os.pread(fd, 1024 * 1024, offset)
+            digest.update(data)
+            offset += len(data)
+        return digest.hexdigest()
+
+    async def _reupload_part(self, path, file, index):
+        session = await self.pool.session(count=self.connections)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            await self._save_part(
+                session, fd, file.id, index, file.parts, isinstance(file, raw.types.InputFileBig)
+            )
+        finally:
+            os.close(fd)
+
+    async def send_video(self, chat_id, path, caption="", duration=0, width=0, height=0, thumb=None,
+                         reply_to_message_id=None, progress=None, progress_args=()):
+        """Upload `path` in parallel and send it as a streamable video; returns the sent Message."""
+        file = await self.upload(path, progress, progress_args)
+        thumb_file = await self.upload(thumb, track=False) if thumb else None
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type="video/mp4",
+            file=file,
+            thumb=thumb_file,
+            attributes=[
+                raw.types.DocumentAttributeVideo(supports_streaming=True, duration=duration, w=width, h=height),
+                raw.types.DocumentAttributeFilename(file_name=os.path.basename(path))
+            ]
+        )
+        peer = await self.client.resolve_peer(chat_id)
+        reply_to = await utils.get_reply_to(self.client, chat_id, reply_to_message_id=reply_to_message_id)
+        for attempt in range(1, PART_RETRIES + 1):
+            try:
+                r = await self.client.invoke(
+                    raw.functions.messages.SendMedia(
+                        peer=peer,
+                        media=media,
+                        reply_to=reply_to,
+                        random_id=self.client.rnd_id(),
+                        **await utils.parse_text_entities(self.client, caption, None, None)
+                    )
+                )
+                break
+            except FilePartMissing as e:
+                if attempt == PART_RETRIES:
+                    raise
+                await self._reupload_part(path, file, e.value)
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    self.client, update.message,
+                    {user.id: user for user in r.users},
+                    {chat.id: chat for chat in r.chats}
+                )
+        return None
+
+    def stats(self):
+        """Uploads done, bytes sent and the overall MB/s."""
+        return {
+            'uploads': self.uploads,
+            'bytes': self.bytes,
+            'speed': self.bytes / 1024 / 1024 / self.seconds if self.seconds else None,
+        }
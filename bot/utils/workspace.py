@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+from contextlib import asynccontextmanager
+from bot.utils.helpers import format_size
+
+LOGGER = logging.getLogger(__name__)
+
+DISK_POLL_INTERVAL = 5  # Seconds between free-space checks while a job waits
+
+
+class DiskFull(Exception):
+    """A job needs more space than the disk can ever offer."""
+
+
+class ScratchDirs:
+    """One working directory per job, so jobs with the same title never share files."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, job_id):
+        return os.path.join(self.root, str(job_id))
+
+    def create(self, job_id):
+        """Create (or reuse, for a resumed job) the job's directory and return its path."""
+        path = self.path(job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def remove(self, job_id):
+        shutil.rmtree(self.path(job_id), ignore_errors=True)
+
+    def sweep(self, keep_job_ids, legacy_dirs=()):
+        """Remove directories of jobs that will not run again, plus loose files from `legacy_dirs`.
+
+        Returns the number of bytes reclaimed.
+        """
+        freed = 0
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name.isdigit() and int(name) in keep_job_ids:
+                    continue
+                path = os.path.join(self.root, name)
+                freed += _tree_size(path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        for directory in legacy_dirs:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and not name.endswith('.db'):
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        if freed:
+            LOGGER.info(f"Reclaimed {format_size(freed)} of orphaned job files")
+        return freed
+
+
+def _tree_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskQuota:
+    """Admits jobs only while their estimated disk usage fits above a free-space floor.
+
+    Reservations are kept in the shared database per host, so worker processes on one machine
+    count each other's jobs; `owner` is the worker id they are recorded under.
+    """
+
+    def __init__(self, db, path, min_free, owner):
+        self.db = db
+        self.path = path
+        self.min_free = min_free
+        self.owner = owner
+        self.host = socket.gethostname()
+        self.reservations = {}  # job_id -> bytes reserved by this process
+        self.condition = asyncio.Condition()
+
+    def free(self):
+        os.makedirs(self.path, exist_ok=True)
+        return shutil.disk_usage(self.path).free
+
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    async def _try_reserve(self, job_id, nbytes):
+        # Reserved jobs may not have written their files yet, so their bytes count as used
+        return await self.db.reserve_disk(job_id, self.owner, self.host, nbytes, self.free() - self.min_free)
+
+    @asynccontextmanager
+    async def reserve(self, job_id, nbytes, on_wait=None):
+        """Hold `nbytes` for the job while the block runs, waiting until they are available."""
+        async with self.condition:
+            notified = False
+            while not await self._try_reserve(job_id, nbytes):
+                reserved, jobs = await self.db.get_disk_reserved(self.host)
+                if not jobs:
+                    # Nothing will be released, so only an outside cleanup could make room
+                    total = shutil.disk_usage(self.path).total
+                    if nbytes + self.min_free > total:
+                        raise DiskFull(f"This job needs about {format_size(nbytes)}, more than the disk can hold.")
+                if on_wait and not notified:
+                    notified = True
+                    await on_wait(nbytes, self.free() - reserved)
+                try:
+                    await asyncio.wait_for(self.condition.wait(), DISK_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            self.reservations[job_id] = nbytes
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.reservations.pop(job_id, None)
+                try:
+                    await self.db.release_disk(job_id)
+                except Exception as e:
+                    LOGGER.error(f"Failed to release the disk reservation of job {job_id}: {e}")
+                self.condition.notify_all()
+
+    async def sweep(self):
+        """Drop reservations left on this host by processes that stopped without releasing them."""
+        await self.db.drop_orphaned_disk_reservations(self.host)
+
+    def stats(self):
+        """Free bytes and the reservations of this process's jobs."""
+        return {'free': self.free(), 'reserved': self.reserved(), 'jobs': len(self.reservations)}
@@ -12,8 +12,8 @@ BOT_TOKEN = os.getenv('BOT_TOKEN','7936026368:AAGUVaduGFrc6XwUy9BOrCX0gcNdTytO_x
 # Channel IDs
 DUMP_CHANNEL = int(os.getenv('DUMP_CHANNEL','-1001930986503'))
 
-# Default FFmpeg code
-DEFAULT_FFMPEG = '-c:v copy -c:a copy -c:s copy -map 0'
+# Default FFmpeg code; 'auto ...' selects adaptive presets (see ADAPTIVE_* below)
+DEFAULT_FFMPEG = os.getenv('DEFAULT_FFMPEG', '-c:v copy -c:a copy -c:s copy -map 0')
 
 # Database
 DB_NAME = 'bot_data.db'
@@ -21,6 +21,79 @@ DB_NAME = 'bot_data.db'
 # Downloads directory
 DOWNLOADS_DIR = 'downloads'
 COOKIES_PATH = '/app/cookies.txt'
+# Concurrency limits for yt-dlp work running off the event loop
+MAX_CONCURRENT_EXTRACTIONS = int(os.getenv('MAX_CONCURRENT_EXTRACTIONS', '4'))
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '2'))
+# Extracted video info cache (entries, seconds, and whether to keep it in the database)
+INFO_CACHE_SIZE = int(os.getenv('INFO_CACHE_SIZE', '256'))
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', '3600'))
+INFO_CACHE_PERSIST = os.getenv('INFO_CACHE_PERSIST', 'true').lower() == 'true'
+# Job scheduler: concurrent jobs per pipeline stage and retries after a crash
+JOB_DOWNLOAD_SLOTS = int(os.getenv('JOB_DOWNLOAD_SLOTS', '2'))
+JOB_ENCODE_SLOTS = int(os.getenv('JOB_ENCODE_SLOTS', '1'))
+JOB_UPLOAD_SLOTS = int(os.getenv('JOB_UPLOAD_SLOTS', '2'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Pipe downloads straight into ffmpeg when the source allows it
+STREAM_ENCODE = os.getenv('STREAM_ENCODE', 'true').lower() == 'true'
+# A streamed /yl download is never stored, so the dump channel would get the compressed file instead of the
+# original; /yl only streams when that is acceptable
+STREAM_DUMP_COMPRESSED = os.getenv('STREAM_DUMP_COMPRESSED', 'false').lower() == 'true'
+# Split long encodes into segments that are encoded in parallel
+PARALLEL_ENCODE = os.getenv('PARALLEL_ENCODE', 'true').lower() == 'true'
+PARALLEL_ENCODE_MIN_DURATION = int(os.getenv('PARALLEL_ENCODE_MIN_DURATION', '600'))
+PARALLEL_ENCODE_WORKERS = int(os.getenv('PARALLEL_ENCODE_WORKERS', str(os.cpu_count() or 1)))
+# Finished uploads reused for repeat requests (entries, seconds)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '5000'))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', str(30 * 24 * 3600)))
+# Status message edits: minimum seconds between edits of one message, and edits per second across the bot
+STATUS_EDIT_INTERVAL = float(os.getenv('STATUS_EDIT_INTERVAL', '5'))
+STATUS_EDITS_PER_SECOND = float(os.getenv('STATUS_EDITS_PER_SECOND', '20'))
+# Telegram downloads of at least PARALLEL_DOWNLOAD_MIN_SIZE bytes fetch parts over several connections
+PARALLEL_DOWNLOAD_CONNECTIONS = int(os.getenv('PARALLEL_DOWNLOAD_CONNECTIONS', '4'))
+PARALLEL_DOWNLOAD_MIN_SIZE = int(os.getenv('PARALLEL_DOWNLOAD_MIN_SIZE', str(20 * 1024 * 1024)))
+# Media sessions used to upload the parts of one file concurrently
+PARALLEL_UPLOAD_CONNECTIONS = int(os.getenv('PARALLEL_UPLOAD_CONNECTIONS', '4'))
+# Interrupted yt-dlp downloads are kept for resuming; untouched ones are removed after PARTIAL_TTL seconds
+PARTIAL_TTL = int(os.getenv('PARTIAL_TTL', str(24 * 3600)))
+PARTIAL_GC_INTERVAL = int(os.getenv('PARTIAL_GC_INTERVAL', '3600'))
+# Disk admission: free bytes to keep, reservation per input byte (source, output and segments), and the guess for unknown sizes
+DISK_MIN_FREE = int(os.getenv('DISK_MIN_FREE', str(2 * 1024 ** 3)))
+DISK_RESERVE_FACTOR = float(os.getenv('DISK_RESERVE_FACTOR', '2.5'))
+DISK_DEFAULT_ESTIMATE = int(os.getenv('DISK_DEFAULT_ESTIMATE', str(1024 ** 3)))
+# Local HTTP endpoint serving /metrics; set METRICS_PORT to 0 to disable it
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+# Inline keyboard sessions (entries kept in memory, seconds until the buttons expire, and whether they survive restarts)
+CALLBACK_SESSION_SIZE = int(os.getenv('CALLBACK_SESSION_SIZE', '1024'))
+CALLBACK_SESSION_TTL = int(os.getenv('CALLBACK_SESSION_TTL', str(6 * 3600)))
+CALLBACK_SESSION_PERSIST = os.getenv('CALLBACK_SESSION_PERSIST', 'true').lower() == 'true'
+# Most videos one /yl batch or playlist may queue
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+# Adaptive presets (/set auto): tallest output, audio kbit/s, encode seconds per media second, and pixels/s one core encodes at x264 medium
+ADAPTIVE_MAX_HEIGHT = int(os.getenv('ADAPTIVE_MAX_HEIGHT', '1080'))
+ADAPTIVE_AUDIO_BITRATE = int(os.getenv('ADAPTIVE_AUDIO_BITRATE', '128'))
+ADAPTIVE_CPU_BUDGET = float(os.getenv('ADAPTIVE_CPU_BUDGET', '1.0'))
+ADAPTIVE_PIXELS_PER_CORE = int(os.getenv('ADAPTIVE_PIXELS_PER_CORE', '15000000'))
+# Content-keyed cache of two-pass logs, keyframe indexes and encoded segments (directory, size limit in bytes)
+ENCODE_CACHE_DIR = os.getenv('ENCODE_CACHE_DIR', os.path.join('downloads', 'cache'))
+ENCODE_CACHE_MAX_BYTES = int(os.getenv('ENCODE_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+# Process role: 'all' runs everything in one process, 'dispatcher' only handles Telegram updates and
+# queues jobs, 'worker' only runs queued jobs (start any number next to one dispatcher, sharing DB_NAME)
+ROLE = os.getenv('ROLE', 'all')
+WORKER_ID = os.getenv('WORKER_ID', '')  # Defaults to host name and process id
+WORKER_MAX_JOBS = int(os.getenv('WORKER_MAX_JOBS', '4'))
+# Seconds between worker heartbeats, silence after which a worker's jobs are reassigned, and queue polling
+WORKER_HEARTBEAT = float(os.getenv('WORKER_HEARTBEAT', '10'))
+WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', '60'))
+BROKER_POLL_INTERVAL = float(os.getenv('BROKER_POLL_INTERVAL', '1'))
+# Seconds between checks for authorization and /set changes made by other processes
+SETTINGS_REFRESH_INTERVAL = float(os.getenv('SETTINGS_REFRESH_INTERVAL', '5'))
+# Budgets for users outside AUTH_USERS (owners are unlimited and jump the stage queues): ffmpeg threads per job,
+# niceness of their ffmpeg processes, jobs running at once, and bytes downloaded plus uploaded per UTC day (0 = no limit)
+USER_FFMPEG_THREADS = int(os.getenv('USER_FFMPEG_THREADS', '2'))
+USER_NICE = int(os.getenv('USER_NICE', '10'))
+USER_MAX_JOBS = int(os.getenv('USER_MAX_JOBS', '3'))
+USER_DAILY_BYTES = int(os.getenv('USER_DAILY_BYTES', str(20 * 1024 ** 3)))
 FFMPEG_LOCATION = '/usr/bin/vegapunk'  # Replace with your actual FFmpeg path
 # config.py
 AUTH_USERS = [1908235162]  # Replace with your authorized user IDs
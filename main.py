@@ -2,7 +2,12 @@ import logging
 import os
 import asyncio
 from bot.client import Bot
-from config import DOWNLOADS_DIR
+from bot.utils.metrics import start_metrics_server
+from bot.utils.encode_cache import encode_cache
+from config import (
+    DOWNLOADS_DIR, INFO_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL, METRICS_HOST, METRICS_PORT, ROLE,
+    CALLBACK_SESSION_TTL
+)
 
 # Configure logging
 logging.basicConfig(
@@ -21,8 +26,26 @@ async def main():
     # Initialize the database
     await bot.db.initialize()
     logging.info("Database initialized.")
+    await bot.db.prune_video_info(INFO_CACHE_TTL)
+    await bot.db.evict_results(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL)
+    await bot.db.prune_callback_sessions(CALLBACK_SESSION_TTL)
+    await encode_cache.load()
+
+    if METRICS_PORT:
+        try:
+            await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            # Several workers on one machine need a METRICS_PORT each
+            logging.error(f"Metrics endpoint not started: {e}")
 
-    await bot.run()  # Ensure this calls the correct run method of the bot
+    try:
+        if ROLE == 'worker':
+            await bot.run_worker()
+        else:
+            await bot.run()  # Ensure this calls the correct run method of the bot
+    finally:
+        await bot.sessions.close()
+        await bot.db.close()
 
 if __name__ == '__main__':
     try:
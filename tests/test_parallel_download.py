@@ -0,0 +1,133 @@
+import asyncio
+import os
+import pytest
+from pyrogram import raw
+from pyrogram.errors import FilePartMissing
+from pyrogram.file_id import FileId, FileType
+from bot.utils.parallel_download import ParallelDownloader, PartBitmap, TelegramPartSource, PARTS_SUFFIX
+
+PART_SIZE = 1024
+FILE_ID = FileId(file_type=FileType.DOCUMENT, dc_id=2, media_id=1, access_hash=2, file_reference=b"").encode()
+
+
+class FakePartServer:
+    """Serves upload.GetFile for one file, like the media sessions of a DC would.
+
+    `delay(index)` postpones the answer for a part, `fail(index, attempt)` returns an error
+    to raise instead of the data (attempts count from 1), and every request is logged.
+    """
+
+    def __init__(self, data, delay=None, fail=None):
+        self.data = data
+        self.delay = delay or (lambda index: 0)
+        self.fail = fail or (lambda index, attempt: None)
+        self.requests = []  # part indexes in request order
+        self.completed = []  # part indexes in the order they were answered
+
+    async def session(self, dc_id, count):
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, server):
+        self.server = server
+
+    async def invoke(self, query, sleep_threshold=None):
+        assert isinstance(query, raw.functions.upload.GetFile)
+        index = query.offset // query.limit
+        self.server.requests.append(index)
+        await asyncio.sleep(self.server.delay(index))
+        error = self.server.fail(index, self.server.requests.count(index))
+        if error is not None:
+            raise error
+        self.server.completed.append(index)
+        return raw.types.upload.File(
+            type=raw.types.storage.FileUnknown(), mtime=0,
+            bytes=self.server.data[query.offset:query.offset + query.limit]
+        )
+
+
+def download(server, path, connections=4):
+    source = TelegramPartSource(server, FILE_ID, connections)
+    downloader = ParallelDownloader(source, len(server.data), str(path), connections, part_size=PART_SIZE)
+    return asyncio.run(downloader.run())
+
+
+def payload(parts):
+    # The last part is short, like most real files
+    return os.urandom(parts * PART_SIZE - 100)
+
+
+def test_parts_answered_out_of_order(tmp_path):
+    data = payload(8)
+    # Later parts come back first
+    server = FakePartServer(data, delay=lambda index: (8 - index) * 0.01)
+    path = tmp_path / "video.mp4"
+
+    download(server, path)
+
+    assert server.completed != sorted(server.completed)
+    assert path.read_bytes() == data
+
+
+def test_missing_part_is_requested_again(tmp_path):
+    data = payload(4)
+    server = FakePartServer(
+        data, fail=lambda index, attempt: FilePartMissing(value=index) if index == 2 and attempt == 1 else None
+    )
+    path = tmp_path / "video.mp4"
+
+    download(server, path)
+
+    assert server.requests.count(2) == 2
+    assert path.read_bytes() == data
+
+
+def test_interrupted_download_resumes_from_bitmap(tmp_path):
+    data = payload(8)
+    path = tmp_path / "video.mp4"
+    # A dropped connection is not retried, so the first attempt stops with parts missing
+    broken = FakePartServer(data, fail=lambda index, attempt: RuntimeError("connection lost") if index >= 5 else None)
+
+    with pytest.raises(RuntimeError):
+        download(broken, path, connections=1)
+
+    bitmap = PartBitmap(str(path) + PARTS_SUFFIX, len(data), PART_SIZE)
+    bitmap.load()
+    assert bitmap.missing() == [5, 6, 7]
+
+    server = FakePartServer(data)
+    download(server, path)
+
+    assert sorted(server.requests) == [5, 6, 7]
+    assert path.read_bytes() == data
+
+
+def test_finished_download_is_not_fetched_again(tmp_path):
+    data = payload(4)
+    path = tmp_path / "video.mp4"
+    download(FakePartServer(data), path)
+    # A retry after a later stage failed finds the complete file and its bitmap
+    assert os.path.exists(str(path) + PARTS_SUFFIX)
+
+    server = FakePartServer(data)
+    download(server, path)
+
+    assert server.requests == []
+    assert path.read_bytes() == data
+
+
+def test_bitmap_of_another_file_is_ignored(tmp_path):
+    data = payload(4)
+    path = tmp_path / "video.mp4"
+    stale = PartBitmap(str(path) + PARTS_SUFFIX, len(data) + 1, PART_SIZE)
+    for index in range(stale.count):
+        stale.add(index)
+    stale.save()
+    path.write_bytes(b"\0" * len(data))
+
+    server = FakePartServer(data)
+    download(server, path)
+
+    assert sorted(server.requests) == [0, 1, 2, 3]
+    assert path.read_bytes() == data